@@ -0,0 +1,3 @@
+"""
+Замеры производительности на синтетических данных, см. benchmarks/stages.py
+"""
@@ -0,0 +1,327 @@
+"""
+soak.py - длительный замер (сезон обработки) на синтетических данных.
+
+Данные сезона генерируются день за днем (см. benchmarks.synthetic), после каждого дня NPPProcessor запускается
+с DATE, равной этому дню, как при ежедневном запуске на станции приема. Для каждого дня и этапа записывается:
+
+* время этапа (секунды);
+* количество SQL запросов к БД;
+* количество обращений к файловой системе из python (открытие файлов, чтение содержимого папок, glob и т. п.,
+  по событиям sys.addaudithook; обращения GDAL из C не учитываются);
+* пиковый RSS процесса за день;
+* размер архива: количество папок витков и записей в основных таблицах БД.
+
+Объем работы за день постоянный (одинаковое количество витков), поэтому время этапа не должно расти вместе
+с архивом. По окончании для каждого этапа считается наклон зависимости log(время за день) от log(размер архива):
+суммарное время этапа за сезон растет как N^(1 + наклон), этапы с наклоном больше --threshold отмечаются как
+растущие сверхлинейно.
+
+Пример (короткий прогон):
+
+    python -m benchmarks.soak --days 20 --passes 6 --workdir /tmp/viirs_soak
+"""
+import argparse
+import json
+import resource
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import numpy as np
+
+from benchmarks import synthetic
+from benchmarks.stages import git_revision
+
+# события sys.addaudithook, которые считаются обращениями к файловой системе
+_FS_EVENTS = frozenset((
+    'open', 'os.listdir', 'os.scandir', 'glob.glob', 'os.mkdir', 'os.remove', 'os.rename',
+    'os.rmdir', 'os.chmod', 'shutil.copyfile', 'os.walk',
+))
+
+# методы NPPProcessor, время которых замеряется целиком (этапы внутри них замеряются отдельно через
+# _on_before_processing/_on_after_processing)
+_TIMED_METHODS = (
+    '_on_start',
+    '_find_viirs_directories',
+    '_process_directory',
+    '_produce_daily_products',
+    '_produce_maps',
+)
+
+REPORT_FIELDS = ('seconds', 'queries', 'fs_calls')
+
+
+class _Counters:
+    def __init__(self):
+        self.queries = 0
+        self.fs_calls = 0
+        self.enabled = False
+
+    def snapshot(self):
+        return time.perf_counter(), self.queries, self.fs_calls
+
+
+COUNTERS = _Counters()
+
+
+def _audit_hook(event, _):
+    if COUNTERS.enabled and event in _FS_EVENTS:
+        COUNTERS.fs_calls += 1
+
+
+def _quiet_logger():
+    from loguru import logger
+    logger.remove()
+    logger.add(sys.stderr, level='ERROR')
+
+
+def _reset_peak_rss():
+    # запись "5" в clear_refs сбрасывает VmHWM (Linux), иначе пик считается с начала работы процесса
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def _peak_rss_mb() -> float:
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class DayStats:
+    def __init__(self):
+        self.stages = defaultdict(lambda: dict.fromkeys(REPORT_FIELDS, 0))
+
+    def add(self, stage, start):
+        ts, queries, fs_calls = COUNTERS.snapshot()
+        entry = self.stages[stage]
+        entry['seconds'] += ts - start[0]
+        entry['queries'] += queries - start[1]
+        entry['fs_calls'] += fs_calls - start[2]
+
+    @contextmanager
+    def measure(self, stage):
+        start = COUNTERS.snapshot()
+        try:
+            yield
+        finally:
+            self.add(stage, start)
+
+
+def _make_soak_processor_class():
+    from gdal_viirs.hl import NPPProcessor
+
+    class SoakProcessor(NPPProcessor):
+        """
+        NPPProcessor, который замеряет этапы обработки (см. _TIMED_METHODS и хуки _on_before_processing)
+        """
+        day_stats: DayStats = None
+
+        def __init__(self, config=None):
+            super(SoakProcessor, self).__init__(config)
+            self._started = {}
+            for name in _TIMED_METHODS:
+                setattr(self, name, self._timed(name, getattr(self, name)))
+
+        def _timed(self, name, fn):
+            def wrapper(*args, **kwargs):
+                with self.day_stats.measure(name.strip('_')):
+                    return fn(*args, **kwargs)
+
+            return wrapper
+
+        def _on_before_processing(self, name, src_type, inputs=None, **tags):
+            super(SoakProcessor, self)._on_before_processing(name, src_type, inputs, **tags)
+            self._started[(str(name), src_type)] = COUNTERS.snapshot()
+
+        def _on_after_processing(self, name, src_type):
+            super(SoakProcessor, self)._on_after_processing(name, src_type)
+            start = self._started.pop((str(name), src_type), None)
+            if start is not None:
+                self.day_stats.add(f'product:{src_type}', start)
+
+    return SoakProcessor
+
+
+def _make_config(workdir: Path, day: datetime, columns: int) -> dict:
+    config = {
+        'CONFIG_DIR': str(workdir / 'cfg'),
+        'LOG_PATH': str(workdir / 'logs'),
+        'DATE': day.strftime('%d-%m-%Y'),
+        # при IS_DEBUG = False create_npp_processor добавляет вывод в stdout уровня INFO
+        'IS_DEBUG': True,
+        'WIDTH': 1600,
+        'HEIGHT': 1200,
+        'LOGO_PATH': str(Path(__file__).parent.parent / 'required_resources' / 'logo.png'),
+        'ISO_QUALITY_SIGN': str(Path(__file__).parent.parent / 'required_resources' / 'iso_sign.jpg'),
+        'INPUTS': {'data': str(workdir / 'input')},
+        'OUTPUTS': {
+            'processed_data': str(workdir / 'processed'),
+            'ndvi': str(workdir / 'maps' / 'ndvi'),
+            'ndvi_dynamics': str(workdir / 'maps' / 'ndvi_dynamics'),
+        },
+        'MAPS_FILENAME_PATTERN': {'ndvi': '{yymmdd}_{name}.png', 'ndvi_dynamics': '{yymmdd}_{name}.png'},
+        'PNG_CONFIG': [
+            {'name': 'region', 'display_name': 'Регион', 'xlim': (-600000, 600000), 'ylim': (-700000, 500000)},
+        ],
+        'NDVI_MERGE_PERIOD_IN_DAYS': 5,
+        # размер пикселя выходной сетки пропорционален уменьшению количества точек в строке,
+        # чтобы размер сетки соответствовал размеру снимка
+        'SCALE_MULTIPLIER': max(1, round(synthetic.I_BAND_COLUMNS / columns)),
+    }
+    return config
+
+
+def _archive_size(workdir: Path) -> dict:
+    from gdal_viirs.persistence.models import ProcessedViirsL1, NDVITiff, NDVIComposite
+    input_dir = workdir / 'input'
+    return {
+        'directories': sum(1 for p in input_dir.iterdir() if p.is_dir()) if input_dir.is_dir() else 0,
+        'processed_l1': ProcessedViirsL1.select().count(),
+        'ndvi_tiff': NDVITiff.select().count(),
+        'ndvi_composite': NDVIComposite.select().count(),
+    }
+
+
+def run_day(workdir: Path, day: datetime, columns: int, maps: bool) -> dict:
+    from gdal_viirs.hl.shortcuts import setup_env, create_npp_processor
+    from gdal_viirs.persistence.models import db_proxy
+
+    processor_class = _make_soak_processor_class()
+    config = _make_config(workdir, day, columns)
+    config['BUILDER_CLASS'] = processor_class
+    stats = DayStats()
+    processor_class.day_stats = stats
+
+    _reset_peak_rss()
+    COUNTERS.enabled = True
+    failed = False
+    try:
+        with setup_env(config) as config:
+            db = db_proxy.obj
+            execute_sql = db.execute_sql
+
+            def counting_execute_sql(*args, **kwargs):
+                COUNTERS.queries += 1
+                return execute_sql(*args, **kwargs)
+
+            db.execute_sql = counting_execute_sql
+            with stats.measure('total'):
+                processor = create_npp_processor(config)
+                try:
+                    with stats.measure('produce_products'):
+                        processor.produce_products()
+                    if maps:
+                        with stats.measure('produce_maps'):
+                            processor.produce_maps()
+                except SystemExit:
+                    # produce_products/produce_maps завершают процесс при ошибке
+                    failed = True
+            COUNTERS.enabled = False
+            archive = _archive_size(workdir)
+    finally:
+        COUNTERS.enabled = False
+        # каждый NPPProcessor добавляет свой файл лога, при ежедневном запуске это новый процесс
+        _quiet_logger()
+
+    return {
+        'date': day.strftime('%Y-%m-%d'),
+        'failed': failed,
+        'peak_rss_mb': _peak_rss_mb(),
+        'archive': archive,
+        'stages': dict(stats.stages),
+    }
+
+
+def scaling_report(days, threshold: float) -> list:
+    """
+    Наклон зависимости log(значение за день) от log(количество папок в архиве) для каждого этапа и показателя
+    """
+    result = []
+    archive = np.array([d['archive']['directories'] for d in days], 'float64')
+    stages = sorted(set(stage for d in days for stage in d['stages']))
+    for stage in stages:
+        for field in REPORT_FIELDS:
+            values = np.array([d['stages'].get(stage, {}).get(field, 0) for d in days], 'float64')
+            mask = (values > 0) & (archive > 0)
+            if mask.sum() < 3 or np.unique(archive[mask]).shape[0] < 2:
+                continue
+            slope = float(np.polyfit(np.log(archive[mask]), np.log(values[mask]), 1)[0])
+            result.append({
+                'stage': stage,
+                'field': field,
+                'slope': slope,
+                'first': float(values[mask][0]),
+                'last': float(values[mask][-1]),
+                'superlinear': slope > threshold,
+            })
+    return result
+
+
+def _print_report(scaling):
+    print(f'{"этап":<36} {"показатель":<10} {"наклон":>7} {"первый день":>12} {"последний":>12}')
+    for entry in sorted(scaling, key=lambda e: -e['slope']):
+        mark = ' <- растет с архивом' if entry['superlinear'] else ''
+        print(f'{entry["stage"]:<36} {entry["field"]:<10} {entry["slope"]:7.2f} '
+              f'{entry["first"]:12.3f} {entry["last"]:12.3f}{mark}')
+
+
+def _main():
+    parser = argparse.ArgumentParser(description='длительный замер обработки сезона на синтетических данных')
+    parser.add_argument('--workdir', help='папка для данных и результатов (по умолчанию - временная)')
+    parser.add_argument('--start', default='2021-05-01', help='первый день сезона, YYYY-MM-DD')
+    parser.add_argument('--days', type=int, default=180)
+    parser.add_argument('--passes', type=int, default=14, help='витков в день')
+    parser.add_argument('--scans', type=int, default=2, help='сканов в витке')
+    parser.add_argument('--columns', type=int, default=400, help='точек в строке')
+    parser.add_argument('--maps', action='store_true', help='также создавать карты')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='наклон, начиная с которого этап считается растущим вместе с архивом')
+    args = parser.parse_args()
+
+    _quiet_logger()
+
+    workdir = Path(args.workdir or tempfile.mkdtemp(prefix='viirs_soak_'))
+    workdir.mkdir(parents=True, exist_ok=True)
+    report_file = workdir / f'soak_{git_revision()}.jsonl'
+    sys.addaudithook(_audit_hook)
+    print(f'данные и результаты: {workdir}', flush=True)
+
+    days = []
+    start = datetime.strptime(args.start, '%Y-%m-%d')
+    with open(report_file, 'w') as report:
+        for index in range(args.days):
+            day = start + timedelta(days=index)
+            # солнечно-синхронная орбита: соседние витки смещены на запад на ~25° и на ~101 минуту,
+            # поэтому местное время пролета у всех витков одинаковое
+            synthetic.write_day(str(workdir / 'input'), day, args.passes, args.scans, args.columns,
+                                first_orbit=50000 + index * args.passes, lon_step=-25.3, first_hour=0)
+            entry = run_day(workdir, day, args.columns, args.maps)
+            days.append(entry)
+            report.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            report.flush()
+            total = entry['stages'].get('total', {})
+            print(f'{entry["date"]}: папок {entry["archive"]["directories"]:5d} '
+                  f'{total.get("seconds", 0):7.2f}s запросов {total.get("queries", 0):6d} '
+                  f'ФС {total.get("fs_calls", 0):6d} RSS {entry["peak_rss_mb"]:7.1f} MB'
+                  + (' ОШИБКА' if entry['failed'] else ''), flush=True)
+
+    scaling = scaling_report(days, args.threshold)
+    with open(workdir / f'soak_{git_revision()}_scaling.json', 'w') as f:
+        json.dump(scaling, f, indent=2, ensure_ascii=False)
+    _print_report(scaling)
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,374 @@
+"""
+stages.py измеряет время и потребление памяти отдельных этапов обработки на синтетических данных
+(см. benchmarks.synthetic) для нескольких размеров витка.
+
+Каждый замер выполняется в отдельном процессе, подготовка (например, обработка геолокации перед замером
+process_band_file) в замер не входит. Для каждого этапа сохраняется:
+
+* время (минимальное и медиана по повторам);
+* пропускная способность - миллионов точек (пикселей) в секунду;
+* пик памяти, выделенной через python/numpy (tracemalloc), и максимальный RSS процесса.
+
+Результаты записываются в benchmarks/results/{commit}.json, чтобы сравнивать их между коммитами:
+
+    python -m benchmarks.stages run --scans 12 48
+    python -m benchmarks.stages compare ad063fd HEAD
+"""
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+
+RESULTS_DIR = Path(__file__).parent / 'results'
+
+STAGES = (
+    'process_geoloc_file',
+    'process_band_file',
+    'process_band_files',
+    'process_band_files_shared',
+    'process_ndvi',
+    'merge_files',
+    'merge_files_tiled',
+    'composite_files',
+    'process_ndvi_dynamics',
+    'produce_image',
+)
+
+# разрешение I-каналов
+SCALE = 375
+
+
+def _quiet_logger():
+    from loguru import logger
+    logger.remove()
+    logger.add(sys.stderr, level='WARNING')
+
+
+def _find_fileset(directory):
+    from gdal_viirs.hl.utility import find_npp_viirs_filesets
+    return find_npp_viirs_filesets(directory)[0]
+
+
+def _raster_pixels(path):
+    import rasterio
+    with rasterio.open(path) as f:
+        return f.width * f.height
+
+
+# region этапы
+# каждая функция принимает словарь с путями к подготовленным данным и возвращает пару функций:
+# (замеряемая функция, количество точек для подсчета пропускной способности)
+
+def _stage_process_geoloc_file(data):
+    from gdal_viirs import process
+    fs = _find_fileset(data['passes'][0])
+
+    def run():
+        return process.process_geoloc_file(fs.geoloc_file, SCALE)
+
+    return run, lambda result: result.samples_count
+
+
+def _stage_process_band_file(data):
+    from gdal_viirs import process
+    fs = _find_fileset(data['passes'][0])
+    geoloc = process.process_geoloc_file(fs.geoloc_file, SCALE)
+    band = next(file for file in fs.band_files if file.file_type == 'SVI01')
+
+    def run():
+        return process.process_band_file(band, geoloc)
+
+    return run, lambda _: geoloc.samples_count
+
+
+def _stage_process_band_files(data, workers=None):
+    from gdal_viirs import process
+    fs = _find_fileset(data['passes'][0])
+    geoloc = process.process_geoloc_file(fs.geoloc_file, SCALE)
+
+    def run():
+        return process._process_band_files(geoloc, fs.band_files, workers=workers)
+
+    return run, lambda _: geoloc.samples_count * len(fs.band_files)
+
+
+def _stage_process_band_files_shared(data):
+    # каналы в отдельных процессах, геолокация и сетка каналов в разделяемой памяти (см. gdal_viirs.sharedmem)
+    return _stage_process_band_files(data, workers=4)
+
+
+def _stage_process_ndvi(data):
+    from gdal_viirs import process
+    output = os.path.join(data['tmp'], 'ndvi.tiff')
+
+    def run():
+        process.process_ndvi(data['vimgo'][0], output, data['clouds'][0], warp_cloud_mask=True)
+
+    return run, lambda _: _raster_pixels(output)
+
+
+def _stage_merge_files(data):
+    from gdal_viirs import merge
+
+    def run():
+        return merge.merge_files(data['ndvi'])
+
+    return run, lambda result: result[0].shape[-1] * result[0].shape[-2]
+
+
+def _stage_merge_files_tiled(data):
+    from gdal_viirs import merge
+    output = os.path.join(data['tmp'], 'merged.tiff')
+
+    def run():
+        merge.merge_files2tiff_tiled(data['ndvi'], output)
+
+    return run, lambda _: _raster_pixels(output)
+
+
+def _stage_composite_files(data):
+    from gdal_viirs import merge
+    output = os.path.join(data['tmp'], 'composite.tiff')
+
+    def run():
+        merge.composite_files2tiff(data['ndvi'], output)
+
+    return run, lambda _: _raster_pixels(output)
+
+
+def _stage_process_ndvi_dynamics(data):
+    from gdal_viirs import process
+    output = os.path.join(data['tmp'], 'dynamics.tiff')
+
+    def run():
+        process.process_ndvi_dynamics_multi(data['composites'][1], [data['composites'][0]], [output])
+
+    return run, lambda _: _raster_pixels(output)
+
+
+def _stage_produce_image(data):
+    import rasterio
+    from gdal_viirs.maps.shortcuts import produce_image
+    root = Path(__file__).parent.parent / 'required_resources'
+    output = os.path.join(data['tmp'], 'map.png')
+    with rasterio.open(data['composites'][1]) as f:
+        bounds = f.bounds
+
+    def run():
+        produce_image(data['composites'][1], output,
+                      expected_width=16, expected_height=12, dpi=100,
+                      logo_path=str(root / 'logo.png'), iso_sign_path=str(root / 'iso_sign.jpg'),
+                      xlim=(bounds.left, bounds.right), ylim=(bounds.bottom, bounds.top))
+
+    return run, lambda _: _raster_pixels(data['composites'][1])
+
+
+# endregion
+
+
+def _measure(stage: str, data: dict) -> dict:
+    """
+    Выполняется в отдельном процессе: подготовка этапа, затем один замер.
+    """
+    _quiet_logger()
+    run, count = globals()[f'_stage_{stage}'](data)
+    tracemalloc.start()
+    ts = time.perf_counter()
+    result = run()
+    elapsed = time.perf_counter() - ts
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'seconds': elapsed,
+        'points': int(count(result)),
+        'peak_traced_mb': peak / 2 ** 20,
+        'max_rss_mb': _max_rss_mb(),
+    }
+
+
+def _max_rss_mb() -> float:
+    # ru_maxrss наследуется от родительского процесса при fork, VmHWM относится только к текущему процессу
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _measure_in_subprocess(stage: str, data: dict) -> dict:
+    context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(_measure, stage, data).result()
+
+
+def prepare_data(workdir: str, scans: int, columns: int) -> dict:
+    """
+    Генерирует три соседних витка и готовит промежуточные файлы для этапов, которые работают с результатами
+    предыдущих (NDVI, композиты).
+    """
+    from benchmarks import synthetic
+    from gdal_viirs import process, merge
+
+    root = os.path.join(workdir, f'scans{scans}_columns{columns}')
+    tmp = os.path.join(root, 'tmp')
+    os.makedirs(tmp, exist_ok=True)
+    passes = synthetic.write_day(os.path.join(root, 'input'), datetime(2021, 7, 1), 3, scans, columns, lon_step=6.)
+
+    data = {'passes': passes, 'tmp': tmp, 'vimgo': [], 'ndvi': [], 'clouds': [], 'composites': []}
+    for index, directory in enumerate(passes):
+        fs = _find_fileset(directory)
+        vimgo = os.path.join(tmp, f'{index}.VIMGO.tiff')
+        ndvi = os.path.join(tmp, f'{index}.NDVI.tiff')
+        clouds = next(Path(directory, 'viirs', 'level2').glob('*CLOUDMASK.tif'))
+        process.process_fileset(fs, vimgo, SCALE)
+        process.process_ndvi(vimgo, ndvi, str(clouds), warp_cloud_mask=True)
+        data['vimgo'].append(vimgo)
+        data['ndvi'].append(ndvi)
+        data['clouds'].append(str(clouds))
+
+    # два "композита" за соседние периоды для динамики NDVI
+    for index, files in enumerate((data['ndvi'][:2], data['ndvi'][1:])):
+        composite = os.path.join(tmp, f'composite{index}.tiff')
+        merge.merge_files2tiff(files, composite)
+        data['composites'].append(composite)
+    return data
+
+
+def git_revision() -> str:
+    """
+    Короткий хеш текущего коммита, с суффиксом -dirty, если есть незакоммиченные изменения.
+    """
+    root = Path(__file__).parent.parent
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=root, text=True).strip()
+        dirty = subprocess.run(['git', 'diff', '--quiet', 'HEAD', '--', 'gdal_viirs'], cwd=root).returncode != 0
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return revision + ('-dirty' if dirty else '')
+
+
+def run_benchmarks(scans_list, columns: int, stages, repeat: int, workdir: str = None, keep: bool = False) -> dict:
+    _quiet_logger()
+    workdir = workdir or tempfile.mkdtemp(prefix='viirs_bench_')
+    report = {
+        'revision': git_revision(),
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'machine': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+        },
+        'repeat': repeat,
+        'results': [],
+    }
+    try:
+        for scans in scans_list:
+            print(f'подготовка данных: {scans} сканов x {columns} точек ...', flush=True)
+            data = prepare_data(workdir, scans, columns)
+            for stage in stages:
+                runs = []
+                for _ in range(repeat):
+                    try:
+                        runs.append(_measure_in_subprocess(stage, data))
+                    except Exception as exc:
+                        print(f'  {stage}: ошибка {type(exc).__name__}: {exc}', flush=True)
+                        break
+                if len(runs) == 0:
+                    report['results'].append({'stage': stage, 'scans': scans, 'columns': columns, 'error': True})
+                    continue
+                seconds = [r['seconds'] for r in runs]
+                entry = {
+                    'stage': stage,
+                    'scans': scans,
+                    'columns': columns,
+                    'points': runs[0]['points'],
+                    'seconds_min': min(seconds),
+                    'seconds_median': statistics.median(seconds),
+                    'mpoints_per_second': runs[0]['points'] / min(seconds) / 1e6,
+                    'peak_traced_mb': max(r['peak_traced_mb'] for r in runs),
+                    'max_rss_mb': max(r['max_rss_mb'] for r in runs),
+                }
+                report['results'].append(entry)
+                print(f'  {stage:<24} {entry["seconds_min"]:8.3f}s {entry["mpoints_per_second"]:8.2f} Mpt/s '
+                      f'peak {entry["peak_traced_mb"]:8.1f} MB rss {entry["max_rss_mb"]:8.1f} MB', flush=True)
+    finally:
+        if not keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return report
+
+
+def save_report(report: dict) -> Path:
+    RESULTS_DIR.mkdir(parents=True, exist_ok=True)
+    path = RESULTS_DIR / f'{report["revision"]}.json'
+    path.write_text(json.dumps(report, indent=2, ensure_ascii=False))
+    return path
+
+
+def _load_report(name: str) -> dict:
+    path = Path(name)
+    if not path.is_file():
+        if name == 'HEAD':
+            name = git_revision()
+        candidates = sorted(RESULTS_DIR.glob(f'{name}*.json'))
+        if len(candidates) == 0:
+            raise FileNotFoundError(f'результаты для {name} не найдены в {RESULTS_DIR}')
+        path = candidates[0]
+    return json.loads(path.read_text())
+
+
+def compare_reports(old: dict, new: dict):
+    key = lambda r: (r['stage'], r['scans'], r['columns'])
+    old_results = {key(r): r for r in old['results'] if not r.get('error')}
+    print(f'{old["revision"]} -> {new["revision"]}')
+    for entry in new['results']:
+        previous = old_results.get(key(entry))
+        if previous is None or entry.get('error'):
+            continue
+        ratio = previous['seconds_min'] / entry['seconds_min']
+        memory = entry['peak_traced_mb'] - previous['peak_traced_mb']
+        print(f'  {entry["stage"]:<24} scans={entry["scans"]:<5} {previous["seconds_min"]:8.3f}s -> '
+              f'{entry["seconds_min"]:8.3f}s (x{ratio:.2f}) peak {memory:+8.1f} MB')
+
+
+def _main():
+    parser = argparse.ArgumentParser(description='замеры производительности этапов обработки')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='выполнить замеры')
+    run_parser.add_argument('--scans', type=int, nargs='+', default=[12, 48],
+                            help='размеры витка в сканах (48 сканов - одна гранула)')
+    run_parser.add_argument('--columns', type=int, default=6400, help='количество точек в строке')
+    run_parser.add_argument('--stages', nargs='+', choices=STAGES, default=list(STAGES))
+    run_parser.add_argument('--repeat', type=int, default=3)
+    run_parser.add_argument('--workdir', help='папка для синтетических данных (по умолчанию - временная)')
+    run_parser.add_argument('--keep', action='store_true', help='не удалять синтетические данные')
+
+    compare_parser = subparsers.add_parser('compare', help='сравнить результаты двух коммитов')
+    compare_parser.add_argument('old', help='коммит (начало хеша) или путь к файлу результатов')
+    compare_parser.add_argument('new', help='коммит (начало хеша), HEAD или путь к файлу результатов')
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        report = run_benchmarks(args.scans, args.columns, args.stages, args.repeat, args.workdir, args.keep)
+        print(f'результаты сохранены в {save_report(report)}')
+    else:
+        compare_reports(_load_report(args.old), _load_report(args.new))
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,122 @@
+"""
+startup.py - замер времени запуска (холодный старт процесса) для частых запусков из cron.
+
+Каждый замер - отдельный процесс python, время считается от запуска процесса до его завершения:
+
+* import - только импорт gdal_viirs.hl.shortcuts;
+* products - produce_products (как products_processor.py) для папки с уже обработанным синтетическим днем,
+  т. е. запуск, в котором нет новой работы;
+* maps_import - импорт gdal_viirs.maps (для сравнения, этот импорт нужен только при создании карт).
+
+Для каждого варианта выводится медиана и минимум по --repeat запускам и список тяжелых модулей,
+которые оказались импортированы. Результаты сохраняются в benchmarks/results/startup_{коммит}.json.
+
+Пример:
+
+    python -m benchmarks.startup --repeat 5
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+from benchmarks import synthetic
+from benchmarks.soak import _make_config
+from benchmarks.stages import git_revision
+
+_ROOT = Path(__file__).parent.parent
+
+# модули, импорт которых заметно замедляет запуск
+HEAVY_MODULES = (
+    'matplotlib', 'cartopy', 'shapely', 'adjustText', 'scipy.spatial', 'scipy.ndimage', 'scipy.sparse',
+)
+
+_SCRIPTS = {
+    'import': 'import gdal_viirs.hl.shortcuts',
+    'maps_import': 'import gdal_viirs.maps',
+    'products': (
+        'import json, sys\n'
+        'from gdal_viirs.hl.shortcuts import produce_products\n'
+        'produce_products(json.load(open(sys.argv[1])))\n'
+    ),
+}
+
+_REPORT_MODULES = (
+    '\nimport sys as _sys\n'
+    'print("MODULES", ",".join(m for m in {heavy!r} if m in _sys.modules))\n'
+)
+
+
+def _run(script: str, *args) -> tuple:
+    code = script + _REPORT_MODULES.format(heavy=HEAVY_MODULES)
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, '-c', code, *args], cwd=_ROOT, capture_output=True, text=True)
+    elapsed = time.perf_counter() - start
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else 'ошибка запуска')
+    modules = next((line[len('MODULES '):] for line in proc.stdout.splitlines() if line.startswith('MODULES ')), '')
+    return elapsed, [m for m in modules.split(',') if m]
+
+
+def _prepare_products_config(workdir: Path, scans: int, columns: int) -> Path:
+    """
+    Синтетический день и конфигурация, после первого (не замеряемого) запуска все витки уже обработаны
+    """
+    day = datetime(2021, 6, 1)
+    synthetic.write_day(str(workdir / 'input'), day, 2, scans, columns, first_orbit=50000)
+    config = _make_config(workdir, day, columns)
+    config['METRICS'] = False
+    config_file = workdir / 'config.json'
+    with open(config_file, 'w') as f:
+        json.dump(config, f, ensure_ascii=False)
+    _run(_SCRIPTS['products'], str(config_file))
+    return config_file
+
+
+def run_benchmarks(variants, repeat: int, scans: int, columns: int, workdir: str = None) -> dict:
+    workdir = Path(workdir or tempfile.mkdtemp(prefix='viirs_startup_'))
+    results = {'revision': git_revision(), 'python': sys.version.split()[0], 'variants': {}}
+    for variant in variants:
+        args = (str(_prepare_products_config(workdir, scans, columns)),) if variant == 'products' else ()
+        times, modules = [], []
+        for _ in range(repeat):
+            elapsed, modules = _run(_SCRIPTS[variant], *args)
+            times.append(elapsed)
+        results['variants'][variant] = {
+            'median_seconds': statistics.median(times),
+            'min_seconds': min(times),
+            'heavy_modules': modules,
+        }
+    return results
+
+
+def _main():
+    parser = argparse.ArgumentParser(description='время запуска процесса обработки')
+    parser.add_argument('variants', nargs='*', help=f'{", ".join(_SCRIPTS)} (по умолчанию - все)')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--scans', type=int, default=2, help='сканов в витке синтетических данных')
+    parser.add_argument('--columns', type=int, default=400, help='точек в строке синтетических данных')
+    parser.add_argument('--workdir', help='папка для синтетических данных (по умолчанию - временная)')
+    args = parser.parse_args()
+    for variant in args.variants:
+        if variant not in _SCRIPTS:
+            parser.error(f'неизвестный вариант {variant}')
+
+    results = run_benchmarks(args.variants or list(_SCRIPTS), args.repeat, args.scans, args.columns, args.workdir)
+    for variant, entry in results['variants'].items():
+        print(f'{variant:12s} медиана {entry["median_seconds"]:6.3f}s  минимум {entry["min_seconds"]:6.3f}s  '
+              f'модули: {", ".join(entry["heavy_modules"]) or "-"}')
+
+    results_dir = Path(__file__).parent / 'results'
+    results_dir.mkdir(exist_ok=True)
+    with open(results_dir / f'startup_{results["revision"]}.json', 'w') as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,243 @@
+"""
+synthetic.py генерирует синтетические данные NPP VIIRS (SDR HDF5 и маску облачности level2) в той же структуре
+папок, что и данные станции приема, чтобы измерять производительность без реальных данных.
+
+Геометрия полосы обзора: подспутниковая трасса идет по дуге большого круга с наклоном орбиты NPP, точки строки
+снимка расположены поперек трассы, расстояние до точки считается по углу сканирования с учетом высоты орбиты,
+поэтому размер пикселя растет к краям полосы как у настоящего VIIRS (эффект "bow-tie" не моделируется,
+но строки в краевых зонах каждого скана заполняются значением ND_OBPT, как в реальных SDR файлах).
+
+Пример:
+
+    python -m benchmarks.synthetic /tmp/viirs_synthetic --scans 48 --passes 3
+"""
+import argparse
+import os
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+import h5py
+import numpy as np
+import pyproj
+import rasterio
+import scipy.ndimage
+from rasterio.transform import from_origin
+
+from gdal_viirs.const import ND_OBPT
+
+# параметры I-каналов VIIRS
+I_BAND_COLUMNS = 6400
+I_BAND_SCAN_ROWS = 32
+I_BAND_PIXEL_SIZE = 375.
+SCANS_PER_GRANULE = 48
+
+_EARTH_RADIUS = 6371000.
+_ORBIT_ALTITUDE = 829000.
+_MAX_SCAN_ANGLE = np.radians(56.06)
+_ORBIT_INCLINATION = 98.7
+
+# коэффициенты (scale, offset) для перевода uint16 в физические величины, как в реальных файлах
+_REFLECTANCE_FACTORS = (2.4e-05, -0.0)
+_BT_FACTORS = (0.0034, 208.)
+
+_GEOD = pyproj.Geod(ellps='WGS84')
+
+
+def _smooth_field(rng: np.random.Generator, shape, sigma: float) -> np.ndarray:
+    """
+    Гладкое случайное поле со значениями от 0 до 1 (шум, сглаженный фильтром Гаусса на уменьшенной сетке)
+    """
+    factor = 8
+    small = rng.random((max(2, shape[0] // factor), max(2, shape[1] // factor)))
+    small = scipy.ndimage.gaussian_filter(small, sigma / factor)
+    field = scipy.ndimage.zoom(small, (shape[0] / small.shape[0], shape[1] / small.shape[1]), order=1)
+    field = field[:shape[0], :shape[1]]
+    field -= field.min()
+    return field / max(field.max(), 1e-9)
+
+
+def make_swath_geolocation(scans: int, columns: int = I_BAND_COLUMNS, lat0: float = 50., lon0: float = 80.,
+                           ascending: bool = True):
+    """
+    Строит широту и долготу полосы обзора.
+
+    :param scans: количество сканов (по 32 строки)
+    :param columns: количество точек в строке (6400 для I-каналов)
+    :param lat0: широта подспутниковой точки первой строки
+    :param lon0: долгота подспутниковой точки первой строки
+    :param ascending: восходящий (на север) или нисходящий виток
+    :return: широта и долгота (float32) размера (scans * 32, columns)
+    """
+    rows = scans * I_BAND_SCAN_ROWS
+    azimuth = (360. - _ORBIT_INCLINATION + 90.) % 360. if ascending else 180. + _ORBIT_INCLINATION - 90.
+    along = np.arange(rows, dtype='float64') * I_BAND_PIXEL_SIZE
+    track_lon, track_lat, track_az = _GEOD.fwd(np.full(rows, lon0), np.full(rows, lat0), np.full(rows, azimuth), along)
+
+    # расстояние от подспутниковой точки до точки строки по углу сканирования
+    scan_angle = np.linspace(-_MAX_SCAN_ANGLE, _MAX_SCAN_ANGLE, columns)
+    earth_angle = np.arcsin((_EARTH_RADIUS + _ORBIT_ALTITUDE) / _EARTH_RADIUS * np.sin(scan_angle)) - scan_angle
+    cross = _EARTH_RADIUS * earth_angle
+
+    shape = (rows, columns)
+    lon, lat, _ = _GEOD.fwd(
+        np.broadcast_to(track_lon[:, None], shape).ravel(),
+        np.broadcast_to(track_lat[:, None], shape).ravel(),
+        np.broadcast_to(track_az[:, None] + 90., shape).ravel(),
+        np.broadcast_to(cross[None, :], shape).ravel())
+    return lat.reshape(shape).astype('float32'), lon.reshape(shape).astype('float32')
+
+
+def _band_data(rng: np.random.Generator, field: np.ndarray, low: float, high: float, factors) -> np.ndarray:
+    value = low + (high - low) * field + rng.normal(0, (high - low) * 0.02, field.shape)
+    data = np.round((value - factors[1]) / factors[0])
+    return np.clip(data, 0, ND_OBPT - 10).astype('uint16')
+
+
+def _apply_scan_edge_fill(data: np.ndarray):
+    """
+    Заполняет первые и последние строки каждого скана в краевых зонах значением ND_OBPT,
+    как это делается в реальных SDR файлах (удаление перекрытия сканов, "bow-tie deletion")
+    """
+    columns = data.shape[1]
+    edge = columns // 6
+    for offset, rows in ((0, 4), (I_BAND_SCAN_ROWS - 4, 4)):
+        for start in range(offset, data.shape[0], I_BAND_SCAN_ROWS):
+            data[start:start + rows, :edge] = ND_OBPT
+            data[start:start + rows, columns - edge:] = ND_OBPT
+
+
+def write_pass(root: str, start: datetime, orbit: int, scans: int = SCANS_PER_GRANULE,
+               columns: int = I_BAND_COLUMNS, lat0: float = 50., lon0: float = 80., ascending: bool = True,
+               solar_zenith_offset: float = 0., cloud_fraction: float = 0.3, seed: Optional[int] = None,
+               cloud_mask: bool = True, cloud_mask_resolution: Optional[float] = None) -> str:
+    """
+    Записывает один синтетический виток: GIMGO и SVI01-SVI05 в папку viirs/level1 и маску облачности
+    в папку viirs/level2 (как ожидает gdal_viirs.hl.utility.find_npp_viirs_filesets).
+
+    :param root: папка, в которой будет создана папка витка вида NPP_{orbit}_{YYYYMMDD}
+    :param start: время начала витка
+    :param orbit: номер витка
+    :param scans: количество сканов (48 - одна гранула)
+    :param columns: количество точек в строке
+    :param lat0: широта подспутниковой точки первой строки
+    :param lon0: долгота подспутниковой точки первой строки
+    :param ascending: восходящий или нисходящий виток
+    :param solar_zenith_offset: добавляется к зенитному углу солнца (например, 90 и больше - ночной виток)
+    :param cloud_fraction: примерная доля облачных пикселей в маске облачности
+    :param seed: зерно генератора случайных чисел, по умолчанию - номер витка
+    :param cloud_mask: создавать ли маску облачности level2
+    :param cloud_mask_resolution: разрешение маски облачности в градусах, по умолчанию соответствует
+        размеру пикселя в надире (0.004° при 6400 точках в строке и пропорционально больше при меньшем количестве)
+    :return: путь к папке витка
+    """
+    rng = np.random.default_rng(orbit if seed is None else seed)
+    directory = os.path.join(root, f'NPP_{orbit}_{start.strftime("%Y%m%d")}')
+    level1 = os.path.join(directory, 'viirs', 'level1')
+    level2 = os.path.join(directory, 'viirs', 'level2')
+    os.makedirs(level1, exist_ok=True)
+
+    lat, lon = make_swath_geolocation(scans, columns, lat0, lon0, ascending)
+    rows = lat.shape[0]
+    end = start + timedelta(seconds=1.7853 * scans)
+    suffix = f'_npp_d{start.strftime("%Y%m%d")}_t{start.strftime("%H%M%S")}{start.microsecond // 100000}' \
+             f'_e{end.strftime("%H%M%S")}{end.microsecond // 100000}_b{orbit:05d}' \
+             f'_c{start.strftime("%Y%m%d%H%M%S")}000000_cspp_dev.h5'
+
+    # зенитный угол солнца: подсолнечная точка на широте 20° и долготе, соответствующей местному полудню
+    subsolar_lon = (12 - start.hour - start.minute / 60) * 15
+    cos_sza = np.sin(np.radians(lat)) * np.sin(np.radians(20.)) + \
+        np.cos(np.radians(lat)) * np.cos(np.radians(20.)) * np.cos(np.radians(lon - subsolar_lon))
+    sza = np.degrees(np.arccos(np.clip(cos_sza, -1, 1))) + solar_zenith_offset
+    del cos_sza
+
+    with h5py.File(os.path.join(level1, 'GIMGO' + suffix), 'w') as f:
+        group = f.create_group('All_Data/VIIRS-IMG-GEO_All')
+        group.create_dataset('Latitude', data=lat)
+        group.create_dataset('Longitude', data=lon)
+        group.create_dataset('SolarZenithAngle', data=np.clip(sza, 0, 180).astype('float32'))
+    del sza
+
+    vegetation = _smooth_field(rng, (rows, columns), 60)
+    # красный канал темнее над растительностью, ближний ИК - светлее
+    bands = {
+        1: ('Reflectance', 1 - vegetation, 0.03, 0.2, _REFLECTANCE_FACTORS),
+        2: ('Reflectance', vegetation, 0.15, 0.55, _REFLECTANCE_FACTORS),
+        3: ('Reflectance', vegetation, 0.1, 0.3, _REFLECTANCE_FACTORS),
+        4: ('BrightnessTemperature', 1 - vegetation, 280, 320, _BT_FACTORS),
+        5: ('BrightnessTemperature', 1 - vegetation, 270, 310, _BT_FACTORS),
+    }
+    for index, (dataset, field, low, high, factors) in bands.items():
+        data = _band_data(rng, field, low, high, factors)
+        _apply_scan_edge_fill(data)
+        quality = np.zeros((rows, columns), 'uint8')
+        quality[rng.random((rows, columns)) < 0.001] = 64
+        with h5py.File(os.path.join(level1, f'SVI0{index}' + suffix), 'w') as f:
+            group = f.create_group(f'All_Data/VIIRS-I{index}-SDR_All')
+            group.create_dataset(dataset, data=data)
+            group.create_dataset(dataset + 'Factors', data=np.array(factors * 2, 'float32'))
+            group.create_dataset(f'QF1_VIIRSI{index}BANDSDR', data=quality)
+        del data, quality
+    del vegetation
+
+    if cloud_mask:
+        os.makedirs(level2, exist_ok=True)
+        if cloud_mask_resolution is None:
+            cloud_mask_resolution = 0.004 * I_BAND_COLUMNS / columns
+        write_cloud_mask(os.path.join(level2, f'{os.path.basename(directory)}.CLOUDMASK.tif'), lat, lon, rng,
+                         cloud_fraction, cloud_mask_resolution)
+    return directory
+
+
+def write_cloud_mask(path: str, lat: np.ndarray, lon: np.ndarray, rng: np.random.Generator,
+                     cloud_fraction: float = 0.3, resolution: float = 0.004):
+    """
+    Записывает маску облачности level2 в EPSG:4326, покрывающую полосу обзора:
+    0 - нет данных, 1 - ясно, 2 - вероятно ясно, 3 - вероятно облачно, 4 - облачно.
+    """
+    west, east = float(lon.min()), float(lon.max())
+    south, north = float(lat.min()), float(lat.max())
+    width = int(np.ceil((east - west) / resolution))
+    height = int(np.ceil((north - south) / resolution))
+    field = _smooth_field(rng, (height, width), 40)
+    threshold = np.quantile(field, 1 - cloud_fraction)
+    mask = np.digitize(field, [threshold * 0.6, threshold * 0.8, threshold]).astype('uint8') + 1
+    with rasterio.open(path, 'w', driver='GTiff', count=1, width=width, height=height, dtype='uint8',
+                       crs='EPSG:4326', transform=from_origin(west, north, resolution, resolution),
+                       compress='deflate') as f:
+        f.write(mask, 1)
+
+
+def write_day(root: str, day: datetime, passes: int, scans: int = SCANS_PER_GRANULE, columns: int = I_BAND_COLUMNS,
+              first_orbit: int = 50000, lat0: float = 50., lon0: float = 80., lon_step: float = 25.,
+              first_hour: int = 3, **kwargs) -> List[str]:
+    """
+    Записывает несколько витков за один день, витки смещены по долготе на lon_step (примерно как соседние витки
+    полярно-орбитального спутника) и по времени на ~101 минуту.
+
+    :return: список папок витков
+    """
+    directories = []
+    for index in range(passes):
+        offset = index - (passes - 1) / 2
+        start = day.replace(hour=first_hour, minute=0, second=0, microsecond=0) + timedelta(minutes=101 * index)
+        directories.append(write_pass(root, start, first_orbit + index, scans, columns, lat0=lat0,
+                                      lon0=lon0 + offset * lon_step, **kwargs))
+    return directories
+
+
+def _main():
+    parser = argparse.ArgumentParser(description='генерация синтетических данных NPP VIIRS')
+    parser.add_argument('root', help='папка для данных')
+    parser.add_argument('--date', default='2021-07-01', help='дата в формате YYYY-MM-DD')
+    parser.add_argument('--passes', type=int, default=1, help='количество витков')
+    parser.add_argument('--scans', type=int, default=SCANS_PER_GRANULE, help='количество сканов в витке')
+    parser.add_argument('--columns', type=int, default=I_BAND_COLUMNS, help='количество точек в строке')
+    parser.add_argument('--lon-step', type=float, default=25., help='смещение соседних витков по долготе')
+    args = parser.parse_args()
+    for directory in write_day(args.root, datetime.strptime(args.date, '%Y-%m-%d'), args.passes, args.scans,
+                               args.columns, lon_step=args.lon_step):
+        print(directory)
+
+
+if __name__ == '__main__':
+    _main()
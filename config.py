@@ -27,6 +27,10 @@ NDVI_MERGE_PERIOD_IN_DAYS = 4
 # менять это значение лучше не стоит
 # NDVI_DYNAMICS_PERIOD = NDVI_MERGE_PERIOD_IN_DAYS * 2
 
+# дополнительные периоды динамики NDVI (в тех же единицах, что и NDVI_DYNAMICS_PERIOD), динамика для всех периодов
+# считается за одно чтение сегодняшнего композита, карты создаются только для NDVI_DYNAMICS_PERIOD
+# NDVI_DYNAMICS_EXTRA_PERIODS = [NDVI_MERGE_PERIOD_IN_DAYS * 4]
+
 # Если True будет генерировать проекцию с облачностью,
 # даже если она уже сгенерирована (по-умолчанию False)
 FORCE_CLOUD_MASK_PROCESSING = False
@@ -41,10 +45,122 @@ FORCE_NDVI_COMPOSITE_PROCESSING = True
 # Если True карты будут пересоздаваться, даже если уни уже были созданы
 FORCE_MAPS_REGENERATION = True
 
+# если True, для каждой карты читается только часть растра в границах xlim/ylim из PNG_CONFIG, а если пиксель
+# растра мельче пикселя изображения - с прореживанием (доли в легенде считаются по прочитанным пикселям)
+MAPS_WINDOWED_READ = False
+
 # Если установить значение в True (по-умолчанию False) маска облачности будет сохраняться в /tmp
 # в один и тот же файл, то есть каждый раз будет перезаписываться
 SINGLE_CLOUD_MASK_FILE = False
 
+# способ построения сетки при обработке level1:
+# 'scatter' - разброс точек по пикселям и заполнение пустот отдельно для каждого канала (по-умолчанию),
+# 'sparse' - разреженный оператор, который строится один раз для файла геолокации и применяется ко всем каналам
+# 'kdtree' - для каждого пикселя берется ближайшая точка снимка (KD-дерево, индекс кэшируется), без заполнения пустот
+GRIDDING = 'scatter'
+
+# если указано, геолокация и каналы читаются и обрабатываются блоками по столько строк (округляется до целого
+# числа сканов), потребление памяти не зависит от длины витка, работает только с GRIDDING = 'scatter'
+# STREAMING_BLOCK_ROWS = 512
+
+# если больше 1, каналы витка обрабатываются параллельно в стольких процессах (только GRIDDING = 'scatter'
+# без STREAMING_BLOCK_ROWS), геолокация и сетка каналов передаются между процессами через разделяемую
+# память (/dev/shm, см. gdal_viirs.sharedmem), без сериализации
+# GRIDDING_WORKERS = 4
+
+# если True, витки, которые не попадают ни в один регион из PNG_CONFIG (xlim/ylim + AOI_MARGIN метров),
+# пропускаются до обработки, а остальные обрезаются по общей границе регионов,
+# результат проверки сохраняется в БД (витки проверяются заново после изменения регионов или AOI_MARGIN)
+AOI_FILTER = False
+AOI_MARGIN = 20000
+
+# считать NDVI сразу после построения сетки, без записи и повторного чтения VIMGO файла,
+# при WRITE_VIMGO = False VIMGO файл не создается вовсе, а сетка строится только для каналов SVI01 и SVI02
+FUSED_NDVI = False
+WRITE_VIMGO = True
+
+# перепроецировать маску облачности из level2 сразу на сетку NDVI (читается только нужное окно исходного файла),
+# вместо отдельного файла PROJECTED_CLOUDMASK, который затем совмещается с NDVI,
+# SAVE_PROJECTED_CLOUD_MASK = True - все равно сохранять маску облачности на сетке NDVI в файл
+CLOUD_MASK_ON_NDVI_GRID = False
+SAVE_PROJECTED_CLOUD_MASK = False
+
+# сбор показателей этапов обработки (время, процессорное время, пиковый RSS, объем чтения/записи, количество
+# пикселей), показатели сохраняются в БД (таблица StageMetric) и выгружаются в OUTPUTS.metrics
+METRICS = False
+
+# если True, композит NDVI собирается по тайлам MERGE_TILE_SIZE x MERGE_TILE_SIZE пикселей в MERGE_WORKERS потоков
+# (None - по количеству процессоров): объединение целиком в памяти не хранится, результат тот же
+MERGE_TILED = False
+MERGE_TILE_SIZE = 1024
+MERGE_WORKERS = None
+
+# статистики композита NDVI, которые сохраняются в отдельных каналах (max всегда первый канал): count - количество
+# безоблачных наблюдений, median - медиана безоблачных значений, latest - последнее безоблачное значение;
+# все статистики считаются за одно чтение NDVI (по тайлам MERGE_TILE_SIZE в MERGE_WORKERS потоков),
+# пустой список - одноканальный композит (max), как раньше
+# COMPOSITE_STATISTICS = ['max', 'count', 'median', 'latest']
+
+# датакуб NDVI (HDF5, см. gdal_viirs.hl.datacube): ежедневные композиты, количество безоблачных наблюдений и облака
+# на фиксированной сетке в одном файле для быстрого чтения временных рядов; файл - DATACUBE_FILE
+# (по умолчанию OUTPUTS.processed_data/ndvi_datacube.h5), сетка задается при создании файла:
+# DATACUBE_BOUNDS (xmin, ymin, xmax, ymax) в проекции композитов, по умолчанию - объединение регионов PNG_CONFIG,
+# DATACUBE_RESOLUTION - по умолчанию разрешение композита
+DATACUBE = False
+
+# индексы, которые считаются по VIMGO файлу вместе, за один проход (см. gdal_viirs.process.process_band_math):
+# названия из process.BAND_INDICES (ndvi, evi2, ndwi, bt_i5) или BAND_EXPRESSIONS, файлы индексов
+# ({датасет}.{ИНДЕКС}.tiff) записываются рядом с NDVI; при FUSED_NDVI нужен WRITE_VIMGO = True
+# BAND_INDICES = ['evi2', 'ndwi', 'bt_i5']
+# дополнительные индексы: название -> выражение над каналами SVI01 - SVI05 (облачные пиксели получают -2)
+# или process.BandExpression, например {'savi': '1.5 * (SVI02 - SVI01) / (SVI02 + SVI01 + 0.5)'}
+BAND_EXPRESSIONS = {}
+
+# многолетняя норма NDVI по дням года (см. gdal_viirs.hl.climatology) на сетке датакуба (DATACUBE_BOUNDS,
+# DATACUBE_RESOLUTION): композиты за последние CLIMATOLOGY_LOOKBACK_DAYS дней добавляются в норму по одному разу,
+# для сегодняшнего композита создается отклонение от нормы (ndvi_anomaly) и карты (OUTPUTS.ndvi_anomaly,
+# по умолчанию - папка карт NDVI); норма дня объединяется по CLIMATOLOGY_WINDOW_DAYS соседним дням с каждой
+# стороны, пиксели, для которых в норме меньше CLIMATOLOGY_MIN_YEARS разных лет с наблюдениями, не получают
+# отклонения; файл нормы - CLIMATOLOGY_FILE (по умолчанию OUTPUTS.processed_data/ndvi_climatology.h5)
+CLIMATOLOGY = False
+CLIMATOLOGY_WINDOW_DAYS = 7
+CLIMATOLOGY_MIN_YEARS = 3
+CLIMATOLOGY_LOOKBACK_DAYS = 30
+
+# каталог растров (таблица Footprint с R-tree индексом): границы, разрешение, доля пикселей с данными и облаками
+# каждого продукта; в композит NDVI попадают только растры, которые пересекают регионы PNG_CONFIG
+CATALOG = False
+
+# отложенная обработка (например, NDVI, для которого еще нет маски облачности level2): повторяется только после
+# появления недостающего файла, остальные ошибки обработки - через PENDING_RETRY_MINUTES минут, интервал
+# удваивается с каждой попыткой (но не больше PENDING_MAX_RETRY_HOURS часов); после PENDING_MAX_ATTEMPTS попыток
+# или через PENDING_GIVE_UP_DAYS дней обработка больше не повторяется
+PENDING_RETRY_MINUTES = 30
+PENDING_MAX_RETRY_HOURS = 24
+PENDING_MAX_ATTEMPTS = 10
+PENDING_GIVE_UP_DAYS = 7
+
+# параметры SQLite (PRAGMA), переопределяют значения по умолчанию (см. gdal_viirs.persistence.models.SQLITE_PRAGMAS:
+# WAL, synchronous=normal, busy_timeout=30000 мс)
+# DB_PRAGMAS = {'busy_timeout': 60000}
+
+# профилирование этапов обработки (cProfile и tracemalloc): False - выключено, True - все этапы,
+# список типов этапов - только указанные (например, ['GIMGO', 'ndvi', 'merged_ndvi', 'map']),
+# отчеты (.pstats и .txt) сохраняются в LOG_PATH/profiles, хранятся последние PROFILE_KEEP отчетов каждого этапа,
+# в текстовый отчет попадают PROFILE_TOP функций и мест выделения памяти,
+# также включается флагом --profile скриптов processor.py, maps_processor.py и products_processor.py
+PROFILE = False
+PROFILE_KEEP = 20
+PROFILE_TOP = 30
+
+# для витков GIMGO/GITCO, в которых доля точек с зенитным углом солнца не больше MAX_SOLAR_ZENITH градусов
+# меньше MIN_DAYLIGHT_FRACTION (ночные витки и витки с низким солнцем), не создаются NDVI и другие продукты
+# на основе отражательной способности, т. к. для них они не имеют смысла: сетка строится только по тепловым
+# каналам, которые нужны индексам из BAND_INDICES (например bt_i5), если таких индексов нет - виток
+# пропускается без построения сетки, None - не проверять
+MAX_SOLAR_ZENITH = None
+MIN_DAYLIGHT_FRACTION = 0.01
+
 # число на которуе будет умножен масштаб при подсчете
 # не может быть меньше 1
 SCALE_MULTIPLIER = 1
@@ -56,11 +172,13 @@ IS_DEBUG = True
 
 MAPS_FILENAME_PATTERN = {
     'ndvi': '{yymmdd}2359_{ka}_{ndvi}_{name}.png',
-    'ndvi_dynamics': '{yymmdd}2359_{ka}_{ndvi_dynamics}_{name}.png'
+    'ndvi_dynamics': '{yymmdd}2359_{ka}_{ndvi_dynamics}_{name}.png',
+    'ndvi_anomaly': '{yymmdd}2359_{ka}_{ndvi_anomaly}_{name}.png'
 }
 MAPS_PARAMS = {
     'ka': 's',
     'ndvi_dynamics': 'd',
+    'ndvi_anomaly': 'a',
     'ndvi': 'c'
 }
 
@@ -82,7 +200,13 @@ GRADATIONS = {
 OUTPUTS = {
     'ndvi': '/mnt/100Tb/Suomi_NPP/Products_NEW/NDVI_maps',
     'ndvi_dynamics': '/mnt/100Tb/Suomi_NPP/Products_NEW/Dynamics_of_crops_ndvi_maps',
-    'processed_data': '/mnt/100Tb/Suomi_NPP/Products_NEW/Processed_files_series'
+    'processed_data': '/mnt/100Tb/Suomi_NPP/Products_NEW/Processed_files_series',
+    # кэш геолокации и операторов перепроецирования, если не указан - кэш не используется
+    # 'geoloc_cache': '/mnt/100Tb/Suomi_NPP/Products_NEW/geoloc_cache'
+    # карты отклонения NDVI от нормы (CLIMATOLOGY), по умолчанию - папка карт NDVI
+    # 'ndvi_anomaly': '/mnt/100Tb/Suomi_NPP/Products_NEW/NDVI_anomaly_maps',
+    # папка для показателей этапов обработки (metrics.jsonl и viirs_processor.prom), по умолчанию - LOG_PATH
+    # 'metrics': '/var/lib/node_exporter/textfile_collector'
 }
 
 INPUTS = {
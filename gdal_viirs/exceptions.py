@@ -62,6 +62,18 @@ class ProcessingException(ViirsException):
     pass
 
 
+class PrerequisiteMissing(ProcessingException):
+    """
+    Выбрасывается, если для обработки не хватает входного файла, который должен появиться позже
+    (например, маски облачности level2), обработка откладывается до его появления
+    """
+
+    def __init__(self, message, prerequisite: str):
+        super(PrerequisiteMissing, self).__init__(message)
+        # glob шаблон файла, появления которого нужно дождаться
+        self.prerequisite = prerequisite
+
+
 class CorruptedFile(ViirsException):
     def __init__(self, inner):
         self.inner = inner
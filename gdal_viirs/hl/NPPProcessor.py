@@ -1,24 +1,35 @@
 import os
 import sys
+import zlib
+from dataclasses import replace
 from datetime import datetime, timedelta, date
 from glob import glob
 from pathlib import Path
-from typing import List, Optional, Type
+from typing import Dict, List, Optional, Set, Type, TYPE_CHECKING
 
+import numpy as np
 import rasterio
 from loguru import logger
 
 import gdal_viirs.hl.utility as _hlutil
-from gdal_viirs import process as _process, misc
+from gdal_viirs import process as _process, misc, utility as _utility
 from gdal_viirs.config import CONFIG, ConfigWrapper
-from gdal_viirs.exceptions import ProcessingException, CorruptedFile
+from gdal_viirs.exceptions import ProcessingException, CorruptedFile, PrerequisiteMissing
+from gdal_viirs.hl import catalog as _catalog, climatology as _climatology, datacube as _datacube
 from gdal_viirs.hl.csv import read_cvs_gradation_file
-from gdal_viirs.maps import produce_image
-from gdal_viirs.maps.builder import MapBuilder
-from gdal_viirs.maps.ndvi_dynamics import NDVIDynamicsMapBuilder
-from gdal_viirs.merge import merge_files2tiff
+from gdal_viirs.hl.metrics import MetricsCollector
+from gdal_viirs.hl.profiling import StageProfiler
+from gdal_viirs.merge import merge_files2tiff, merge_files2tiff_tiled, composite_files2tiff
 from gdal_viirs.persistence.models import *
 
+# каналы отражательной способности, продукты на их основе не создаются для ночных витков (см. MAX_SOLAR_ZENITH)
+_REFLECTANCE_BANDS = ('SVI01', 'SVI02', 'SVI03')
+
+# gdal_viirs.maps (matplotlib, cartopy, shapely) импортируется только при создании карт,
+# чтобы не замедлять запуск обработки продуктов
+if TYPE_CHECKING:
+    from gdal_viirs.maps.builder import MapBuilder
+
 
 def _validate_png_config(png_config):
     if not isinstance(png_config, (list, set, tuple)):
@@ -107,6 +118,25 @@ class NPPProcessor:
         config_dir = Path(os.path.expandvars(os.path.expanduser(config['CONFIG_DIR'])))
         config_dir.mkdir(parents=True, exist_ok=True)
 
+        # показатели этапов обработки, см. METRICS в конфигурации
+        self._metrics = MetricsCollector() if config.get('METRICS', False) else None
+        # профилирование этапов, см. PROFILE в конфигурации
+        self._profiler = self._create_profiler()
+        # записи БД, полученные заранее для обрабатываемой папки (см. _prefetch_records): ключ -> запись или None
+        self._prefetched = {}
+
+    def _create_profiler(self) -> Optional[StageProfiler]:
+        profile = self._config.get('PROFILE', False)
+        if not profile:
+            return None
+        stages = None if profile is True else ([profile] if isinstance(profile, str) else list(profile))
+        output_dir = Path(self._config.get('LOG_PATH', 'viirs_logs')) / 'profiles'
+        logger.info(f'PROFILE: профилирование этапов {"(все)" if stages is None else ", ".join(stages)}, '
+                    f'отчеты сохраняются в {output_dir}')
+        return StageProfiler(output_dir, stages,
+                             keep=self._config.get('PROFILE_KEEP', 20),
+                             top=self._config.get('PROFILE_TOP', 30))
+
     def _init_logger(self):
         logger_dir = self._config.get('LOG_PATH', 'viirs_logs')
         logger_file = os.path.join(logger_dir, 'viirs.log')
@@ -152,6 +182,8 @@ class NPPProcessor:
         except Exception as exc:
             logger.exception(exc)
             exit(1)
+        finally:
+            self._on_finish()
 
     @logger.catch
     def produce_maps(self):
@@ -165,6 +197,8 @@ class NPPProcessor:
         except Exception as exc:
             logger.exception(exc)
             exit(1)
+        finally:
+            self._on_finish()
 
     @logger.catch
     def produce_products(self):
@@ -174,15 +208,24 @@ class NPPProcessor:
         except Exception as exc:
             logger.exception(exc)
             exit(1)
+        finally:
+            self._on_finish()
 
     def _produce_products(self):
         self._on_start()
-        for d in self._find_viirs_directories():
+        directories = [(d, _hlutil.find_npp_viirs_filesets(d)) for d in self._find_viirs_directories()]
+        # записи БД для всех папок получаем сразу, а не запросами на каждую папку
+        self._prefetch_records([fs for _, filesets in directories for fs in filesets])
+        for d, filesets in directories:
             try:
                 logger.debug(f'проверка папки {d} ...')
-                self._process_directory(d)
+                self._process_directory(d, filesets)
             except ProcessingException as e:
                 logger.exception(e)
+        self._prefetched = {}
+        pending_count = PendingWork.select().where(PendingWork.gave_up == False).count()  # noqa: E712
+        if pending_count > 0:
+            logger.info(f'отложенная обработка ожидает для {pending_count} датасетов')
 
         self._produce_daily_products()
 
@@ -197,32 +240,276 @@ class NPPProcessor:
         scale = round(scale)
         return scale
 
-    def _on_before_processing(self, name, src_type):
+    def _get_geoloc_cache_dir(self) -> Optional[Path]:
+        """
+        Возвращает папку кэша геолокации (OUTPUTS.geoloc_cache в конфигурации) или None, если кэш не используется
+        """
+        try:
+            return _mkpath(self._config.get_output('geoloc_cache'))
+        except KeyError:
+            return None
+
+    def _register_footprint(self, path, kind: str, starts_at, ends_at=None, cloud_value: float = None):
+        """
+        Добавляет созданный растр в каталог (Footprint), если каталог включен (CATALOG в конфигурации)
+        """
+        if self._config.get('CATALOG', False) and os.path.isfile(str(path)):
+            _catalog.register_raster(path, kind, starts_at, ends_at, cloud_value)
+
+    def _select_contributing_rasters(self, rasters: List[str], kind: str, dates: dict,
+                                     cloud_value: float = None) -> List[str]:
+        """
+        Оставляет только растры, которые по каталогу пересекают регионы из PNG_CONFIG (с учетом AOI_MARGIN).
+        Растры отбираются только по границам, а не по доле пикселей с данными: доли в каталоге приблизительные
+        (см. catalog.describe_raster), а полностью облачный растр тоже участвует в композите (облака).
+        Растры, которых нет в каталоге, добавляются в него, а если это не удалось - не исключаются.
+        Работает только при CATALOG = True.
+
+        :param rasters: пути к растрам
+        :param kind: тип продукта в каталоге
+        :param dates: путь -> дата растра (для добавления в каталог)
+        :param cloud_value: значение облачных пикселей
+        """
+        if not self._config.get('CATALOG', False) or len(rasters) == 0:
+            return rasters
+        registered = Footprint.get_many(rasters)
+        for path in rasters:
+            if path not in registered:
+                record = _catalog.register_raster(path, kind, dates[path], cloud_value=cloud_value)
+                if record is not None:
+                    registered[path] = record
+
+        regions = _hlutil.get_png_config_bounds(self.png_config or [], self._config.get('AOI_MARGIN', 20000))
+        query = Footprint.find(kind, bounds=_hlutil.union_bounds(regions)) \
+            .where(Footprint.output_file.in_(list(registered)))
+        contributing = {record.output_file for record in query}
+        selected = [path for path in rasters if path not in registered or path in contributing]
+        if len(selected) < len(rasters):
+            logger.info(f'CATALOG: {len(rasters) - len(selected)} из {len(rasters)} растров {kind} не пересекают '
+                        f'регионы PNG_CONFIG и пропущены')
+        return selected
+
+    def _get_aoi_regions(self):
+        return _hlutil.get_png_config_bounds(self.png_config or [], self._config.get('AOI_MARGIN', 20000))
+
+    @staticmethod
+    def _get_aoi_check_name(regions) -> str:
+        """
+        Название проверки AOI_FILTER в БД, включает хэш регионов (с учетом AOI_MARGIN), поэтому после изменения
+        PNG_CONFIG или AOI_MARGIN витки проверяются заново
+        """
+        key = repr(sorted(tuple(float(v) for v in region) for region in regions))
+        return f'aoi:{zlib.crc32(key.encode("utf-8")):08x}'
+
+    def _check_aoi(self, fs: _hlutil.NPPViirsFileset):
+        """
+        Проверяет, попадает ли виток хотя бы в один регион из PNG_CONFIG (по прореженной выборке широты и долготы),
+        результат проверки сохраняется в БД и пересчитывается только после изменения регионов или AOI_MARGIN.
+        Включается параметром AOI_FILTER в конфигурации.
+
+        :return: кортеж (попадает ли виток в область интереса, границы области интереса для обрезки или None)
+        """
+        if not self._config.get('AOI_FILTER', False):
+            return True, None
+
+        regions = self._get_aoi_regions()
+        aoi_bounds = _hlutil.union_bounds(regions)
+        if aoi_bounds is None:
+            return True, None
+
+        check = self._get_aoi_check_name(regions)
+        record = self._get_record((check, fs.geoloc_file.name),
+                                  lambda: FilesetCheck.get_result(fs.geoloc_file.name, check))
+        if record is None:
+            try:
+                x, y = _process.get_swath_sample(fs.geoloc_file, step=self._config.get('AOI_SAMPLE_STEP', 16))
+            except Exception as exc:
+                # если проверить не удалось - обрабатываем как обычно
+                logger.warning(f'не удалось проверить попадание {fs.geoloc_file.name} в область интереса: {exc}')
+                return True, aoi_bounds
+            inside = np.zeros(x.shape, np.bool_)
+            for region in regions:
+                inside |= _utility.points_in_bounds(x, y, region)
+            fraction = float(inside.mean()) if inside.shape[0] > 0 else 0.
+            logger.debug(f'{fs.geoloc_file.name}: {round(fraction * 100, 1)}% витка в области интереса')
+            record = FilesetCheck.set_result(fs.geoloc_file.name, check, bool(inside.any()), fraction)
+            self._prefetched[(check, fs.geoloc_file.name)] = record
+
+        return record.passed, aoi_bounds
+
+    def _check_illumination(self, fs: _hlutil.NPPViirsFileset) -> bool:
+        """
+        Проверяет освещенность витка по прореженной выборке зенитного угла солнца из файла геолокации.
+        Для неосвещенных витков сетка строится только по тепловым каналам, которые нужны настроенным индексам
+        (если таких нет - виток пропускается), NDVI и другие продукты на основе отражательной способности
+        не создаются (см. _process__gimgo).
+        Проверяются только наборы файлов, типы которых указаны в ILLUMINATION_CHECK_TYPES (по-умолчанию GIMGO и
+        GITCO, т. е. продукты на основе отражательной способности), поэтому, например, ночная обработка DNB
+        остается возможной. Результат проверки сохраняется в БД и не пересчитывается.
+        Включается параметром MAX_SOLAR_ZENITH в конфигурации.
+
+        :return: False, если доля точек с зенитным углом не больше MAX_SOLAR_ZENITH меньше MIN_DAYLIGHT_FRACTION
+        """
+        max_sza = self._config.get('MAX_SOLAR_ZENITH')
+        if max_sza is None:
+            return True
+        if fs.geoloc_file.file_type not in self._config.get('ILLUMINATION_CHECK_TYPES', ('GIMGO', 'GITCO')):
+            return True
+
+        record = self._get_record(('illumination', fs.geoloc_file.name),
+                                  lambda: FilesetCheck.get_result(fs.geoloc_file.name, 'illumination'))
+        if record is None:
+            try:
+                sza = _process.get_solar_zenith_sample(fs.geoloc_file, step=self._config.get('AOI_SAMPLE_STEP', 16))
+            except Exception as exc:
+                logger.warning(f'не удалось проверить освещенность {fs.geoloc_file.name}: {exc}')
+                return True
+            fraction = float(np.count_nonzero(sza <= max_sza) / sza.shape[0]) if sza.shape[0] > 0 else 0.
+            passed = sza.shape[0] > 0 and fraction >= self._config.get('MIN_DAYLIGHT_FRACTION', 0.01)
+            logger.debug(f'{fs.geoloc_file.name}: доля точек с зенитным углом солнца <= {max_sza}° - '
+                         f'{round(fraction * 100, 1)}%')
+            record = FilesetCheck.set_result(fs.geoloc_file.name, 'illumination', passed, fraction)
+            self._prefetched[('illumination', fs.geoloc_file.name)] = record
+
+        return record.passed
+
+    def _on_before_processing(self, name, src_type, inputs=None, **tags):
+        """
+        Вызывается перед этапом обработки.
+
+        :param name: выходной файл (или папка) этапа
+        :param src_type: тип этапа (VIMGO, clouds_file, ndvi, merged_ndvi, ...)
+        :param inputs: входные файлы этапа
+        :param tags: метки этапа для показателей: swath_id, region, date
+        """
         logger.debug(f'обработка {src_type} @ {name}')
+        if self._metrics is not None:
+            self._metrics.start(name, src_type, inputs, **tags)
+        if self._profiler is not None:
+            self._profiler.start(name, src_type)
 
     def _on_after_processing(self, name, src_type):
         logger.debug(f'обработка завершена {src_type} @ {name}')
+        if self._profiler is not None:
+            self._profiler.finish(name, src_type)
+        if self._metrics is not None:
+            record = self._metrics.finish(name, src_type)
+            if record is not None:
+                logger.debug(f'{src_type}: {round(record["wall_seconds"], 3)}s, '
+                             f'cpu {round(record["cpu_seconds"], 3)}s, RSS {record["peak_rss_mb"]} MB')
 
     def _on_exception(self, exc):
         logger.exception(exc)
+        if self._metrics is not None:
+            self._metrics.mark_failed()
+        if self._profiler is not None:
+            # этап, прерванный исключением, не дойдет до _on_after_processing, завершаем его профиль сейчас,
+            # иначе cProfile и tracemalloc остаются включенными и следующие этапы не профилируются
+            self._profiler.close()
+
+    def _on_finish(self):
+        self._flush_metrics()
+        if self._profiler is not None:
+            # этап, который не был завершен из-за исключения
+            self._profiler.close()
+
+    def _flush_metrics(self):
+        """
+        Сохраняет показатели этапов в БД (StageMetric) и выгружает их в папку OUTPUTS.metrics (по умолчанию -
+        LOG_PATH): metrics.jsonl (дописывается) и viirs_processor.prom (показатели последнего запуска
+        для textfile collector node_exporter).
+        """
+        if self._metrics is None or len(self._metrics.records) == 0:
+            return
+        try:
+            try:
+                metrics_dir = _mkpath(self._config.get_output('metrics'))
+            except KeyError:
+                metrics_dir = _mkpath(Path(self._config.get('LOG_PATH', 'viirs_logs')))
+            self._metrics.write_jsonl(metrics_dir / 'metrics.jsonl')
+            self._metrics.write_prometheus(metrics_dir / 'viirs_processor.prom')
+            StageMetric.insert_records(self._metrics.records)
+        except Exception as exc:
+            logger.warning(f'не удалось сохранить показатели этапов: {exc}')
+        self._metrics.clear()
 
     def _on_start(self, start_tag=None):
         if hasattr(self, '_on_start_fired'):
             return
         setattr(self, '_on_start_fired', True)
         now = str(datetime.now())
-        MetaData.set_meta('last_start', str(datetime.now()))
-        MetaData.set_meta('last_start_pyversion', sys.version)
-        MetaData.set_meta('packages_versions', misc.gather_packages())
-        MetaData.set_meta('proj_version', misc.get_proj_version())
         start_tag = start_tag or 'None'
-        MetaData.set_meta('last_start_type', start_tag)
-        MetaData.set_meta(f'last_start__{start_tag}', now)
+        versions = {
+            'last_start_pyversion': sys.version,
+            'packages_versions': misc.gather_packages(),
+            'proj_version': misc.get_proj_version(),
+        }
+        # версии перезаписываются, только если изменились
+        stored_versions = MetaData.get_meta_many(versions.keys())
+        values = {k: v for k, v in versions.items() if stored_versions.get(k) != v}
+        values.update({
+            'last_start': str(datetime.now()),
+            'last_start_type': start_tag,
+            f'last_start__{start_tag}': now,
+        })
+        MetaData.set_meta_many(values)
 
     # endregion
 
-    def _process_directory(self, input_directory):
-        filesets = _hlutil.find_npp_viirs_filesets(input_directory)
+    def _get_l1_output_file(self, fs: _hlutil.NPPViirsFileset) -> Path:
+        typ = fs.geoloc_file.file_type_out.upper()
+        return self._processed_output / fs.geoloc_file.date.strftime('%Y%m%d') / fs.swath_id \
+            / f'{fs.root_dir.parts[-1]}.{typ}.tiff'
+
+    def _get_ndvi_file(self, based_on: ProcessedViirsL1) -> Path:
+        return self._processed_output / based_on.dataset_date.strftime('%Y%m%d') / based_on.swath_id \
+            / f'{based_on.directory_name}.NDVI.tiff'
+
+    def _prefetch_records(self, filesets: List[_hlutil.NPPViirsFileset]):
+        """
+        Получает записи БД для наборов файлов несколькими запросами, вместо запросов на каждый набор:
+        обработанные файлы, отложенная обработка, NDVI файлы и результаты проверок AOI_FILTER и MAX_SOLAR_ZENITH
+        """
+        self._prefetched = {}
+        l1_output_files = [str(self._get_l1_output_file(fs)) for fs in filesets]
+        processed = ProcessedViirsL1.get_many(l1_output_files)
+        for path in l1_output_files:
+            self._prefetched[('l1', path)] = processed.get(path)
+        pending = PendingWork.get_many(record.id for record in processed.values())
+        for record in processed.values():
+            for stage in self._PENDING_STAGES:
+                self._prefetched[('pending', record.id, stage)] = pending.get((record.id, stage))
+        ndvi_files = [str(self._get_ndvi_file(record)) for record in processed.values()]
+        ndvi_records = NDVITiff.get_many(ndvi_files)
+        for path in ndvi_files:
+            self._prefetched[('ndvi', path)] = ndvi_records.get(path)
+        geoloc_filenames = [fs.geoloc_file.name for fs in filesets]
+        aoi_check = self._get_aoi_check_name(self._get_aoi_regions())
+        for check, enabled in ((aoi_check, self._config.get('AOI_FILTER', False)),
+                               ('illumination', self._config.get('MAX_SOLAR_ZENITH') is not None)):
+            if not enabled:
+                continue
+            results = FilesetCheck.get_results(geoloc_filenames, check)
+            for name in geoloc_filenames:
+                self._prefetched[(check, name)] = results.get(name)
+
+    def _get_record(self, key: tuple, query):
+        """
+        Возвращает запись, полученную в _prefetch_records, или выполняет запрос query, если записи нет в кэше
+        """
+        if key in self._prefetched:
+            return self._prefetched[key]
+        return query()
+
+    def _process_directory(self, input_directory, filesets: List[_hlutil.NPPViirsFileset] = None):
+        """
+        :param input_directory: папка с данными
+        :param filesets: наборы файлов папки, записи БД для которых уже получены через _prefetch_records,
+            если не указаны - наборы файлов ищутся в папке
+        """
+        if filesets is None:
+            filesets = _hlutil.find_npp_viirs_filesets(input_directory)
+            self._prefetch_records(filesets)
         if len(filesets) == 0:
             logger.warning(f'не найдено ни одного датасета в папке {input_directory}')
         logger.debug(f'найдено {len(filesets)} в папке {input_directory}')
@@ -231,14 +518,33 @@ class NPPProcessor:
             if 'SKIP_FILES_BEFORE' in self._config and fs.geoloc_file.date < self._config['SKIP_FILES_BEFORE']:
                 logger.debug(f'SKIP_FILES_BEFORE: Пропускаем {fs.geoloc_file.name}')
                 continue
+            in_aoi, aoi_bounds = self._check_aoi(fs)
+            if not in_aoi:
+                logger.debug(f'AOI_FILTER: виток не попадает в регионы из PNG_CONFIG, пропускаем {fs.geoloc_file.name}')
+                continue
+            if not self._check_illumination(fs):
+                # ночной виток или низкое солнце: сетка строится только по тепловым каналам, которые нужны
+                # индексам без каналов отражательной способности (см. _process__gimgo)
+                band_types = self._get_thermal_band_types(fs)
+                if not band_types:
+                    logger.debug(f'MAX_SOLAR_ZENITH: ночной виток или низкое солнце, продуктов по тепловым каналам '
+                                 f'нет, пропускаем {fs.geoloc_file.name}')
+                    continue
+                fs = replace(fs, band_files=[file for file in fs.band_files if file.file_type in band_types])
             # обработка данных с level1
             typ = fs.geoloc_file.file_type_out.upper()
-            l1_output_file = _mkpath(self._processed_output / fs.geoloc_file.date.strftime('%Y%m%d') / fs.swath_id) \
-                             / f'{fs.root_dir.parts[-1]}.{typ}.tiff'
-            if not l1_output_file.is_file():
-                self._on_before_processing(str(l1_output_file), typ)
+            l1_output_file = self._get_l1_output_file(fs)
+            _mkpath(l1_output_file.parent)
+            if not l1_output_file.is_file() and not self._is_fused_ndvi(fs):
+                self._on_before_processing(str(l1_output_file), typ, [fs.geoloc_file.path],
+                                           swath_id=fs.swath_id, date=fs.geoloc_file.date)
                 try:
-                    _process.process_fileset(fs, str(l1_output_file), self._get_scale(fs.geoloc_file.band))
+                    _process.process_fileset(fs, str(l1_output_file), self._get_scale(fs.geoloc_file.band),
+                                             gridding=self._config.get('GRIDDING', _process.GRIDDING_SCATTER),
+                                             cache_dir=self._get_geoloc_cache_dir(),
+                                             block_rows=self._config.get('STREAMING_BLOCK_ROWS'),
+                                             bounds=aoi_bounds,
+                                             workers=self._config.get('GRIDDING_WORKERS'))
                 except CorruptedFile as exc:
                     logger.error(f'Датасет {fs.geoloc_file} имеет поврежденные файлы: {exc.inner}')
                     continue
@@ -246,8 +552,11 @@ class NPPProcessor:
                     self._on_exception(exc)
 
                 self._on_after_processing(str(l1_output_file), typ)
+                self._register_footprint(l1_output_file, typ, fs.geoloc_file.date)
 
-            processed: ProcessedViirsL1 = ProcessedViirsL1.get_or_none(ProcessedViirsL1.output_file == l1_output_file)
+            processed: ProcessedViirsL1 = self._get_record(
+                ('l1', str(l1_output_file)),
+                lambda: ProcessedViirsL1.get_or_none(ProcessedViirsL1.output_file == l1_output_file))
             if processed is None:
                 # сохранить данные в БД
                 processed = ProcessedViirsL1(l1_output_file, fs.geoloc_file.date,
@@ -255,6 +564,7 @@ class NPPProcessor:
                                              type=fs.geoloc_file.file_type,
                                              input_directory=input_directory)
                 processed.save(True)
+                self._prefetched[('l1', str(l1_output_file))] = processed
             elif processed.type != typ:
                 # тип файла в БД не соответствует тому, что есть на самом деле
                 # будем считать, что тип в БД неверен
@@ -263,93 +573,214 @@ class NPPProcessor:
                 processed.type = typ
                 processed.save()
 
-            handler_name = f'_process__{fs.geoloc_file.file_type.lower()}'
+            stage = fs.geoloc_file.file_type.lower()
+            handler_name = f'_process__{stage}'
             if hasattr(self, handler_name):
-                logger.debug(f'вызов обработчика {handler_name} ...')
                 fn = getattr(self, handler_name)
                 if hasattr(fn, '__call__'):
+                    pending: Optional[PendingWork] = self._get_record(
+                        ('pending', processed.id, stage),
+                        lambda: PendingWork.get_or_none((PendingWork.processed == processed) &
+                                                        (PendingWork.stage == stage)))
+                    if pending is not None and not self._is_pending_ready(pending):
+                        continue
+                    logger.debug(f'вызов обработчика {handler_name} ...')
                     try:
-                        fn(processed)
+                        fn(processed, fileset=fs)
                     except ProcessingException as exc:
                         logger.error(exc.message)
+                        self._defer(processed, stage, exc, pending)
                     except Exception as exc:
                         self._on_exception(exc)
                         raise
+                    else:
+                        if pending is not None:
+                            logger.info(f'отложенная обработка {stage} @ {processed.output_file} выполнена '
+                                        f'(попытка {pending.attempts + 1})')
+                            pending.delete_instance()
                 else:
                     raise TypeError(f'обработчик {handler_name} найден, но не является функцией')
 
-    def _process__gimgo(self, processed: ProcessedViirsL1):
+    # обработчики, выполнение которых может быть отложено (см. PendingWork)
+    _PENDING_STAGES = ('gimgo',)
+
+    def _is_pending_ready(self, pending: PendingWork) -> bool:
+        """
+        Проверяет, нужно ли повторить отложенную обработку: если указан prerequisite - только когда файл появился,
+        иначе - после retry_after. Если обработка не выполняется дольше PENDING_GIVE_UP_DAYS дней или попыток
+        больше PENDING_MAX_ATTEMPTS, она больше не повторяется.
+        """
+        if pending.gave_up:
+            return False
+        now = datetime.now()
+        give_up_days = self._config.get('PENDING_GIVE_UP_DAYS', 7)
+        if pending.attempts >= self._config.get('PENDING_MAX_ATTEMPTS', 10) or \
+                (give_up_days is not None and now - pending.created_at > timedelta(days=give_up_days)):
+            logger.warning(f'обработка {pending.stage} @ {pending.processed.output_file} не выполнена за '
+                           f'{pending.attempts} попыток и больше не будет повторяться: {pending.reason}')
+            pending.gave_up = True
+            pending.save()
+            return False
+        if pending.prerequisite is not None:
+            return len(glob(pending.prerequisite)) > 0
+        return now >= pending.retry_after
+
+    def _defer(self, processed: ProcessedViirsL1, stage: str, exc: ProcessingException,
+               pending: Optional[PendingWork] = None):
+        """
+        Откладывает обработку: сохраняет причину, файл, появления которого нужно дождаться, и время следующей
+        попытки (интервал удваивается с каждой попыткой, начиная с PENDING_RETRY_MINUTES, но не больше
+        PENDING_MAX_RETRY_HOURS часов)
+        """
+        if pending is None:
+            pending = PendingWork(processed=processed, stage=stage)
+        pending.attempts += 1
+        pending.reason = exc.message
+        pending.prerequisite = exc.prerequisite if isinstance(exc, PrerequisiteMissing) else None
+        pending.last_attempt_at = datetime.now()
+        delay = timedelta(minutes=self._config.get('PENDING_RETRY_MINUTES', 30)) * 2 ** (pending.attempts - 1)
+        pending.retry_after = pending.last_attempt_at + min(
+            delay, timedelta(hours=self._config.get('PENDING_MAX_RETRY_HOURS', 24)))
+        pending.save()
+        self._prefetched[('pending', processed.id, stage)] = pending
+
+    def _process__gimgo(self, processed: ProcessedViirsL1, fileset: _hlutil.NPPViirsFileset = None):
+        # для ночных витков и витков с низким солнцем (MAX_SOLAR_ZENITH) продукты на основе отражательной
+        # способности не создаются, тепловые каналы и индексы на их основе обрабатываются как обычно
+        if fileset is not None and not self._check_illumination(fileset):
+            logger.debug(f'MAX_SOLAR_ZENITH: ночной виток или низкое солнце, NDVI не считается для '
+                         f'{fileset.geoloc_file.name}')
+            self.produce_band_indices(processed, reflectance=False)
+            return
         # обработка NDVI
-        self.produce_ndvi_file(processed)
+        self.produce_ndvi_file(processed, fileset=fileset if self._is_fused_ndvi(fileset) else None)
+        self.produce_band_indices(processed)
+
+    def _get_thermal_band_types(self, fs: _hlutil.NPPViirsFileset) -> Set[str]:
+        """
+        Каналы набора файлов, которые используют индексы без каналов отражательной способности (для ночных
+        витков, см. MAX_SOLAR_ZENITH). Индексы считаются только по VIMGO, для остальных типов - пустое множество.
+        """
+        if fs.geoloc_file.file_type != 'GIMGO':
+            return set()
+        available = {file.file_type for file in fs.band_files}
+        return {
+            band for expression in self._get_band_expressions(reflectance=False).values()
+            for band in _process.expression_bands(expression.expression)
+        } & available
+
+    def _is_fused_ndvi(self, fs: Optional[_hlutil.NPPViirsFileset]) -> bool:
+        """
+        Проверяет, нужно ли считать NDVI для набора файлов напрямую (см. FUSED_NDVI в конфигурации),
+        в этом случае VIMGO файл не создается отдельным этапом. Для ночных витков NDVI не считается,
+        поэтому VIMGO файл для них всегда создается отдельно.
+        """
+        return fs is not None and fs.geoloc_file.file_type == 'GIMGO' and self._config.get('FUSED_NDVI', False) \
+            and self._check_illumination(fs)
 
     def _produce_daily_products(self):
         logger.info('обработка ежедневных продуктов...')
         try:
             self.produce_merged_ndvi_file()
-            self.get_or_make_ndvi_dynamics()
+            self.make_ndvi_dynamics()
+            self.make_ndvi_anomaly()
         except Exception as e:
             self._on_exception(e)
 
     def _produce_maps(self):
         self.make_ndvi_maps()
         self.make_ndvi_dynamics_maps()
+        if self._config.get('CLIMATOLOGY', False):
+            self.make_ndvi_anomaly_maps()
 
     # region ndvi / ndvi dynamics
 
-    def reproject_cloud_mask(self, processed: ProcessedViirsL1) -> Optional[Path]:
+    def _find_level2_cloud_mask(self, processed: ProcessedViirsL1) -> str:
         """
-        Обрабатывает маску облачности для данного обработанного датасета.
-        :param processed: запись обработанного датасета
-        :return: путь к файл или None, если не удалось найти исходник для маски облачности
+        Ищет исходную маску облачности (level2) для обработанного датасета.
+        :raise PrerequisiteMissing: если маски облачности еще нет, обработка будет повторена после ее появления
         """
         level2_folder = os.path.join(processed.input_directory, 'viirs/level2')
         l2_input_file = glob(os.path.join(level2_folder, '*CLOUDMASK.tif'))
-
-        is_single_file_mode = self._config.get('SINGLE_CLOUD_MASK_FILE', False)
-
+        if len(l2_input_file) == 0:
+            # если маска облачности еще не была посчитана для level2
+            # мы не будем ничего делать и обработаем все потом
+            logger.info(f'папка {processed.input_directory} не содержит маски облачности '
+                        f'в level2, дальнейшая обработка отложена до ее появления')
+            raise PrerequisiteMissing('не удалось обработать маску облачности: исходный файл не найден',
+                                      os.path.join(level2_folder, '*CLOUDMASK.tif'))
+        return l2_input_file[0]
+
+    def _get_projected_cloud_mask_path(self, processed: ProcessedViirsL1) -> Path:
         # если SINGLE_CLOUD_MASK_FILE = True сохраняем маску облачности в /tmp
         # если False - сохраняем в папку с данными по умолчанию
-        if is_single_file_mode:
+        if self._config.get('SINGLE_CLOUD_MASK_FILE', False):
             clouds_file = _mkpath(Path('/tmp/viirs_processor'))
-            clouds_file /= 'cloud_mask.tiff'
+            return clouds_file / 'cloud_mask.tiff'
+
+        try:
+            clouds_root = self._config.get_output('clouds')
+        except KeyError:
+            clouds_root = self._processed_output
+
+        if processed.input_directory:
+            swath_id = _hlutil.extract_swath_id(os.path.basename(processed.input_directory))
         else:
-            try:
-                clouds_root = self._config.get_output('clouds')
-            except KeyError:
-                clouds_root = self._processed_output
+            swath_id = None
 
-            if processed.input_directory:
-                swath_id = _hlutil.extract_swath_id(os.path.basename(processed.input_directory))
-            else:
-                swath_id = None
+        clouds_root = _mkpath(clouds_root) / processed.dataset_date.strftime('%Y%m%d')
+        if swath_id:
+            clouds_root /= swath_id
+        return clouds_root / f'{processed.directory_name}.PROJECTED_CLOUDMASK.tiff'
 
-            clouds_root = _mkpath(clouds_root) / processed.dataset_date.strftime('%Y%m%d')
-            if swath_id:
-                clouds_root /= swath_id
-            clouds_file = clouds_root / f'{processed.directory_name}.PROJECTED_CLOUDMASK.tiff'
+    def reproject_cloud_mask(self, processed: ProcessedViirsL1) -> Optional[Path]:
+        """
+        Обрабатывает маску облачности для данного обработанного датасета.
+        :param processed: запись обработанного датасета
+        :return: путь к файл или None, если не удалось найти исходник для маски облачности
+        """
+        is_single_file_mode = self._config.get('SINGLE_CLOUD_MASK_FILE', False)
+        clouds_file = self._get_projected_cloud_mask_path(processed)
 
         if is_single_file_mode or not clouds_file.is_file() or self._config.get('FORCE_CLOUD_MASK_PROCESSING', False):
-            if len(l2_input_file) == 0:
-                # если маска облачности еще не была посчитана для level2
-                # мы не будем ничего делать и обработаем все потом
-                logger.info(f'папка {processed.input_directory} не содержит маски облачности '
-                            f'в level2, дальнейшая обработка отложена до следующего запуска')
-                raise ProcessingException('не удалось обработать маску облачности: исходный файл не найден')
+            l2_input_file = self._find_level2_cloud_mask(processed)
 
             # перепроецируем маску облачности
             # все ошибки передаются в обработчик вызывающей функции
-            self._on_before_processing(clouds_file, 'clouds_file')
-            _process.process_cloud_mask(l2_input_file[0], clouds_file, scale=self._get_scale('I'))
+            self._on_before_processing(clouds_file, 'clouds_file', [l2_input_file],
+                                       swath_id=processed.swath_id, date=processed.dataset_date)
+            _process.process_cloud_mask(l2_input_file, clouds_file, scale=self._get_scale('I'))
             self._on_after_processing(clouds_file, 'clouds_file')
         else:
             logger.debug('пропускаем cloud_file @ ' + str(clouds_file))
 
         return clouds_file
 
-    def produce_ndvi_file(self, based_on: ProcessedViirsL1) -> NDVITiff:
+    def _get_ndvi_cloud_mask(self, based_on: ProcessedViirsL1):
+        """
+        Маска облачности для NDVI и индексов датасета
+
+        :return: маска облачности, файл для маски на сетке NDVI (или None), нужно ли перепроецировать маску
+            на сетку NDVI (см. process.calc_ndvi)
+        """
+        # при CLOUD_MASK_ON_NDVI_GRID = True исходная маска облачности перепроецируется сразу на сетку NDVI
+        # при расчете NDVI, промежуточный файл записывается только при SAVE_PROJECTED_CLOUD_MASK = True
+        warp_cloud_mask = self._config.get('CLOUD_MASK_ON_NDVI_GRID', False)
+        if warp_cloud_mask:
+            clouds_file = self._find_level2_cloud_mask(based_on)
+            projected_clouds_file = str(self._get_projected_cloud_mask_path(based_on)) \
+                if self._config.get('SAVE_PROJECTED_CLOUD_MASK', False) else None
+        else:
+            clouds_file = self.reproject_cloud_mask(based_on)
+            projected_clouds_file = None
+        return clouds_file, projected_clouds_file, warp_cloud_mask
+
+    def produce_ndvi_file(self, based_on: ProcessedViirsL1, fileset: _hlutil.NPPViirsFileset = None) -> NDVITiff:
         """
         Создать NDVI файлы для указанного датасета
         :param based_on: запись обработанного датасета для которого следует создать NDVI файлы
+        :param fileset: если указан, NDVI считается напрямую из набора файлов без чтения VIMGO файла
+            (VIMGO файл записывается, только если WRITE_VIMGO = True)
         :return: экземпляр NDVITiff, сохранённый в БД
         """
         if not based_on.is_of_type('GIMGO') and not based_on.is_of_type('VIMGO'):
@@ -359,31 +790,54 @@ class NPPProcessor:
             based_on.save()
             logger.debug('Замена типа GIMGO на VIMGO')
 
-        ndvi_file = _mkpath(
-            self._processed_output / based_on.dataset_date.strftime('%Y%m%d') / based_on.swath_id
-        ) / f'{based_on.directory_name}.NDVI.tiff'
+        ndvi_file = self._get_ndvi_file(based_on)
+        _mkpath(ndvi_file.parent)
 
-        ndvi_record: NDVITiff = NDVITiff.get_or_none(NDVITiff.output_file == str(ndvi_file))
+        ndvi_record: NDVITiff = self._get_record(('ndvi', str(ndvi_file)),
+                                                 lambda: NDVITiff.get_or_none(NDVITiff.output_file == str(ndvi_file)))
 
         # создаем NDVI файл, но только если его еще нет, не перезаписываем
         if not ndvi_file.is_file():
-            clouds_file = self.reproject_cloud_mask(based_on)
-
-            # проверяем, что исходный файл (VIMGO/GIMGO) существует, если нет - ошибка
-            if os.path.isfile(based_on.output_file):
-                self._on_before_processing(ndvi_file, 'ndvi')
-                _process.process_ndvi(based_on.output_file, ndvi_file, str(clouds_file))
+            clouds_file, projected_clouds_file, warp_cloud_mask = self._get_ndvi_cloud_mask(based_on)
+
+            # проверяем, что исходный файл (VIMGO/GIMGO) существует или есть набор файлов, если нет - ошибка
+            if fileset is not None or os.path.isfile(based_on.output_file):
+                self._on_before_processing(ndvi_file, 'ndvi',
+                                           [based_on.output_file if fileset is None else fileset.geoloc_file.path],
+                                           swath_id=based_on.swath_id, date=based_on.dataset_date)
+                if fileset is not None:
+                    write_vimgo = self._config.get('WRITE_VIMGO', True) and not os.path.isfile(based_on.output_file)
+                    _process.process_fileset_ndvi(fileset, str(ndvi_file), self._get_scale(fileset.geoloc_file.band),
+                                                  cloud_mask_file=str(clouds_file),
+                                                  vimgo_file=based_on.output_file if write_vimgo else None,
+                                                  gridding=self._config.get('GRIDDING', _process.GRIDDING_SCATTER),
+                                                  cache_dir=self._get_geoloc_cache_dir(),
+                                                  block_rows=self._config.get('STREAMING_BLOCK_ROWS'),
+                                                  bounds=self._check_aoi(fileset)[1],
+                                                  warp_cloud_mask=warp_cloud_mask,
+                                                  projected_cloud_mask_file=projected_clouds_file,
+                                                  workers=self._config.get('GRIDDING_WORKERS'))
+                else:
+                    _process.process_ndvi(based_on.output_file, ndvi_file, str(clouds_file),
+                                          warp_cloud_mask=warp_cloud_mask,
+                                          projected_cloud_mask_file=projected_clouds_file)
 
                 # сохраняем запись с БД
-                tiff_record = NDVITiff.get_or_none(NDVITiff.output_file == ndvi_file)
+                tiff_record = ndvi_record
                 if tiff_record is None:
                     tiff_record = NDVITiff(ndvi_file)
                     tiff_record.based_on = based_on
                     tiff_record.save(True)
-                elif tiff_record.based_on != based_on:
+                    self._prefetched[('ndvi', str(ndvi_file))] = tiff_record
+                elif tiff_record.based_on_id != based_on.id:
                     tiff_record.based_on = based_on
                     tiff_record.save()
                 self._on_after_processing(ndvi_file, 'ndvi')
+                self._register_footprint(ndvi_file, 'ndvi', based_on.dataset_date,
+                                         cloud_value=_catalog.NDVI_CLOUD_VALUE)
+                if fileset is not None:
+                    # VIMGO файл, записанный вместе с NDVI
+                    self._register_footprint(based_on.output_file, based_on.type, based_on.dataset_date)
                 return ndvi_file
             else:
                 logger.warning(f'не удалось найти файл {based_on.output_file}, не могу обработать NDVI')
@@ -395,11 +849,81 @@ class NPPProcessor:
         if ndvi_record is None:
             ndvi_record = NDVITiff(ndvi_file, based_on=based_on)
             ndvi_record.save(True)
-        elif ndvi_record.output_file != ndvi_file:
-            ndvi_record.output_file = ndvi_file
+            self._prefetched[('ndvi', str(ndvi_file))] = ndvi_record
+        elif ndvi_record.output_file != str(ndvi_file):
+            ndvi_record.output_file = str(ndvi_file)
             ndvi_record.save()
         return ndvi_record
 
+    def _get_band_expressions(self, reflectance: bool = True) -> Dict[str, _process.BandExpression]:
+        """
+        Индексы из BAND_INDICES: названия из process.BAND_INDICES или BAND_EXPRESSIONS (название -> выражение
+        или process.BandExpression)
+
+        :param reflectance: False - только индексы, которые не используют каналы отражательной способности
+        """
+        custom = {
+            name: expression if isinstance(expression, _process.BandExpression) else _process.BandExpression(expression)
+            for name, expression in (self._config.get('BAND_EXPRESSIONS') or {}).items()
+        }
+        expressions = {**_process.BAND_INDICES, **custom}
+        names = list(dict.fromkeys(self._config.get('BAND_INDICES') or []))
+        unknown = [name for name in names if name not in expressions]
+        if unknown:
+            logger.error(f'BAND_INDICES: неизвестные индексы {", ".join(unknown)} будут пропущены')
+        if not reflectance:
+            names = [
+                name for name in names if name in expressions and
+                not any(band in _REFLECTANCE_BANDS for band in _process.expression_bands(expressions[name].expression))
+            ]
+        return {name: expressions[name] for name in names if name in expressions}
+
+    def _get_band_index_file(self, based_on: ProcessedViirsL1, name: str) -> Path:
+        return self._get_ndvi_file(based_on).with_name(f'{based_on.directory_name}.{name.upper()}.tiff')
+
+    def produce_band_indices(self, based_on: ProcessedViirsL1, reflectance: bool = True) -> Dict[str, BandIndexTiff]:
+        """
+        Считает индексы из BAND_INDICES по VIMGO файлу датасета за один проход (см. process.process_band_math).
+        Уже созданные файлы индексов не пересчитываются.
+
+        :param reflectance: False - считать только индексы, которые не используют каналы отражательной
+            способности (для ночных витков, см. MAX_SOLAR_ZENITH)
+        :return: название индекса -> запись BandIndexTiff
+        """
+        expressions = self._get_band_expressions(reflectance)
+        if not expressions:
+            return {}
+        outputs = {name: self._get_band_index_file(based_on, name) for name in expressions}
+        pending = {name: str(path) for name, path in outputs.items() if not path.is_file()}
+        if pending:
+            if not os.path.isfile(based_on.output_file):
+                logger.warning(f'не удалось найти файл {based_on.output_file}, индексы {", ".join(pending)} '
+                               f'не будут посчитаны (при FUSED_NDVI нужен WRITE_VIMGO = True)')
+                return {}
+            needs_clouds = any(expressions[name].cloud_value is not None for name in pending)
+            clouds_file, _, warp_cloud_mask = self._get_ndvi_cloud_mask(based_on) if needs_clouds \
+                else (None, None, False)
+            first_output = next(iter(pending.values()))
+            self._on_before_processing(first_output, 'band_indices', [based_on.output_file],
+                                       swath_id=based_on.swath_id, date=based_on.dataset_date)
+            _process.process_band_math(based_on.output_file, pending, expressions,
+                                       cloud_mask_file=str(clouds_file) if clouds_file else None,
+                                       warp_cloud_mask=warp_cloud_mask,
+                                       block_rows=self._config.get('STREAMING_BLOCK_ROWS') or 512)
+            self._on_after_processing(first_output, 'band_indices')
+            for name, path in pending.items():
+                self._register_footprint(path, name, based_on.dataset_date, cloud_value=expressions[name].cloud_value)
+
+        existing = BandIndexTiff.get_many(outputs.values())
+        records = {}
+        for name, path in outputs.items():
+            record: BandIndexTiff = existing.get(str(path))
+            if record is None:
+                record = BandIndexTiff(path, based_on=based_on, name=name)
+                record.save(True)
+            records[name] = record
+        return records
+
     def produce_merged_ndvi_file(self, now: date = None, merge_period: int = None) -> Optional[NDVIComposite]:
         """
         Обрабатывает композит для сегодняшнего дня
@@ -414,10 +938,12 @@ class NPPProcessor:
 
         merged_ndvi_filename = 'merged_ndvi_' + now.strftime('%Y%m%d') + '_' + past_day.strftime('%Y%m%d') + '.tiff'
         output_file = _mkpath(self._processed_output / self.now.strftime('%Y%m%d') / 'daily') / merged_ndvi_filename
-        ndvi_records = NDVITiff.select() \
+        ndvi_records = NDVITiff.select(NDVITiff, ProcessedViirsL1) \
             .join(ProcessedViirsL1) \
             .where((ProcessedViirsL1.dataset_date <= now) & (ProcessedViirsL1.dataset_date >= past_day))
         ndvi_records: List[NDVITiff] = list(ndvi_records)
+        # каналы композита, None - композит не пересоздавался
+        statistics = None
 
         if not output_file.is_file() or self._config.get('FORCE_NDVI_COMPOSITE_PROCESSING', True):
             # если не одного NDVI tiff'а не найдено, выбросить исключение
@@ -436,9 +962,28 @@ class NPPProcessor:
                 if not os.path.isfile(raster.output_file):
                     logger.error(f'файл {raster} не найден, обнаружено несоотсветсвие БД')
 
-            self._on_before_processing(str(output_file), 'merged_ndvi')
-            merge_files2tiff(ndvi_rasters, str(output_file), method='max')
+            # по каталогу исключаем растры, которые не пересекают регионы карт,
+            # если таких не осталось - объединяем все, как без каталога
+            dates = {r.output_file: r.based_on.dataset_date for r in ndvi_records}
+            ndvi_rasters = self._select_contributing_rasters(ndvi_rasters, 'ndvi', dates, _catalog.NDVI_CLOUD_VALUE) \
+                or ndvi_rasters
+
+            self._on_before_processing(str(output_file), 'merged_ndvi', ndvi_rasters, date=now)
+            statistics = self._get_composite_statistics()
+            if len(statistics) > 1:
+                composite_files2tiff(ndvi_rasters, str(output_file), statistics,
+                                     dates=[dates[r] for r in ndvi_rasters],
+                                     cloud_value=_catalog.NDVI_CLOUD_VALUE,
+                                     tile_size=self._config.get('MERGE_TILE_SIZE', 1024),
+                                     workers=self._config.get('MERGE_WORKERS'))
+            elif self._config.get('MERGE_TILED', False):
+                merge_files2tiff_tiled(ndvi_rasters, str(output_file), method='max',
+                                       tile_size=self._config.get('MERGE_TILE_SIZE', 1024),
+                                       workers=self._config.get('MERGE_WORKERS'))
+            else:
+                merge_files2tiff(ndvi_rasters, str(output_file), method='max')
             self._on_after_processing(str(output_file), 'merged_ndvi')
+            self._register_footprint(output_file, 'merged_ndvi', past_day, now, cloud_value=_catalog.NDVI_CLOUD_VALUE)
 
         composite = NDVIComposite.get_or_none(NDVIComposite.output_file == str(output_file))
 
@@ -451,54 +996,187 @@ class NPPProcessor:
             ]
             NDVICompositeComponents.bulk_create(assoc)
 
+        if statistics is not None:
+            # у одноканального композита (только max) записей о каналах нет, см. NDVIComposite.get_band
+            NDVICompositeBand.set_bands(composite, statistics if len(statistics) > 1 else [],
+                                        _catalog.NDVI_CLOUD_VALUE, len(ndvi_rasters))
+            self._append_to_datacube(composite)
+
         return composite
 
-    def get_or_make_ndvi_dynamics(self, now: date = None) -> Optional[NDVIDynamicsTiff]:
-        now = now or self.now.date()
-        days = self._config.get(
+    def _append_to_datacube(self, composite: NDVIComposite):
+        """
+        Добавляет композит в датакуб (срез за composite.ends_at), если датакуб включен (DATACUBE в конфигурации).
+        Сетка куба задается при его создании: DATACUBE_BOUNDS (по умолчанию - объединение регионов PNG_CONFIG)
+        и DATACUBE_RESOLUTION (по умолчанию - разрешение композита).
+        """
+        if not self._config.get('DATACUBE', False) or not os.path.isfile(composite.output_file):
+            return
+        path = str(_datacube.get_datacube_file(self._config))
+        self._on_before_processing(path, 'datacube', [composite.output_file], date=composite.ends_at)
+        try:
+            with _datacube.DataCube.open_or_create(path, *self._get_regional_grid(composite.output_file)) as cube:
+                cube.append(composite.ends_at, composite.output_file, composite.id,
+                            count_band=composite.get_band('count'))
+        except Exception as exc:
+            logger.warning(f'не удалось добавить композит {composite.output_file} в датакуб: {exc}')
+        self._on_after_processing(path, 'datacube')
+
+    def _get_regional_grid(self, composite_file: str):
+        """
+        Региональная сетка датакуба и нормы NDVI: DATACUBE_BOUNDS (по умолчанию - объединение регионов
+        PNG_CONFIG или границы композита) и DATACUBE_RESOLUTION (по умолчанию - разрешение композита)
+
+        :return: проекция, трансформация, ширина, высота
+        """
+        with rasterio.open(composite_file) as f:
+            crs, resolution, file_bounds = f.crs, f.res[0], tuple(f.bounds)
+        bounds = self._config.get('DATACUBE_BOUNDS') \
+            or _hlutil.union_bounds(_hlutil.get_png_config_bounds(self.png_config or [])) \
+            or file_bounds
+        transform, width, height = _datacube.snap_grid(bounds, self._config.get('DATACUBE_RESOLUTION', resolution))
+        return crs, transform, width, height
+
+    def _get_composite_statistics(self) -> List[str]:
+        """
+        Статистики (каналы) композита NDVI из COMPOSITE_STATISTICS. Первый канал всегда max - его используют
+        карты и динамика NDVI.
+        """
+        statistics = [s for s in self._config.get('COMPOSITE_STATISTICS') or [] if s != 'max']
+        return ['max'] + list(dict.fromkeys(statistics))
+
+    def _get_ndvi_dynamics_period(self) -> int:
+        return self._config.get(
             'NDVI_DYNAMICS_PERIOD',
             self._config.get('NDVI_MERGE_PERIOD_IN_DAYS', 5) * 2
         )
-        past_days = now - timedelta(days=days - 1)
-        b2: NDVIComposite = NDVIComposite.get_or_none(NDVIComposite.ends_at == now)
-        b1: NDVIComposite = NDVIComposite.get_or_none(NDVIComposite.starts_at == past_days)
 
-        if b1 is None:
-            logger.warning(f'не удалось найти композит начинающийся с starts_at={past_days} (b1)')
-            return None
-        if b2 is None:
-            logger.error(f'не удалось найти композит, сделанный сегодня (b2, ends_at={now})')
-            return None
+    def get_or_make_ndvi_dynamics(self, now: date = None) -> Optional[NDVIDynamicsTiff]:
+        days = self._get_ndvi_dynamics_period()
+        return self.make_ndvi_dynamics(now, [days]).get(days)
 
-        if (b1.ends_at - b2.starts_at).days > 1:
-            logger.warning(f'похоже, что композиты {b1} и {b2} имеют неправильные даты - между концом композита {b1} и'
-                           f' датой начала {b2} более 1 дня ({b1.ends_at - b2.starts_at})')
+    def make_ndvi_dynamics(self, now: date = None, periods: List[int] = None) -> Dict[int, NDVIDynamicsTiff]:
+        """
+        Создает динамику NDVI сегодняшнего композита относительно композитов, которые начинаются за period - 1
+        дней до сегодня, для нескольких периодов за один проход (см. process_ndvi_dynamics_multi).
 
-        filename = '.'.join((
-            f'ndvi_dynamics',
-            f'{b1.starts_at.strftime("%Y%m%d")}-{b1.ends_at.strftime("%Y%m%d")}',
-            f'{b2.starts_at.strftime("%Y%m%d")}-{b2.ends_at.strftime("%Y%m%d")}',
-            'tiff'
-        ))
-        dynamics_tiff_output = _mkpath(self._processed_output / self.now.strftime('%Y%m%d') / 'daily') / filename
+        :param now: дата, по умолчанию - сегодня
+        :param periods: периоды в днях, по умолчанию - NDVI_DYNAMICS_PERIOD и NDVI_DYNAMICS_EXTRA_PERIODS
+        :return: словарь период - запись динамики (периоды, для которых не нашлось композита, пропускаются)
+        """
+        now = now or self.now.date()
+        if periods is None:
+            periods = [self._get_ndvi_dynamics_period()] + list(self._config.get('NDVI_DYNAMICS_EXTRA_PERIODS') or [])
+        periods = list(dict.fromkeys(periods))
+        b2: NDVIComposite = NDVIComposite.get_or_none(NDVIComposite.ends_at == now)
+        if b2 is None:
+            logger.error(f'не удалось найти композит, сделанный сегодня (b2, ends_at={now})')
+            return {}
+
+        outputs = {}
+        for days in periods:
+            past_days = now - timedelta(days=days - 1)
+            b1: NDVIComposite = NDVIComposite.get_or_none(NDVIComposite.starts_at == past_days)
+            if b1 is None:
+                logger.warning(f'не удалось найти композит начинающийся с starts_at={past_days} (b1)')
+                continue
 
-        if not dynamics_tiff_output.is_file() or self._config.get('FORCE_NDVI_DYNAMICS_PROCESSING', True):
-            self._on_before_processing(str(dynamics_tiff_output), 'ndvi_dynamics')
-            _process.process_ndvi_dynamics(b1.output_file, b2.output_file, str(dynamics_tiff_output))
-            self._on_after_processing(str(dynamics_tiff_output), 'ndvi_dynamics')
+            if (b1.ends_at - b2.starts_at).days > 1:
+                logger.warning(f'похоже, что композиты {b1} и {b2} имеют неправильные даты - между концом композита '
+                               f'{b1} и датой начала {b2} более 1 дня ({b1.ends_at - b2.starts_at})')
+
+            filename = '.'.join((
+                f'ndvi_dynamics',
+                f'{b1.starts_at.strftime("%Y%m%d")}-{b1.ends_at.strftime("%Y%m%d")}',
+                f'{b2.starts_at.strftime("%Y%m%d")}-{b2.ends_at.strftime("%Y%m%d")}',
+                'tiff'
+            ))
+            output = _mkpath(self._processed_output / self.now.strftime('%Y%m%d') / 'daily') / filename
+            outputs[days] = (b1, output)
+
+        force = self._config.get('FORCE_NDVI_DYNAMICS_PROCESSING', True)
+        pending = {days: (b1, output) for days, (b1, output) in outputs.items() if force or not output.is_file()}
+        if pending:
+            first_output = str(next(iter(pending.values()))[1])
+            self._on_before_processing(first_output, 'ndvi_dynamics',
+                                       [b2.output_file] + [b1.output_file for b1, _ in pending.values()],
+                                       date=self.now)
+            created = _process.process_ndvi_dynamics_multi(
+                b2.output_file, [b1.output_file for b1, _ in pending.values()],
+                [str(output) for _, output in pending.values()])
+            self._on_after_processing(first_output, 'ndvi_dynamics')
+            for days, (b1, output) in pending.items():
+                if str(output) not in created:
+                    del outputs[days]
+                    continue
+                self._register_footprint(output, 'ndvi_dynamics', b1.starts_at, b2.ends_at)
+
+        existing = NDVIDynamicsTiff.get_many(output for _, output in outputs.values())
+        records = {}
+        for days, (b1, output) in outputs.items():
+            record: NDVIDynamicsTiff = existing.get(str(output))
+            if record is None:
+                record = NDVIDynamicsTiff(output)
+                record.b1_composite = b1
+                record.b2_composite = b2
+                record.save(True)
+            elif record.b1_composite_id != b1.id or record.b2_composite_id != b2.id:
+                record.b2_composite = b2
+                record.b1_composite = b1
+                record.save()
+            records[days] = record
+        return records
+
+    def _get_ndvi_anomaly_file(self, now: date) -> Path:
+        return self._processed_output / now.strftime('%Y%m%d') / 'daily' / f'ndvi_anomaly.{now.strftime("%Y%m%d")}.tiff'
+
+    def make_ndvi_anomaly(self, now: date = None) -> Optional[Path]:
+        """
+        Добавляет в многолетнюю норму NDVI (см. gdal_viirs.hl.climatology) композиты за последние
+        CLIMATOLOGY_LOOKBACK_DAYS дней до сегодняшнего, которых в ней еще нет, и создает отклонение сегодняшнего
+        композита от нормы. Сегодняшний композит в норму не добавляется: в течение дня он пересоздается
+        с новыми данными, он будет добавлен завтра. Работает только при CLIMATOLOGY = True.
 
-        record: NDVIDynamicsTiff = NDVIDynamicsTiff.get_or_none(NDVIDynamicsTiff.output_file == dynamics_tiff_output)
-        if record is None:
-            record = NDVIDynamicsTiff(dynamics_tiff_output)
-            record.b1_composite = b1
-            record.b2_composite = b2
-            record.save(True)
-        elif record.b1_composite != b1 or record.b2_composite != b2:
-            record.b2_composite = b2
-            record.b1_composite = b1
-            record.save()
+        :param now: дата, по умолчанию - сегодня
+        :return: путь к файлу отклонения или None, если норма выключена, пуста или нет сегодняшнего композита
+        """
+        if not self._config.get('CLIMATOLOGY', False):
+            return None
+        now = now or self.now.date()
+        composite: NDVIComposite = NDVIComposite.get_or_none(NDVIComposite.ends_at == now)
+        if composite is None or not os.path.isfile(composite.output_file):
+            logger.warning(f'не удалось найти композит, сделанный сегодня (ends_at={now}), отклонение от нормы '
+                           f'не будет создано')
+            return None
 
-        return record
+        path = str(_climatology.get_climatology_file(self._config))
+        lookback = self._config.get('CLIMATOLOGY_LOOKBACK_DAYS', 30)
+        past = NDVIComposite.select() \
+            .where(NDVIComposite.ends_at < now, NDVIComposite.ends_at >= now - timedelta(days=lookback)) \
+            .order_by(NDVIComposite.ends_at)
+        output = self._get_ndvi_anomaly_file(now)
+        _mkpath(output.parent)
+        with _climatology.ClimatologyStore.open_or_create(path, *self._get_regional_grid(composite.output_file)) \
+                as store:
+            folded = set(store.dates)
+            pending = [c for c in past if c.ends_at not in folded and os.path.isfile(c.output_file)]
+            if pending:
+                self._on_before_processing(path, 'climatology', [c.output_file for c in pending], date=now)
+                for past_composite in pending:
+                    store.fold(past_composite.ends_at, past_composite.output_file)
+                self._on_after_processing(path, 'climatology')
+
+            if not store.dates:
+                logger.info('многолетняя норма NDVI пока пуста, отклонение от нормы не будет создано')
+                return None
+            self._on_before_processing(str(output), 'ndvi_anomaly', [composite.output_file, path], date=now)
+            _climatology.make_anomaly_file(store, now, composite.output_file, output,
+                                           window_days=self._config.get('CLIMATOLOGY_WINDOW_DAYS', 7),
+                                           min_years=self._config.get('CLIMATOLOGY_MIN_YEARS', 3))
+            self._on_after_processing(str(output), 'ndvi_anomaly')
+        self._register_footprint(output, 'ndvi_anomaly', composite.starts_at, composite.ends_at,
+                                 cloud_value=_climatology.ANOMALY_CLOUD_VALUE)
+        return output
 
     # endregion
 
@@ -568,15 +1246,38 @@ class NPPProcessor:
         ndvi_dynamics_dir = self._ndvi_dynamics_output / now.strftime('%Y%m%d')
         _mkpath(ndvi_dynamics_dir)
         # создание карт динамики
-        self._on_before_processing(str(ndvi_dynamics_dir), 'maps_ndvi_dynamics')
+        from gdal_viirs.maps.ndvi_dynamics import NDVIDynamicsMapBuilder
+        self._on_before_processing(str(ndvi_dynamics_dir), 'maps_ndvi_dynamics', [ndvi_dynamics.output_file],
+                                   date=now)
         self.make_ndvi_dynamics_maps_source(
             ndvi_dynamics.output_file, str(ndvi_dynamics_dir), ndvi_dynamics.b2_composite.ends_at,
             self._config.getpath('MAPS_FILENAME_PATTERN.ndvi_dynamics'), ndvi_dynamics.date_text, NDVIDynamicsMapBuilder
         )
         self._on_after_processing(str(ndvi_dynamics_dir), 'maps_ndvi_dynamics')
 
+    def make_ndvi_anomaly_maps(self, now: date = None):
+        now = now or self.now.date()
+        anomaly_file = self._get_ndvi_anomaly_file(now)
+        if not anomaly_file.is_file():
+            anomaly_file = self.make_ndvi_anomaly(now)
+        if anomaly_file is None:
+            logger.warning('не могу создать карты отклонения NDVI от нормы т. к. не удалось создать отклонение')
+            return
+
+        try:
+            output_root = self._config.get_output('ndvi_anomaly')
+        except KeyError:
+            output_root = self._ndvi_output
+        output_dir = _mkpath(output_root / now.strftime('%Y%m%d'))
+        from gdal_viirs.maps.ndvi_anomaly import NDVIAnomalyMapBuilder
+        self._on_before_processing(str(output_dir), 'maps_ndvi_anomaly', [str(anomaly_file)], date=now)
+        self._make_images(str(anomaly_file), str(output_dir), now,
+                          self._config.get('MAPS_FILENAME_PATTERN.ndvi_anomaly', '{yymmdd}2359_{name}_anomaly.png'),
+                          date_text=now.strftime('%d.%m.%Y'), builder=NDVIAnomalyMapBuilder)
+        self._on_after_processing(str(output_dir), 'maps_ndvi_anomaly')
+
     def make_ndvi_dynamics_maps_source(self, source: str, output_directory: str, dt: date, file_pattern: str,
-                                       bottom_description: str = None, builder: Type[MapBuilder] = None):
+                                       bottom_description: str = None, builder: Type['MapBuilder'] = None):
         self._make_images(source,
                           output_directory,
                           dt,
@@ -586,6 +1287,7 @@ class NPPProcessor:
 
     def _make_images(self, input_file: str, output_directory: str, dt: date, filename_pattern: str,
                      date_text=None, builder=None):
+        from gdal_viirs.maps import produce_image
         png_config = self._config.get("PNG_CONFIG")
 
         with rasterio.open(input_file) as f:
@@ -614,7 +1316,8 @@ class NPPProcessor:
                 props = {
                     'bottom_subtitle': display_name,
                     'map_points': self._config.get('MAP_POINTS'),
-                    'date_text': date_text
+                    'date_text': date_text,
+                    'windowed_read': self._config.get('MAPS_WINDOWED_READ', False)
                 }
                 if 'FONT_FAMILY' in self._config:
                     props['font_family'] = self._config['FONT_FAMILY']
@@ -651,6 +1354,7 @@ class NPPProcessor:
                     gradation = gradation.get(self.now.strftime('%m%d'))
 
                 logger.debug(f'обработка изображения ({index + 1}/{len(png_config)}) {filepath}')
+                self._on_before_processing(filepath, 'map', [input_file], region=name, date=dt)
                 produce_image(
                     f, filepath,
                     builder=builder,
@@ -664,6 +1368,7 @@ class NPPProcessor:
                     gradation_value=gradation,
                     **props
                 )
+                self._on_after_processing(filepath, 'map')
 
     # endregion
 
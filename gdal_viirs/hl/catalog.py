@@ -0,0 +1,74 @@
+"""
+catalog.py заполняет каталог растров (модель Footprint): границы, проекция, разрешение и доли пикселей
+с данными и облаками для каждого созданного продукта.
+"""
+from datetime import datetime
+from pathlib import Path
+from typing import Optional, Union
+
+import numpy as np
+import rasterio
+from loguru import logger
+from rasterio.enums import Resampling
+
+from gdal_viirs.persistence.models import Footprint
+
+# значение облачных пикселей в NDVI (см. process.calc_ndvi)
+NDVI_CLOUD_VALUE = -2
+
+
+def describe_raster(path: Union[str, Path], cloud_value: float = None, max_pixels: int = 2 ** 20) -> dict:
+    """
+    Описывает растр для каталога. Доли пикселей считаются по первому каналу, прочитанному с прореживанием
+    (не больше max_pixels пикселей), поэтому для больших растров они приблизительные.
+
+    :param path: путь к растру
+    :param cloud_value: значение облачных пикселей, None - облака не учитываются
+    :param max_pixels: максимальное количество пикселей, которое читается для подсчета долей
+    :return: словарь с полями Footprint: crs, min_x, min_y, max_x, max_y, res_x, res_y, width, height,
+        valid_fraction, cloud_fraction
+    """
+    with rasterio.open(str(path)) as f:
+        step = max(1, int(np.ceil(np.sqrt(f.width * f.height / max_pixels))))
+        out_shape = (max(1, f.height // step), max(1, f.width // step))
+        data = f.read(1, out_shape=out_shape, resampling=Resampling.nearest, masked=True)
+        nodata = np.ma.getmaskarray(data)
+        if np.issubdtype(data.dtype, np.floating):
+            nodata |= np.isnan(data.filled(0))
+        clouds = ~nodata & (data.filled(0) == cloud_value) if cloud_value is not None else np.zeros_like(nodata)
+        valid = ~nodata & ~clouds
+        observed = np.count_nonzero(valid) + np.count_nonzero(clouds)
+        return {
+            'crs': f.crs.to_wkt() if f.crs is not None else '',
+            'min_x': f.bounds.left,
+            'min_y': f.bounds.bottom,
+            'max_x': f.bounds.right,
+            'max_y': f.bounds.top,
+            'res_x': f.res[0],
+            'res_y': f.res[1],
+            'width': f.width,
+            'height': f.height,
+            'valid_fraction': float(np.count_nonzero(valid) / valid.size),
+            'cloud_fraction': float(np.count_nonzero(clouds) / observed) if cloud_value is not None and observed else None,
+        }
+
+
+def register_raster(path: Union[str, Path], kind: str, starts_at: datetime, ends_at: datetime = None,
+                    cloud_value: float = None) -> Optional[Footprint]:
+    """
+    Добавляет растр в каталог. Ошибки не прерывают обработку: растр без записи в каталоге
+    просто не участвует в отборе по каталогу.
+
+    :param path: путь к растру
+    :param kind: тип продукта (VIMGO, ndvi, merged_ndvi, ndvi_dynamics, ...)
+    :param starts_at: начало периода, за который получен растр
+    :param ends_at: конец периода, по умолчанию - starts_at
+    :param cloud_value: значение облачных пикселей, None - облака не учитываются
+    :return: запись каталога или None, если растр не удалось описать
+    """
+    try:
+        info = describe_raster(path, cloud_value)
+        return Footprint.register(path, kind, starts_at, ends_at or starts_at, **info)
+    except Exception as exc:
+        logger.warning(f'не удалось добавить {path} в каталог: {exc}')
+        return None
@@ -0,0 +1,268 @@
+"""
+climatology.py - многолетняя норма NDVI по дням года и отклонение композита от нормы.
+
+Норма хранится в одном HDF5 файле на фиксированной региональной сетке (той же, что у датакуба) в виде
+накопителей Уэлфорда для каждого пикселя и дня года: количество наблюдений (count), среднее (mean) и сумма
+квадратов отклонений от среднего (m2). Композит за день добавляется в норму одним проходом по полосам
+строк (fold), пересчитывать норму по всем композитам за прошлые годы не нужно.
+
+День года считается по месяцу и числу (29 февраля - отдельный день, 366 дней), поэтому одна и та же дата
+в високосном и невисокосном году попадает в один день. При чтении нормы можно объединить соседние дни
+(window_days), накопители объединяются по формуле Чана, т. е. так, как если бы все наблюдения окна
+добавлялись в один накопитель.
+
+Каждая дата добавляется в норму один раз: даты и файлы добавленных композитов хранятся в самом файле.
+
+Композиты за соседние дни перекрываются (каждый - за несколько дней), поэтому наблюдения одного года
+внутри окна не независимы. Поэтому для каждого пикселя и дня года хранится и битовая маска лет
+с наблюдениями (years, бит - год по модулю 64 от YEARS_BASE). Достоверность нормы определяется
+количеством разных лет в окне, а стандартное отклонение считается как отклонение между годами
+(поправка Бесселя - по количеству лет, а не наблюдений).
+"""
+from datetime import date, datetime
+from pathlib import Path
+from typing import List, Tuple, Union
+
+import h5py
+import numpy as np
+import rasterio
+import rasterio.crs
+from affine import Affine
+from rasterio.windows import Window
+
+from gdal_viirs.hl.datacube import CHUNK_SIZE, read_on_grid
+
+DAYS = 366
+# год нулевого бита маски лет, маска различает 64 года подряд
+YEARS_BASE = 2000
+# значение облачных пикселей в отклонении (как в динамике NDVI)
+ANOMALY_CLOUD_VALUE = -999
+ANOMALY_BANDS = ('anomaly', 'zscore', 'years')
+
+# значение облачных пикселей в NDVI (см. process.calc_ndvi)
+_NDVI_CLOUD_VALUE = -2
+_CHUNK_CACHE_BYTES = 64 * 2 ** 20
+# количество единичных битов в байте
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], 'uint8')
+
+
+def get_climatology_file(config) -> Path:
+    """
+    Путь к файлу нормы по конфигурации: CLIMATOLOGY_FILE или OUTPUTS.processed_data/ndvi_climatology.h5
+    """
+    return Path(config.get('CLIMATOLOGY_FILE') or config.get_output('processed_data') / 'ndvi_climatology.h5')
+
+
+def day_of_year_index(dt: date) -> int:
+    """
+    Номер дня года (0 - 365) по месяцу и числу, 29 февраля - 59
+    """
+    return date(2000, dt.month, dt.day).timetuple().tm_yday - 1
+
+
+def _year_bit(dt: date) -> np.uint64:
+    return np.uint64(1) << np.uint64((dt.year - YEARS_BASE) % 64)
+
+
+def _count_years(mask: np.ndarray) -> np.ndarray:
+    """
+    Количество лет (единичных битов) в маске лет
+    """
+    return _POPCOUNT[mask.view('uint8')].reshape(mask.shape + (8,)).sum(axis=-1, dtype='uint8')
+
+
+class ClimatologyStore:
+    """
+    Многолетняя норма NDVI, см. описание модуля. Открывается как контекстный менеджер:
+
+        with ClimatologyStore.open(path) as store:
+            count, years, mean, std = store.read_norm(date(2021, 7, 1), window_days=7)
+    """
+
+    def __init__(self, file: h5py.File):
+        self._file = file
+
+    # region открытие и создание
+
+    @classmethod
+    def open(cls, path: Union[str, Path], mode: str = 'r') -> 'ClimatologyStore':
+        return cls(h5py.File(str(path), mode, rdcc_nbytes=_CHUNK_CACHE_BYTES))
+
+    @classmethod
+    def create(cls, path: Union[str, Path], crs: rasterio.crs.CRS, transform: Affine, width: int, height: int,
+               chunk_size: int = CHUNK_SIZE) -> 'ClimatologyStore':
+        """
+        Создает пустую норму на сетке (crs, transform, width, height)
+        """
+        file = h5py.File(str(path), 'w-', rdcc_nbytes=_CHUNK_CACHE_BYTES)
+        try:
+            file.attrs['crs'] = crs.to_wkt()
+            file.attrs['transform'] = tuple(transform)[:6]
+            file.attrs['created_at'] = datetime.now().isoformat(timespec='seconds')
+            # один чанк - один день года, при добавлении композита читается и записывается только его день
+            chunks = (1, min(chunk_size, height), min(chunk_size, width))
+            for name, dtype in (('count', 'uint16'), ('years', 'uint64'), ('mean', 'float32'), ('m2', 'float32')):
+                file.create_dataset(name, shape=(DAYS, height, width), dtype=dtype, chunks=chunks, fillvalue=0,
+                                    compression='gzip', compression_opts=1, shuffle=True)
+            file.create_dataset('time', shape=(0,), maxshape=(None,), dtype='int32', chunks=(1024,))
+            file.create_dataset('source', shape=(0,), maxshape=(None,), dtype=h5py.string_dtype(), chunks=(1024,))
+        except Exception:
+            file.close()
+            raise
+        return cls(file)
+
+    @classmethod
+    def open_or_create(cls, path: Union[str, Path], crs: rasterio.crs.CRS, transform: Affine, width: int,
+                       height: int) -> 'ClimatologyStore':
+        """
+        Открывает норму для записи, если файла нет - создает его на сетке (crs, transform, width, height)
+        """
+        if Path(path).is_file():
+            return cls.open(path, 'r+')
+        return cls.create(path, crs, transform, width, height)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    # endregion
+
+    @property
+    def crs(self) -> rasterio.crs.CRS:
+        return rasterio.crs.CRS.from_wkt(self._file.attrs['crs'])
+
+    @property
+    def transform(self) -> Affine:
+        return Affine(*self._file.attrs['transform'])
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self._file['count'].shape[1:]
+
+    @property
+    def dates(self) -> List[date]:
+        """
+        Даты композитов, добавленных в норму
+        """
+        return [date.fromordinal(int(t)) for t in self._file['time'][:]]
+
+    def is_folded(self, dt: date) -> bool:
+        return bool(np.any(self._file['time'][:] == dt.toordinal()))
+
+    def fold(self, dt: date, ndvi_file: Union[str, Path], ndvi_band: int = 1) -> bool:
+        """
+        Добавляет композит за дату в норму его дня года (облачные пиксели и пиксели без данных пропускаются).
+        Композит приводится к сетке нормы и обрабатывается полосами строк, целиком в память не читается.
+
+        :return: False, если композит за эту дату уже добавлен
+        """
+        if self.is_folded(dt):
+            return False
+        day = day_of_year_index(dt)
+        year_bit = _year_bit(dt)
+        height, width = self.shape
+        count_ds, years_ds, mean_ds, m2_ds = (self._file[name] for name in ('count', 'years', 'mean', 'm2'))
+        for rows, data in read_on_grid(ndvi_file, self.crs, self.transform, width, height, (ndvi_band,),
+                                       count_ds.chunks[1]):
+            ndvi = data[0]
+            valid = ~np.isnan(ndvi) & (ndvi != _NDVI_CLOUD_VALUE)
+            if not valid.any():
+                continue
+            count = count_ds[day, rows]
+            mean = mean_ds[day, rows]
+            m2 = m2_ds[day, rows]
+            # шаг Уэлфорда только для пикселей с наблюдением
+            count = np.where(valid, np.minimum(count.astype('uint32') + 1, np.iinfo('uint16').max), count)
+            delta = np.where(valid, ndvi - mean, 0).astype('float32')
+            mean += delta / np.maximum(count, 1)
+            m2 += delta * np.where(valid, ndvi - mean, 0)
+            count_ds[day, rows] = count.astype('uint16')
+            years = years_ds[day, rows]
+            years_ds[day, rows] = np.where(valid, years | year_bit, years)
+            mean_ds[day, rows] = mean
+            m2_ds[day, rows] = m2
+
+        t = self._file['time'].shape[0]
+        for name in ('time', 'source'):
+            self._file[name].resize(t + 1, axis=0)
+        self._file['time'][t] = dt.toordinal()
+        self._file['source'][t] = str(ndvi_file)
+        self._file.flush()
+        return True
+
+    def read_norm(self, dt: date, window_days: int = 0,
+                  rows: slice = slice(None)) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Норма для дня года даты, объединенная по дням [день - window_days, день + window_days]
+
+        :param rows: строки сетки, по умолчанию - все
+        :return: количество наблюдений, количество разных лет с наблюдениями, среднее и стандартное
+            отклонение между годами (NaN, если лет меньше двух)
+        """
+        center = day_of_year_index(dt)
+        count = mean = m2 = None
+        years_mask = None
+        for offset in range(-window_days, window_days + 1):
+            day = (center + offset) % DAYS
+            years_b = self._file['years'][day, rows]
+            years_mask = years_b if years_mask is None else years_mask | years_b
+            n_b = self._file['count'][day, rows].astype('float64')
+            mean_b = self._file['mean'][day, rows].astype('float64')
+            m2_b = self._file['m2'][day, rows].astype('float64')
+            if count is None:
+                count, mean, m2 = n_b, mean_b, m2_b
+                continue
+            # объединение накопителей (Chan et al.)
+            total = count + n_b
+            delta = mean_b - mean
+            with np.errstate(invalid='ignore', divide='ignore'):
+                share = np.where(total > 0, n_b / total, 0)
+            m2 = m2 + m2_b + delta ** 2 * count * share
+            mean = mean + delta * share
+            count = total
+        years = _count_years(years_mask)
+        # наблюдения одного года внутри окна сильно коррелированы, поэтому дисперсия наблюдений (m2 / count)
+        # приводится к несмещенной оценке дисперсии между годами по количеству лет
+        with np.errstate(invalid='ignore', divide='ignore'):
+            std = np.where(years > 1, np.sqrt(m2 / np.maximum(count, 1) * years / np.maximum(years - 1, 1)), np.nan)
+        mean = np.where(count > 0, mean, np.nan)
+        return count.astype('uint32'), years, mean.astype('float32'), std.astype('float32')
+
+
+def make_anomaly_file(store: ClimatologyStore, dt: date, ndvi_file: Union[str, Path], output_file: Union[str, Path],
+                      window_days: int = 0, min_years: int = 3, ndvi_band: int = 1) -> str:
+    """
+    Отклонение композита от нормы на сетке нормы, полосами строк. Каналы (см. ANOMALY_BANDS):
+
+    1. anomaly - NDVI минус среднее, ANOMALY_CLOUD_VALUE - облака;
+    2. zscore - отклонение в стандартных отклонениях нормы;
+    3. years - количество разных лет с наблюдениями в норме.
+
+    Пиксели без данных и пиксели, для которых в норме меньше min_years лет с наблюдениями, получают NaN.
+    Отклонение нужно считать до добавления композита в норму (ClimatologyStore.fold), иначе он сам входит в норму.
+
+    :return: путь к файлу
+    """
+    height, width = store.shape
+    with rasterio.open(str(output_file), 'w', driver='GTiff', count=len(ANOMALY_BANDS), crs=store.crs,
+                       transform=store.transform, width=width, height=height, dtype='float32', nodata=np.nan,
+                       tiled=True, blockxsize=256, blockysize=256) as out:
+        for rows, data in read_on_grid(ndvi_file, store.crs, store.transform, width, height, (ndvi_band,)):
+            ndvi = data[0]
+            _, years, mean, std = store.read_norm(dt, window_days, rows)
+            clouds = ndvi == _NDVI_CLOUD_VALUE
+            known = years >= max(min_years, 1)
+            anomaly = np.where(known & ~clouds, ndvi - mean, np.nan)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                zscore = np.where(std > 0, anomaly / std, np.nan)
+            anomaly[known & clouds] = ANOMALY_CLOUD_VALUE
+            window = Window(0, rows.start, width, rows.stop - rows.start)
+            out.write(np.stack([anomaly, zscore, years.astype('float32')]).astype('float32'), window=window)
+        for band, name in enumerate(ANOMALY_BANDS, 1):
+            out.set_band_description(band, name)
+    return str(output_file)
@@ -0,0 +1,318 @@
+"""
+datacube.py - временной ряд NDVI на фиксированной региональной сетке в одном HDF5 файле (датакуб).
+
+Ежедневные композиты добавляются в конец куба (по одному срезу на дату), поэтому временной ряд пикселя или
+карта за день читаются из одного файла, без открытия сотен GeoTIFF. Переменные куба - трехмерные наборы данных
+(время, строка, столбец):
+
+* ndvi - композит NDVI (max), -2 - облака, NaN - нет данных;
+* count - количество безоблачных наблюдений (255 - неизвестно, например, у одноканального композита);
+* clouds - 1, если пиксель композита закрыт облаками.
+
+Куб хранит собственный индекс: даты срезов (time, дни с 01.01.0001, см. date.toordinal), пути и id записей
+композитов (source, source_id), а в атрибутах - проекцию и трансформацию сетки.
+
+Наборы данных разбиты на чанки CHUNK_DAYS x CHUNK_SIZE x CHUNK_SIZE: карта за день читает CHUNK_DAYS срезов
+(небольшое чтение лишнего), ряд пикселя за сезон - несколько чанков по времени вместо сотен файлов.
+"""
+from datetime import date, datetime
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional, Tuple, Union
+
+import h5py
+import numpy as np
+import rasterio
+import rasterio.crs
+from affine import Affine
+from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window
+
+CHUNK_DAYS = 8
+CHUNK_SIZE = 128
+COUNT_UNKNOWN = 255
+
+# переменные куба: тип и значение по умолчанию (для пикселей и срезов, которые не записывались)
+VARIABLES = {
+    'ndvi': ('float32', np.nan),
+    'count': ('uint8', COUNT_UNKNOWN),
+    'clouds': ('uint8', 0),
+}
+
+# значение облачных пикселей в NDVI (см. process.calc_ndvi)
+_NDVI_CLOUD_VALUE = -2
+# кэш чанков HDF5, чтобы при чтении полосами строк распакованные чанки не читались повторно
+_CHUNK_CACHE_BYTES = 64 * 2 ** 20
+
+
+def get_datacube_file(config) -> Path:
+    """
+    Путь к датакубу по конфигурации: DATACUBE_FILE или OUTPUTS.processed_data/ndvi_datacube.h5
+    """
+    return Path(config.get('DATACUBE_FILE') or config.get_output('processed_data') / 'ndvi_datacube.h5')
+
+
+def snap_grid(bounds: Tuple[float, float, float, float], resolution: float) -> Tuple[Affine, int, int]:
+    """
+    Сетка с заданным разрешением, покрывающая bounds, с границами, кратными разрешению
+
+    :return: трансформация, ширина, высота
+    """
+    left, bottom, right, top = bounds
+    left = np.floor(left / resolution) * resolution
+    top = np.ceil(top / resolution) * resolution
+    width = int(np.ceil((right - left) / resolution))
+    height = int(np.ceil((top - bottom) / resolution))
+    return Affine(resolution, 0, left, 0, -resolution, top), width, height
+
+
+def read_on_grid(path: Union[str, Path], crs: rasterio.crs.CRS, transform: Affine, width: int, height: int,
+                 bands: Tuple[int, ...] = (1,), block_rows: int = CHUNK_SIZE) -> Iterator[Tuple[slice, np.ndarray]]:
+    """
+    Читает растр, приведенный к сетке (ближайший сосед), полосами по block_rows строк
+
+    :return: итератор (строки сетки, данные полосы (канал, строка, столбец))
+    """
+    with rasterio.open(str(path)) as src:
+        with WarpedVRT(src, crs=crs, transform=transform, width=width, height=height,
+                       resampling=Resampling.nearest, src_nodata=np.nan, nodata=np.nan) as vrt:
+            for row in range(0, height, block_rows):
+                window = Window(0, row, width, min(block_rows, height - row))
+                yield slice(row, row + window.height), vrt.read(list(bands), window=window)
+
+
+class DataCube:
+    """
+    Датакуб NDVI, см. описание модуля. Открывается как контекстный менеджер:
+
+        with DataCube.open(path) as cube:
+            values = cube.read_day(date(2021, 7, 1))
+    """
+
+    def __init__(self, file: h5py.File):
+        self._file = file
+
+    # region открытие и создание
+
+    @classmethod
+    def open(cls, path: Union[str, Path], mode: str = 'r') -> 'DataCube':
+        return cls(h5py.File(str(path), mode, rdcc_nbytes=_CHUNK_CACHE_BYTES))
+
+    @classmethod
+    def create(cls, path: Union[str, Path], crs: rasterio.crs.CRS, transform: Affine, width: int, height: int,
+               chunk_days: int = CHUNK_DAYS, chunk_size: int = CHUNK_SIZE) -> 'DataCube':
+        """
+        Создает пустой куб на сетке (crs, transform, width, height)
+        """
+        file = h5py.File(str(path), 'w-', rdcc_nbytes=_CHUNK_CACHE_BYTES)
+        try:
+            file.attrs['crs'] = crs.to_wkt()
+            file.attrs['transform'] = tuple(transform)[:6]
+            file.attrs['created_at'] = datetime.now().isoformat(timespec='seconds')
+            chunks = (chunk_days, min(chunk_size, height), min(chunk_size, width))
+            for name, (dtype, fill_value) in VARIABLES.items():
+                file.create_dataset(name, shape=(0, height, width), maxshape=(None, height, width), dtype=dtype,
+                                    chunks=chunks, fillvalue=fill_value, compression='gzip', compression_opts=1,
+                                    shuffle=True)
+            file.create_dataset('time', shape=(0,), maxshape=(None,), dtype='int32', chunks=(1024,))
+            file.create_dataset('source_id', shape=(0,), maxshape=(None,), dtype='int64', chunks=(1024,))
+            file.create_dataset('source', shape=(0,), maxshape=(None,), dtype=h5py.string_dtype(), chunks=(1024,))
+        except Exception:
+            file.close()
+            raise
+        return cls(file)
+
+    @classmethod
+    def open_or_create(cls, path: Union[str, Path], crs: rasterio.crs.CRS, transform: Affine, width: int,
+                       height: int) -> 'DataCube':
+        """
+        Открывает куб для записи, если файла нет - создает его на сетке (crs, transform, width, height).
+        Сетка существующего куба не меняется.
+        """
+        if Path(path).is_file():
+            return cls.open(path, 'r+')
+        return cls.create(path, crs, transform, width, height)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    # endregion
+
+    # region сетка и индекс
+
+    @property
+    def crs(self) -> rasterio.crs.CRS:
+        return rasterio.crs.CRS.from_wkt(self._file.attrs['crs'])
+
+    @property
+    def transform(self) -> Affine:
+        return Affine(*self._file.attrs['transform'])
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self._file['ndvi'].shape[1:]
+
+    @property
+    def bounds(self) -> Tuple[float, float, float, float]:
+        transform, (height, width) = self.transform, self.shape
+        return transform.c, transform.f + transform.e * height, transform.c + transform.a * width, transform.f
+
+    @property
+    def dates(self) -> List[date]:
+        return [date.fromordinal(int(t)) for t in self._file['time'][:]]
+
+    @property
+    def sources(self) -> List[Tuple[int, str]]:
+        """
+        :return: записи композитов срезов: пары (id, путь к файлу)
+        """
+        return list(zip(self._file['source_id'][:].tolist(),
+                        (s.decode() if isinstance(s, bytes) else s for s in self._file['source'][:])))
+
+    def time_index(self, dt: date) -> Optional[int]:
+        """
+        :return: номер среза за дату или None, если среза нет
+        """
+        indices = np.flatnonzero(self._file['time'][:] == dt.toordinal())
+        return int(indices[-1]) if len(indices) else None
+
+    def index(self, xs: Iterable[float], ys: Iterable[float]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Строки и столбцы сетки для координат в проекции куба (точки вне сетки получают -1)
+        """
+        cols, rows = ~self.transform * (np.asarray(xs, 'float64'), np.asarray(ys, 'float64'))
+        rows, cols = np.floor(rows).astype('int64'), np.floor(cols).astype('int64')
+        height, width = self.shape
+        outside = (rows < 0) | (rows >= height) | (cols < 0) | (cols >= width)
+        rows[outside] = -1
+        cols[outside] = -1
+        return rows, cols
+
+    # endregion
+
+    # region запись
+
+    def append(self, dt: date, ndvi_file: Union[str, Path], source_id: int = None, count_band: int = None,
+               ndvi_band: int = 1):
+        """
+        Добавляет композит за дату в конец куба, если срез за дату уже есть - перезаписывает его. Композит
+        приводится к сетке куба (ближайший сосед) и записывается полосами по высоте чанка, целиком
+        в память не читается.
+
+        :param dt: дата среза
+        :param ndvi_file: композит NDVI
+        :param source_id: id записи композита в БД
+        :param count_band: канал композита с количеством безоблачных наблюдений, None - количество неизвестно
+        :param ndvi_band: канал композита с NDVI
+        """
+        t = self.time_index(dt)
+        new = t is None
+        if new:
+            t = self._file['time'].shape[0]
+            for name in ('time', 'source_id', 'source', *VARIABLES):
+                self._file[name].resize(t + 1, axis=0)
+        self._file['time'][t] = dt.toordinal()
+        self._file['source_id'][t] = -1 if source_id is None else source_id
+        self._file['source'][t] = str(ndvi_file)
+
+        height, width = self.shape
+        bands = (ndvi_band,) if count_band is None else (ndvi_band, count_band)
+        for rows, data in read_on_grid(ndvi_file, self.crs, self.transform, width, height, bands,
+                                       self._file['ndvi'].chunks[1]):
+            ndvi = data[0]
+            # пустые полосы нового среза не записываются - в них и так значения по умолчанию,
+            # а чанки без данных не занимают места в файле
+            if new and np.isnan(ndvi).all():
+                continue
+            self._file['ndvi'][t, rows] = ndvi
+            self._file['clouds'][t, rows] = (ndvi == _NDVI_CLOUD_VALUE).astype('uint8')
+            if count_band is not None:
+                count = data[1]
+                self._file['count'][t, rows] = np.where(np.isnan(count), COUNT_UNKNOWN,
+                                                        np.clip(count, 0, COUNT_UNKNOWN - 1)).astype('uint8')
+            elif not new:
+                self._file['count'][t, rows] = COUNT_UNKNOWN
+        self._file.flush()
+
+    # endregion
+
+    # region чтение
+
+    def read_day(self, dt: date, variable: str = 'ndvi', window: Window = None) -> Optional[np.ndarray]:
+        """
+        :return: срез переменной за дату (или его окно) или None, если среза нет
+        """
+        t = self.time_index(dt)
+        if t is None:
+            return None
+        if window is None:
+            return self._file[variable][t]
+        rows, cols = window.toslices()
+        return self._file[variable][t, rows, cols]
+
+    def _time_selection(self, starts_at: date = None, ends_at: date = None) -> np.ndarray:
+        """
+        Номера срезов в периоде, отсортированные по дате
+        """
+        time = self._file['time'][:]
+        mask = np.ones(time.shape, bool)
+        if starts_at is not None:
+            mask &= time >= starts_at.toordinal()
+        if ends_at is not None:
+            mask &= time <= ends_at.toordinal()
+        indices = np.flatnonzero(mask)
+        return indices[np.argsort(time[indices], kind='stable')]
+
+    def read_window(self, window: Window, starts_at: date = None, ends_at: date = None,
+                    variable: str = 'ndvi') -> Tuple[List[date], np.ndarray]:
+        """
+        Окно переменной за период одним чтением
+
+        :return: даты срезов и массив значений (дата, строка, столбец)
+        """
+        dataset = self._file[variable]
+        indices = self._time_selection(starts_at, ends_at)
+        dates = [date.fromordinal(int(t)) for t in self._file['time'][:][indices]]
+        rows, cols = window.toslices()
+        if len(indices) == 0:
+            return dates, np.empty((0, int(window.height), int(window.width)), dataset.dtype)
+        t_start, t_end = int(indices.min()), int(indices.max()) + 1
+        return dates, dataset[t_start:t_end, rows, cols][indices - t_start]
+
+    def read_pixels(self, rows: Iterable[int], cols: Iterable[int], starts_at: date = None, ends_at: date = None,
+                    variable: str = 'ndvi') -> Tuple[List[date], np.ndarray]:
+        """
+        Временные ряды пикселей. Пиксели группируются по чанкам, для каждой группы читается один блок
+        (время x чанк), поэтому тысячи точек на одном поле читаются несколькими чтениями.
+
+        :param rows: строки пикселей (-1 - пиксель вне сетки, его значения - значение по умолчанию переменной)
+        :param cols: столбцы пикселей
+        :return: даты срезов и массив значений (дата, пиксель)
+        """
+        rows, cols = np.asarray(rows, 'int64'), np.asarray(cols, 'int64')
+        dataset = self._file[variable]
+        indices = self._time_selection(starts_at, ends_at)
+        dates = [date.fromordinal(int(t)) for t in self._file['time'][:][indices]]
+        values = np.full((len(indices), len(rows)), VARIABLES[variable][1], dataset.dtype)
+        if len(indices) == 0 or len(rows) == 0:
+            return dates, values
+
+        t_start, t_end = int(indices.min()), int(indices.max()) + 1
+        _, chunk_rows, chunk_cols = dataset.chunks
+        inside = np.flatnonzero(rows >= 0)
+        tiles = (rows[inside] // chunk_rows) * (dataset.shape[2] // chunk_cols + 1) + cols[inside] // chunk_cols
+        for tile in np.unique(tiles):
+            points = inside[tiles == tile]
+            r0, c0 = rows[points].min(), cols[points].min()
+            r1, c1 = rows[points].max() + 1, cols[points].max() + 1
+            block = dataset[t_start:t_end, r0:r1, c0:c1]
+            values[:, points] = block[indices - t_start][:, rows[points] - r0, cols[points] - c0]
+        return dates, values
+
+    # endregion
@@ -0,0 +1,220 @@
+"""
+metrics.py собирает показатели этапов обработки (время, процессорное время, пиковый RSS, объем чтения/записи,
+количество пикселей на входе и выходе) и выгружает их в формате Prometheus (textfile collector) и JSON lines.
+
+Этапы отмечаются хуками NPPProcessor._on_before_processing и _on_after_processing.
+"""
+import json
+import os
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Iterable, List, Optional, Union
+
+import h5py
+import rasterio
+from loguru import logger
+
+# поля записи, которые выгружаются в Prometheus как суммы по этапам
+_SUMMED_FIELDS = (
+    'wall_seconds',
+    'cpu_seconds',
+    'bytes_read',
+    'bytes_written',
+    'input_pixels',
+    'output_pixels',
+)
+
+
+def _read_proc_io():
+    """
+    Количество байт, прочитанных и записанных процессом (включая чтение из кэша ФС), из /proc/self/io
+    """
+    try:
+        values = {}
+        with open('/proc/self/io') as f:
+            for line in f:
+                key, value = line.split(':', 1)
+                values[key] = int(value)
+        return values.get('rchar', 0), values.get('wchar', 0)
+    except (OSError, ValueError):
+        return 0, 0
+
+
+def _reset_peak_rss():
+    # "5" в clear_refs сбрасывает пиковый RSS (VmHWM) процесса (Linux)
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def _peak_rss_mb() -> Optional[float]:
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def count_pixels(path: Union[str, Path]) -> Optional[int]:
+    """
+    Количество пикселей в файле: для растров - ширина * высота * количество каналов (читается только заголовок),
+    для HDF5 - размер самого большого двумерного датасета (т. е. количество точек снимка).
+
+    :return: количество пикселей или None, если файл не найден или не поддерживается
+    """
+    path = str(path)
+    if not os.path.isfile(path):
+        return None
+    try:
+        if path.endswith('.h5'):
+            sizes = []
+            with h5py.File(path, 'r') as f:
+                f.visititems(lambda _, obj: sizes.append(obj.size)
+                             if isinstance(obj, h5py.Dataset) and obj.ndim == 2 else None)
+            return max(sizes) if sizes else None
+        with rasterio.open(path) as f:
+            return f.width * f.height * f.count
+    except Exception:
+        return None
+
+
+class _Frame:
+    __slots__ = ('key', 'tags', 'inputs', 'started_at', 'wall', 'cpu', 'io', 'child_peak', 'failed')
+
+    def __init__(self, key, inputs, tags):
+        self.key = key
+        self.tags = tags
+        self.inputs = inputs
+        self.started_at = datetime.now()
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        self.io = _read_proc_io()
+        self.child_peak = None
+        self.failed = False
+
+
+class MetricsCollector:
+    """
+    Собирает показатели этапов. Этапы могут быть вложенными (например, маска облачности внутри NDVI),
+    пиковый RSS внешнего этапа учитывает пики вложенных.
+    """
+
+    def __init__(self):
+        self._frames: List[_Frame] = []
+        self.records: List[dict] = []
+
+    def start(self, name, stage: str, inputs: Iterable = None, **tags):
+        """
+        :param name: имя выходного файла (или папки) этапа
+        :param stage: тип этапа (VIMGO, ndvi, merged_ndvi, ...)
+        :param inputs: входные файлы этапа, для подсчета количества входных пикселей
+        :param tags: дополнительные метки записи: swath_id, region, date
+        """
+        self._frames.append(_Frame((str(name), stage), list(inputs or ()), tags))
+        _reset_peak_rss()
+
+    def mark_failed(self):
+        if self._frames:
+            self._frames[-1].failed = True
+
+    def finish(self, name, stage: str) -> Optional[dict]:
+        key = (str(name), stage)
+        index = next((i for i in range(len(self._frames) - 1, -1, -1) if self._frames[i].key == key), None)
+        if index is None:
+            logger.warning(f'этап {stage} @ {name} завершен, но не был начат')
+            return None
+        # этапы, которые были начаты после этого, но не завершились (из-за исключения)
+        while len(self._frames) > index + 1:
+            abandoned = self._frames[-1]
+            abandoned.failed = True
+            self._record(abandoned)
+        return self._record(self._frames[index])
+
+    def _record(self, frame: _Frame) -> dict:
+        self._frames.remove(frame)
+        peak = _peak_rss_mb()
+        if peak is not None and frame.child_peak is not None:
+            peak = max(peak, frame.child_peak)
+        if self._frames and peak is not None:
+            parent = self._frames[-1]
+            parent.child_peak = peak if parent.child_peak is None else max(parent.child_peak, peak)
+        bytes_read, bytes_written = _read_proc_io()
+        input_pixels = [count_pixels(path) for path in frame.inputs]
+        date = frame.tags.get('date')
+        record = {
+            'stage': frame.key[1],
+            'output': frame.key[0],
+            'swath_id': frame.tags.get('swath_id'),
+            'region': frame.tags.get('region'),
+            'date': date.strftime('%Y-%m-%d') if date is not None else None,
+            'started_at': frame.started_at.isoformat(timespec='seconds'),
+            'wall_seconds': time.perf_counter() - frame.wall,
+            'cpu_seconds': time.process_time() - frame.cpu,
+            'peak_rss_mb': peak,
+            'bytes_read': bytes_read - frame.io[0],
+            'bytes_written': bytes_written - frame.io[1],
+            'input_pixels': sum(v for v in input_pixels if v is not None) if any(input_pixels) else None,
+            'output_pixels': count_pixels(frame.key[0]),
+            'success': not frame.failed,
+        }
+        self.records.append(record)
+        return record
+
+    def write_jsonl(self, path: Union[str, Path]):
+        with open(path, 'a') as f:
+            for record in self.records:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    def write_prometheus(self, path: Union[str, Path]):
+        """
+        Записывает показатели последнего запуска в формате textfile collector (node_exporter),
+        файл заменяется атомарно.
+        """
+        stages = {}
+        for record in self.records:
+            entry = stages.setdefault(record['stage'], {'count': 0, 'failed': 0, 'wall_seconds_max': 0.,
+                                                        'peak_rss_mb_max': 0., **dict.fromkeys(_SUMMED_FIELDS, 0)})
+            entry['count'] += 1
+            entry['failed'] += 0 if record['success'] else 1
+            entry['wall_seconds_max'] = max(entry['wall_seconds_max'], record['wall_seconds'])
+            entry['peak_rss_mb_max'] = max(entry['peak_rss_mb_max'], record['peak_rss_mb'] or 0.)
+            for field in _SUMMED_FIELDS:
+                entry[field] += record[field] or 0
+
+        lines = [
+            '# HELP viirs_processor_last_run_timestamp_seconds время окончания последнего запуска',
+            '# TYPE viirs_processor_last_run_timestamp_seconds gauge',
+            f'viirs_processor_last_run_timestamp_seconds {time.time():.0f}',
+        ]
+        metrics = (
+            ('stage_runs', 'count', 'количество выполнений этапа'),
+            ('stage_failures', 'failed', 'количество выполнений этапа с ошибкой'),
+            ('stage_wall_seconds', 'wall_seconds', 'суммарное время этапа'),
+            ('stage_wall_seconds_max', 'wall_seconds_max', 'максимальное время одного выполнения этапа'),
+            ('stage_cpu_seconds', 'cpu_seconds', 'суммарное процессорное время этапа'),
+            ('stage_peak_rss_bytes', 'peak_rss_mb_max', 'максимальный пиковый RSS этапа'),
+            ('stage_read_bytes', 'bytes_read', 'прочитано байт'),
+            ('stage_written_bytes', 'bytes_written', 'записано байт'),
+            ('stage_input_pixels', 'input_pixels', 'пикселей на входе'),
+            ('stage_output_pixels', 'output_pixels', 'пикселей на выходе'),
+        )
+        for metric, field, description in metrics:
+            lines.append(f'# HELP viirs_processor_{metric} {description}')
+            lines.append(f'# TYPE viirs_processor_{metric} gauge')
+            for stage, entry in sorted(stages.items()):
+                value = entry[field] * 2 ** 20 if field == 'peak_rss_mb_max' else entry[field]
+                lines.append(f'viirs_processor_{metric}{{stage="{stage}"}} {value}')
+
+        tmp_path = str(path) + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, path)
+
+    def clear(self):
+        self.records = []
@@ -0,0 +1,158 @@
+"""
+profiling.py - профилирование этапов обработки (cProfile и tracemalloc) для поиска медленных и прожорливых мест.
+
+Включается параметром PROFILE в конфигурации (или флагом --profile скриптов processor.py, maps_processor.py,
+products_processor.py). Если профилирование выключено, профайлер не создается и этапы выполняются как обычно.
+
+Для каждого профилируемого этапа в папке LOG_PATH/profiles создаются файлы:
+
+* {время}_{этап}__{выход}.pstats - статистика cProfile (открывается через pstats, snakeviz и т. п.);
+* {время}_{этап}__{выход}.txt - самые долгие функции и места, где выделено больше всего памяти.
+
+Хранятся последние PROFILE_KEEP отчетов каждого этапа.
+"""
+import cProfile
+import io
+import os
+import pstats
+import re
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+from typing import Iterable, List, Optional, Union
+
+from loguru import logger
+
+_TIME_FORMAT = '%Y%m%d_%H%M%S'
+
+# выделения памяти внутри самих tracemalloc и профайлера в отчет не попадают
+_TRACEMALLOC_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    tracemalloc.Filter(False, '<unknown>'),
+)
+
+
+class _ProfiledStage:
+    __slots__ = ('key', 'profile', 'snapshot', 'started_at', 'wall', 'own_tracing')
+
+    def __init__(self, key, own_tracing):
+        self.key = key
+        self.own_tracing = own_tracing
+        self.started_at = datetime.now()
+        # tracemalloc.reset_peak есть только с python 3.9: если трассировку включил профайлер, пик считается
+        # с начала этапа, иначе - с начала трассировки
+        self.snapshot = tracemalloc.take_snapshot().filter_traces(_TRACEMALLOC_FILTERS)
+        self.profile = cProfile.Profile()
+        self.wall = time.perf_counter()
+        self.profile.enable()
+
+
+class StageProfiler:
+    """
+    Профилирует этапы обработки, отмеченные хуками NPPProcessor._on_before_processing и _on_after_processing.
+
+    cProfile не может профилировать вложенные этапы одновременно, поэтому профилируется только внешний
+    из выбранных этапов, вложенные этапы входят в его отчет.
+    """
+
+    def __init__(self, output_dir: Union[str, Path], stages: Optional[Iterable[str]] = None, keep: int = 20,
+                 top: int = 30):
+        """
+        :param output_dir: папка для отчетов
+        :param stages: типы этапов (GIMGO, ndvi, merged_ndvi, map, ...), которые нужно профилировать,
+            None - все этапы
+        :param keep: количество отчетов каждого этапа, которые хранятся в папке
+        :param top: количество функций и мест выделения памяти в текстовом отчете
+        """
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.stages = None if stages is None else set(stages)
+        self.keep = keep
+        self.top = top
+        self._active: Optional[_ProfiledStage] = None
+        self.reports: List[Path] = []
+
+    def start(self, name, stage: str):
+        if self._active is not None or (self.stages is not None and stage not in self.stages):
+            return
+        own_tracing = not tracemalloc.is_tracing()
+        if own_tracing:
+            tracemalloc.start()
+        try:
+            self._active = _ProfiledStage((str(name), stage), own_tracing)
+        except ValueError as exc:
+            # другой профайлер уже включен (например, программа запущена под cProfile)
+            logger.warning(f'не удалось включить профилирование этапа {stage}: {exc}')
+            if own_tracing:
+                tracemalloc.stop()
+
+    def finish(self, name, stage: str) -> Optional[Path]:
+        active = self._active
+        if active is None or active.key != (str(name), stage):
+            return None
+        active.profile.disable()
+        wall = time.perf_counter() - active.wall
+        self._active = None
+        _, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot().filter_traces(_TRACEMALLOC_FILTERS)
+        if active.own_tracing:
+            tracemalloc.stop()
+
+        try:
+            path = self._write_report(active, wall, peak, snapshot)
+        except Exception as exc:
+            logger.warning(f'не удалось сохранить профиль этапа {stage}: {exc}')
+            return None
+        self._remove_old_reports(stage)
+        logger.debug(f'профиль этапа {stage} сохранен: {path}')
+        return path
+
+    def close(self):
+        """
+        Завершает профилирование незавершенного этапа (например, прерванного исключением)
+        """
+        if self._active is not None:
+            self.finish(*self._active.key)
+
+    def _write_report(self, active: _ProfiledStage, wall, peak, snapshot) -> Path:
+        output, stage = active.key
+        output_name = re.sub(r'[^\w.-]+', '_', os.path.basename(output.rstrip('/\\')))[:80]
+        base = self.output_dir / f'{active.started_at.strftime(_TIME_FORMAT)}_{stage}__{output_name}'
+        pstats_path = base.with_name(base.name + '.pstats')
+        active.profile.dump_stats(str(pstats_path))
+
+        stats_text = io.StringIO()
+        stats = pstats.Stats(active.profile, stream=stats_text)
+        stats.strip_dirs().sort_stats(pstats.SortKey.CUMULATIVE).print_stats(self.top)
+
+        lines = [
+            f'этап: {stage}',
+            f'выход: {output}',
+            f'начало: {active.started_at.isoformat(timespec="seconds")}',
+            f'время: {wall:.3f} s',
+            f'пик памяти (tracemalloc): {peak / 2 ** 20:.1f} MB'
+            + ('' if active.own_tracing else ' (с начала трассировки, включенной до этапа)'),
+            '',
+            f'== больше всего памяти выделено и не освобождено к концу этапа (top {self.top}) ==',
+        ]
+        for diff in snapshot.compare_to(active.snapshot, 'lineno')[:self.top]:
+            lines.append(str(diff))
+        lines += ['', f'== функции по суммарному времени (top {self.top}) ==', stats_text.getvalue()]
+        base.with_name(base.name + '.txt').write_text('\n'.join(lines))
+        self.reports.append(pstats_path)
+        return pstats_path
+
+    def _remove_old_reports(self, stage: str):
+        if self.keep is None:
+            return
+        prefix_length = len(datetime.now().strftime(_TIME_FORMAT)) + 1
+        reports = [p for p in self.output_dir.glob('*.pstats') if p.name[prefix_length:].startswith(f'{stage}__')]
+        reports.sort(key=lambda p: p.stat().st_mtime, reverse=True)
+        for path in reports[self.keep:]:
+            for old in (path, path.with_suffix('.txt')):
+                try:
+                    old.unlink()
+                except FileNotFoundError:
+                    pass
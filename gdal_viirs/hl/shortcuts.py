@@ -1,3 +1,4 @@
+import argparse
 import sys
 from contextlib import contextmanager
 
@@ -7,7 +8,7 @@ import peewee
 from gdal_viirs import misc
 from gdal_viirs.config import load_config, ConfigWrapper
 from gdal_viirs.hl import NPPProcessor
-from gdal_viirs.persistence.models import db_proxy, PEEWEE_MODELS
+from gdal_viirs.persistence.models import db_proxy, PEEWEE_MODELS, SQLITE_PRAGMAS
 
 
 def _set_debug_off():
@@ -15,9 +16,28 @@ def _set_debug_off():
     loguru.logger.add(sys.stdout, colorize=True, level='INFO')
 
 
+def parse_cli_args(args=None) -> argparse.Namespace:
+    """
+    Разбирает аргументы командной строки скриптов processor.py, maps_processor.py и products_processor.py
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--profile', nargs='*', metavar='STAGE',
+                        help='профилировать этапы обработки (все, если этапы не указаны), см. PROFILE в конфигурации')
+    parsed = parser.parse_args(args)
+    if parsed.profile is not None:
+        parsed.profile = parsed.profile or True
+    return parsed
+
+
 @contextmanager
-def setup_env(config):
+def setup_env(config, profile=None):
+    """
+    :param config: модуль конфигурации, строка для импорта или словарь
+    :param profile: если указан, заменяет значение PROFILE в конфигурации
+    """
     config = load_config(config)
+    if profile is not None:
+        config['PROFILE'] = profile
 
     try:
         # config directory
@@ -25,7 +45,10 @@ def setup_env(config):
         config_dir.mkdir(parents=True, exist_ok=True)
 
         # db
-        db = peewee.SqliteDatabase(str(config_dir / 'viirs_processor.db'))
+        # WAL и busy_timeout, см. SQLITE_PRAGMAS, параметры можно переопределить через DB_PRAGMAS в конфигурации
+        pragmas = {**SQLITE_PRAGMAS, **(config.get('DB_PRAGMAS') or {})}
+        db = peewee.SqliteDatabase(str(config_dir / 'viirs_processor.db'), pragmas=pragmas,
+                                   timeout=pragmas['busy_timeout'] / 1000)
         db_proxy.initialize(db)
         db.create_tables(PEEWEE_MODELS)
 
@@ -47,16 +70,16 @@ def create_npp_processor(config: ConfigWrapper) -> NPPProcessor:
     return processor
 
 
-def process_recent(config):
-    with setup_env(config) as config:
+def process_recent(config, profile=None):
+    with setup_env(config, profile) as config:
         create_npp_processor(config).process_recent()
 
 
-def produce_products(config):
-    with setup_env(config) as config:
+def produce_products(config, profile=None):
+    with setup_env(config, profile) as config:
         create_npp_processor(config).produce_products()
 
 
-def produce_maps(config):
-    with setup_env(config) as config:
+def produce_maps(config, profile=None):
+    with setup_env(config, profile) as config:
         create_npp_processor(config).produce_maps()
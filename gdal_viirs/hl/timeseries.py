@@ -0,0 +1,494 @@
+"""
+timeseries.py - временные ряды NDVI для точек и зональная статистика для полигонов за период.
+
+Продукты за период ищутся по каталогу растров (Footprint, см. CATALOG в конфигурации): открываются только
+растры, которые пересекают запрошенные объекты, и из них читаются только окна вокруг объектов. Точки
+и полигоны, попадающие в один блок растра (_BLOCK_SIZE x _BLOCK_SIZE пикселей), читаются одним чтением.
+Для композитов (merged_ndvi) даты, которые есть в датакубе (см. datacube.py), читаются из датакуба,
+а не из файлов композитов.
+
+Координаты точек и полигонов - долгота и широта (EPSG:4326), полигоны - GeoJSON геометрии (словари
+или объекты с __geo_interface__).
+
+Запуск из командной строки (результат - CSV):
+
+    python timeseries_query.py --point 84.95 56.48 --from 2021-05-01 --to 2021-09-30
+    python timeseries_query.py --geojson fields.geojson --from 2021-05-01 --to 2021-09-30 -o fields.csv
+"""
+import argparse
+import csv
+import json
+import sys
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import date, datetime, time
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import rasterio
+import rasterio.crs
+import rasterio.features
+import rasterio.warp
+from affine import Affine
+from loguru import logger
+from rasterio.windows import Window
+
+from gdal_viirs.hl import datacube as _datacube
+from gdal_viirs.persistence.models import Footprint
+
+WGS84 = rasterio.crs.CRS.from_epsg(4326)
+# значения облачных пикселей продуктов (см. process.calc_ndvi и process.process_ndvi_dynamics)
+CLOUD_VALUES = {
+    'ndvi': -2,
+    'merged_ndvi': -2,
+    'ndvi_dynamics': -999,
+}
+ZONAL_STATISTICS = ('mean', 'median', 'min', 'max', 'count', 'cloud_fraction')
+
+_BLOCK_SIZE = 256
+
+
+@dataclass
+class QueryResult:
+    """
+    Результат запроса: значения для каждого продукта (даты) и объекта (точки или полигона)
+    """
+    # дата продукта (конец периода, за который он получен)
+    dates: List[datetime]
+    # файл продукта или датакуб, из которого прочитаны значения
+    sources: List[str]
+    # название значения -> массив (дата, объект)
+    values: Dict[str, np.ndarray]
+
+    def rows(self, features: Sequence = None) -> Iterator[dict]:
+        """
+        Строки для таблицы: дата, источник, объект и значения
+
+        :param features: названия объектов, по умолчанию - номера
+        """
+        for i, (dt, source) in enumerate(zip(self.dates, self.sources)):
+            for j in range(self.values_count):
+                row = {'date': dt.isoformat(sep=' '), 'source': source,
+                       'feature': features[j] if features is not None else j}
+                for name, values in self.values.items():
+                    row[name] = values[i, j].item()
+                yield row
+
+    @property
+    def values_count(self) -> int:
+        return next(iter(self.values.values())).shape[1] if self.values else 0
+
+
+# region общие функции
+
+def _as_datetime(value: Union[date, datetime], end: bool = False) -> datetime:
+    """
+    Дата без времени означает начало дня или, если end, конец дня
+    """
+    if isinstance(value, datetime):
+        return value
+    return datetime.combine(value, time.max if end else time.min)
+
+
+def _block_groups(rows: np.ndarray, cols: np.ndarray, block_size: int = _BLOCK_SIZE) -> Iterator[np.ndarray]:
+    """
+    Номера точек (строка, столбец >= 0), сгруппированные по блокам block_size x block_size
+    """
+    inside = np.flatnonzero((rows >= 0) & (cols >= 0))
+    if len(inside) == 0:
+        return
+    keys = np.stack([rows[inside] // block_size, cols[inside] // block_size], axis=1)
+    _, inverse = np.unique(keys, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    order = np.argsort(inverse, kind='stable')
+    yield from np.split(inside[order], np.flatnonzero(np.diff(inverse[order])) + 1)
+
+
+def _pixel_index(transform: Affine, width: int, height: int, xs, ys) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Строки и столбцы растра для координат (точки вне растра получают -1)
+    """
+    cols, rows = ~transform * (np.asarray(xs, 'float64'), np.asarray(ys, 'float64'))
+    rows, cols = np.floor(rows).astype('int64'), np.floor(cols).astype('int64')
+    outside = (rows < 0) | (rows >= height) | (cols < 0) | (cols >= width)
+    rows[outside] = -1
+    cols[outside] = -1
+    return rows, cols
+
+
+def _geometry_windows(geometries: List[dict], transform: Affine, width: int, height: int) -> List[Optional[Window]]:
+    """
+    Окна растра, покрывающие геометрии (None - геометрия не пересекает растр)
+    """
+    windows = []
+    for geometry in geometries:
+        xmin, ymin, xmax, ymax = rasterio.features.bounds(geometry)
+        col0, row0 = ~transform * (xmin, ymax)
+        col1, row1 = ~transform * (xmax, ymin)
+        col0, col1 = sorted((col0, col1))
+        row0, row1 = sorted((row0, row1))
+        col0, row0 = max(int(np.floor(col0)), 0), max(int(np.floor(row0)), 0)
+        col1, row1 = min(int(np.ceil(col1)), width), min(int(np.ceil(row1)), height)
+        windows.append(Window(col0, row0, col1 - col0, row1 - row0) if col1 > col0 and row1 > row0 else None)
+    return windows
+
+
+def _zonal_statistics(values: np.ndarray, cloud_value: float, statistics: Sequence[str]) -> Dict[str, np.ndarray]:
+    """
+    Статистика по пикселям полигона
+
+    :param values: значения пикселей, массив (дата, пиксель)
+    :return: статистика -> массив (дата,)
+    """
+    clouds = values == cloud_value
+    valid = ~np.isnan(values) & ~clouds
+    count = np.count_nonzero(valid, axis=1)
+    observed = count + np.count_nonzero(clouds, axis=1)
+    data = np.where(valid, values, np.nan)
+    empty = np.full(values.shape[0], np.nan, 'float32')
+    result = {}
+    with warnings.catch_warnings(), np.errstate(invalid='ignore', divide='ignore'):
+        # полигоны без данных получают NaN, предупреждения numpy об этом не нужны
+        warnings.simplefilter('ignore', RuntimeWarning)
+        for name in statistics:
+            if name == 'count':
+                result[name] = count.astype('float32')
+            elif name == 'cloud_fraction':
+                result[name] = np.where(observed > 0, np.count_nonzero(clouds, axis=1) / np.maximum(observed, 1),
+                                        np.nan).astype('float32')
+            elif values.shape[1] == 0:
+                result[name] = empty
+            else:
+                result[name] = getattr(np, f'nan{name}')(data, axis=1).astype('float32')
+    return result
+
+
+def _union_window(windows: Sequence[Window]) -> Window:
+    row0 = min(w.row_off for w in windows)
+    col0 = min(w.col_off for w in windows)
+    row1 = max(w.row_off + w.height for w in windows)
+    col1 = max(w.col_off + w.width for w in windows)
+    return Window(col0, row0, col1 - col0, row1 - row0)
+
+
+def _polygon_groups(windows: List[Optional[Window]]) -> Iterator[Tuple[np.ndarray, Window]]:
+    """
+    Полигоны, сгруппированные по блоку левого верхнего угла их окна, и окно, покрывающее группу
+    """
+    rows = np.array([w.row_off if w is not None else -1 for w in windows], 'int64')
+    cols = np.array([w.col_off if w is not None else -1 for w in windows], 'int64')
+    for group in _block_groups(rows, cols):
+        yield group, _union_window([windows[i] for i in group])
+
+
+def _polygon_masks(geometries: List[dict], windows: List[Optional[Window]], group: np.ndarray, window: Window,
+                   transform: Affine) -> Iterator[Tuple[int, Tuple[slice, slice], np.ndarray]]:
+    """
+    Маски полигонов группы внутри общего окна: номер полигона, срезы его окна в общем окне и маска пикселей
+    """
+    for i in group:
+        w = windows[i]
+        slices = (slice(w.row_off - window.row_off, w.row_off - window.row_off + w.height),
+                  slice(w.col_off - window.col_off, w.col_off - window.col_off + w.width))
+        inside = ~rasterio.features.geometry_mask([geometries[i]], (w.height, w.width),
+                                                  rasterio.windows.transform(w, transform))
+        yield i, slices, inside
+
+# endregion
+
+
+# region чтение продуктов
+
+def _find_products(kind: str, starts_at: datetime, ends_at: datetime, project) -> List[Tuple[Footprint, object]]:
+    """
+    Продукты из каталога, пересекающие объекты, и объекты в проекции каждого продукта
+
+    :param project: функция (crs) -> (объекты в проекции crs, границы объектов)
+    """
+    crs_list = [row.crs for row in Footprint.select(Footprint.crs).where(Footprint.kind == kind).distinct()]
+    products = []
+    for crs_wkt in crs_list:
+        if not crs_wkt:
+            continue
+        projected, bounds = project(rasterio.crs.CRS.from_wkt(crs_wkt))
+        if bounds is None:
+            continue
+        query = Footprint.find(kind, bounds=bounds) \
+            .where(Footprint.crs == crs_wkt, Footprint.ends_at >= starts_at, Footprint.ends_at <= ends_at)
+        products += [(record, projected) for record in query]
+    products.sort(key=lambda p: (p[0].ends_at, p[0].output_file))
+    return products
+
+
+def _read_points(path: str, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+    """
+    Значения первого канала растра в точках (NaN - точка вне растра или nodata)
+    """
+    values = np.full(len(xs), np.nan, 'float32')
+    with rasterio.open(path) as f:
+        rows, cols = _pixel_index(f.transform, f.width, f.height, xs, ys)
+        for points in _block_groups(rows, cols):
+            r0, c0 = rows[points].min(), cols[points].min()
+            window = Window(c0, r0, cols[points].max() + 1 - c0, rows[points].max() + 1 - r0)
+            data = f.read(1, window=window)
+            values[points] = data[rows[points] - r0, cols[points] - c0]
+        if f.nodata is not None and not np.isnan(f.nodata):
+            values[values == f.nodata] = np.nan
+    return values
+
+
+def _read_zones(path: str, geometries: List[dict], cloud_value: float,
+                statistics: Sequence[str]) -> Dict[str, np.ndarray]:
+    """
+    Зональная статистика первого канала растра
+
+    :return: статистика -> массив (полигон,)
+    """
+    result = {name: np.full(len(geometries), np.nan, 'float32') for name in statistics}
+    if 'count' in result:
+        result['count'][:] = 0
+    with rasterio.open(path) as f:
+        nodata = f.nodata if f.nodata is not None and not np.isnan(f.nodata) else None
+        windows = _geometry_windows(geometries, f.transform, f.width, f.height)
+        for group, window in _polygon_groups(windows):
+            data = f.read(1, window=window).astype('float32')
+            if nodata is not None:
+                data[data == nodata] = np.nan
+            for i, slices, inside in _polygon_masks(geometries, windows, group, window, f.transform):
+                zone = _zonal_statistics(data[slices][inside][np.newaxis], cloud_value, statistics)
+                for name, values in zone.items():
+                    result[name][i] = values[0]
+    return result
+
+
+def _read_datacube_points(cube: _datacube.DataCube, lons, lats, starts_at: datetime, ends_at: datetime,
+                          cloud_value: float):
+    xs, ys = rasterio.warp.transform(WGS84, cube.crs, lons, lats)
+    rows, cols = cube.index(xs, ys)
+    dates, values = cube.read_pixels(rows, cols, starts_at, ends_at)
+    return dates, {'value': np.where(values == cloud_value, np.nan, values),
+                   'cloudy': (values == cloud_value).astype('uint8')}
+
+
+def _read_datacube_zones(cube: _datacube.DataCube, geometries: List[dict], starts_at: datetime, ends_at: datetime,
+                         cloud_value: float, statistics: Sequence[str]):
+    crs = cube.crs
+    geometries = [rasterio.warp.transform_geom(WGS84, crs, g) for g in geometries]
+    (height, width), transform = cube.shape, cube.transform
+    windows = _geometry_windows(geometries, transform, width, height)
+    dates = sorted(d for d in cube.dates if starts_at.toordinal() <= d.toordinal() <= ends_at.toordinal())
+    result = {name: np.full((len(dates), len(geometries)), np.nan, 'float32') for name in statistics}
+    if 'count' in result:
+        result['count'][:] = 0
+    for group, window in _polygon_groups(windows):
+        dates, data = cube.read_window(window, starts_at, ends_at)
+        for i, slices, inside in _polygon_masks(geometries, windows, group, window, transform):
+            zone = _zonal_statistics(data[:, slices[0], slices[1]][:, inside], cloud_value, statistics)
+            for name, values in zone.items():
+                result[name][:, i] = values
+    return dates, result
+
+
+def _datacube_sources(cube: _datacube.DataCube) -> Dict[date, str]:
+    return {d: path for d, (_, path) in zip(cube.dates, cube.sources)}
+
+# endregion
+
+
+def _query(kind: str, starts_at, ends_at, datacube_file, workers, project, read_product, read_datacube,
+           empty: Dict[str, np.ndarray]):
+    """
+    Общая часть запросов: значения из датакуба (для merged_ndvi) и из продуктов каталога за остальные даты
+
+    :param empty: значения без дат (массивы (0, объект)) - типы и названия значений результата
+    """
+    starts_at, ends_at = _as_datetime(starts_at), _as_datetime(ends_at, end=True)
+    dates, sources, parts = [], [], [empty]
+
+    cube_dates = set()
+    if kind == 'merged_ndvi' and datacube_file is not None and Path(datacube_file).is_file():
+        with _datacube.DataCube.open(datacube_file) as cube:
+            cube_sources = _datacube_sources(cube)
+            days, values = read_datacube(cube, starts_at, ends_at)
+        cube_dates = set(days)
+        dates += [_as_datetime(d, end=True) for d in days]
+        sources += [cube_sources.get(d, str(datacube_file)) for d in days]
+        parts.append(values)
+
+    products = [(record, projected) for record, projected in _find_products(kind, starts_at, ends_at, project)
+                if record.ends_at.date() not in cube_dates]
+    missing = [record.output_file for record, _ in products if not Path(record.output_file).is_file()]
+    if missing:
+        logger.warning(f'{len(missing)} файлов {kind} есть в каталоге, но отсутствуют на диске, например: {missing[0]}')
+    products = [(record, projected) for record, projected in products if record.output_file not in missing]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        values = list(executor.map(lambda p: read_product(p[0].output_file, p[1]), products))
+    dates += [record.ends_at for record, _ in products]
+    sources += [record.output_file for record, _ in products]
+    if values:
+        parts.append({name: np.stack([v[name] for v in values]) for name in values[0]})
+
+    order = sorted(range(len(dates)), key=lambda i: (dates[i], sources[i]))
+    merged = {name: np.concatenate([part[name] for part in parts]).astype(values.dtype)[order]
+              for name, values in empty.items()}
+    return QueryResult([dates[i] for i in order], [sources[i] for i in order], merged)
+
+
+def query_points(lonlats: Sequence[Tuple[float, float]], starts_at: Union[date, datetime],
+                 ends_at: Union[date, datetime], kind: str = 'merged_ndvi',
+                 datacube_file: Union[str, Path] = None, workers: int = None) -> QueryResult:
+    """
+    Временные ряды продукта в точках. Значения: value - значение продукта (NaN - нет данных или облака),
+    cloudy - 1, если пиксель закрыт облаками.
+
+    :param lonlats: точки (долгота, широта)
+    :param starts_at: начало периода (дата без времени - с начала дня)
+    :param ends_at: конец периода включительно (дата без времени - до конца дня)
+    :param kind: тип продукта в каталоге: merged_ndvi, ndvi, ndvi_dynamics
+    :param datacube_file: датакуб, из которого читаются композиты (только для merged_ndvi)
+    :param workers: количество потоков для чтения файлов
+    """
+    lonlats = np.asarray(lonlats, 'float64').reshape(-1, 2)
+    lons, lats = lonlats[:, 0].tolist(), lonlats[:, 1].tolist()
+    cloud_value = CLOUD_VALUES.get(kind)
+
+    def project(crs):
+        if len(lons) == 0:
+            return None, None
+        xs, ys = rasterio.warp.transform(WGS84, crs, lons, lats)
+        return (np.asarray(xs), np.asarray(ys)), (min(xs), min(ys), max(xs), max(ys))
+
+    def read_product(path, projected):
+        values = _read_points(path, *projected)
+        cloudy = values == cloud_value
+        return {'value': np.where(cloudy, np.nan, values), 'cloudy': cloudy.astype('uint8')}
+
+    def read_datacube(cube, a, b):
+        return _read_datacube_points(cube, lons, lats, a, b, cloud_value)
+
+    empty = {'value': np.empty((0, len(lons)), 'float32'), 'cloudy': np.empty((0, len(lons)), 'uint8')}
+    return _query(kind, starts_at, ends_at, datacube_file, workers, project, read_product, read_datacube, empty)
+
+
+def query_polygons(geometries: Sequence, starts_at: Union[date, datetime], ends_at: Union[date, datetime],
+                   kind: str = 'merged_ndvi', statistics: Sequence[str] = ZONAL_STATISTICS,
+                   datacube_file: Union[str, Path] = None, workers: int = None) -> QueryResult:
+    """
+    Зональная статистика продукта по полигонам. Облачные пиксели в статистику значений не входят,
+    cloud_fraction - доля облаков среди пикселей с наблюдениями, count - количество безоблачных пикселей.
+
+    :param geometries: полигоны в координатах EPSG:4326 (GeoJSON словари или объекты с __geo_interface__)
+    :param statistics: статистики из ZONAL_STATISTICS
+    :param starts_at: начало периода (дата без времени - с начала дня)
+    :param ends_at: конец периода включительно (дата без времени - до конца дня)
+    :param kind: тип продукта в каталоге: merged_ndvi, ndvi, ndvi_dynamics
+    :param datacube_file: датакуб, из которого читаются композиты (только для merged_ndvi)
+    :param workers: количество потоков для чтения файлов
+    """
+    unknown = set(statistics) - set(ZONAL_STATISTICS)
+    if unknown:
+        raise ValueError(f'неизвестные статистики: {", ".join(sorted(unknown))}')
+    geometries = [getattr(g, '__geo_interface__', g) for g in geometries]
+    cloud_value = CLOUD_VALUES.get(kind)
+
+    def project(crs):
+        if len(geometries) == 0:
+            return None, None
+        projected = [rasterio.warp.transform_geom(WGS84, crs, g) for g in geometries]
+        bounds = [rasterio.features.bounds(g) for g in projected]
+        return projected, (min(b[0] for b in bounds), min(b[1] for b in bounds),
+                           max(b[2] for b in bounds), max(b[3] for b in bounds))
+
+    def read_product(path, projected):
+        return _read_zones(path, projected, cloud_value, statistics)
+
+    def read_datacube(cube, a, b):
+        return _read_datacube_zones(cube, geometries, a, b, cloud_value, statistics)
+
+    empty = {name: np.empty((0, len(geometries)), 'float32') for name in statistics}
+    return _query(kind, starts_at, ends_at, datacube_file, workers, project, read_product, read_datacube, empty)
+
+
+# region командная строка
+
+def _read_points_csv(path: str, delimiter: str = ';') -> Tuple[List[Tuple[float, float]], List[str]]:
+    """
+    Точки из CSV с колонками lon, lat и (необязательно) name
+    """
+    lonlats, names = [], []
+    with open(path, newline='') as f:
+        for i, row in enumerate(csv.DictReader(f, delimiter=delimiter)):
+            lonlats.append((float(row['lon']), float(row['lat'])))
+            names.append(row.get('name') or str(i))
+    return lonlats, names
+
+
+def _read_geojson(path: str) -> Tuple[List[dict], List[str]]:
+    """
+    Полигоны из GeoJSON (FeatureCollection, Feature или геометрия), названия - свойство name или id
+    """
+    with open(path) as f:
+        data = json.load(f)
+    features = data['features'] if data.get('type') == 'FeatureCollection' else [data]
+    geometries, names = [], []
+    for i, feature in enumerate(features):
+        if feature.get('type') == 'Feature':
+            properties = feature.get('properties') or {}
+            geometries.append(feature['geometry'])
+            names.append(str(properties.get('name', feature.get('id', i))))
+        else:
+            geometries.append(feature)
+            names.append(str(i))
+    return geometries, names
+
+
+def run_cli(config, args=None):
+    """
+    Запрос временных рядов из командной строки, результат записывается в CSV
+
+    :param config: модуль конфигурации, строка для импорта или словарь (нужны БД и путь к датакубу)
+    """
+    from gdal_viirs.hl.shortcuts import setup_env
+
+    parser = argparse.ArgumentParser(description='временные ряды NDVI для точек и полигонов')
+    parser.add_argument('--point', nargs=2, type=float, action='append', default=[], metavar=('LON', 'LAT'),
+                        help='точка (можно указать несколько раз)')
+    parser.add_argument('--points-csv', help='CSV (разделитель ;) с колонками lon, lat и name')
+    parser.add_argument('--geojson', help='полигоны в GeoJSON (EPSG:4326), по ним считается зональная статистика')
+    parser.add_argument('--from', dest='starts_at', required=True, type=date.fromisoformat, help='ГГГГ-ММ-ДД')
+    parser.add_argument('--to', dest='ends_at', required=True, type=date.fromisoformat, help='ГГГГ-ММ-ДД')
+    parser.add_argument('--kind', default='merged_ndvi', choices=sorted(CLOUD_VALUES))
+    parser.add_argument('--statistics', nargs='+', default=list(ZONAL_STATISTICS), choices=ZONAL_STATISTICS)
+    parser.add_argument('--no-datacube', action='store_true', help='не использовать датакуб')
+    parser.add_argument('-o', '--output', help='выходной CSV (по умолчанию - вывод в консоль)')
+    parsed = parser.parse_args(args)
+    if not parsed.geojson and not parsed.point and not parsed.points_csv:
+        parser.error('нужно указать точки (--point, --points-csv) или полигоны (--geojson)')
+
+    with setup_env(config) as config:
+        datacube_file = None if parsed.no_datacube else _datacube.get_datacube_file(config)
+        if parsed.geojson:
+            geometries, names = _read_geojson(parsed.geojson)
+            result = query_polygons(geometries, parsed.starts_at, parsed.ends_at, parsed.kind, parsed.statistics,
+                                    datacube_file)
+        else:
+            lonlats = [tuple(p) for p in parsed.point]
+            names = [f'{lon} {lat}' for lon, lat in lonlats]
+            if parsed.points_csv:
+                csv_lonlats, csv_names = _read_points_csv(parsed.points_csv)
+                lonlats += csv_lonlats
+                names += csv_names
+            result = query_points(lonlats, parsed.starts_at, parsed.ends_at, parsed.kind, datacube_file)
+
+    output = open(parsed.output, 'w', newline='') if parsed.output else sys.stdout
+    try:
+        writer = csv.DictWriter(output, ['date', 'source', 'feature', *result.values], delimiter=';')
+        writer.writeheader()
+        writer.writerows(result.rows(names))
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+# endregion
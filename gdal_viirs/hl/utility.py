@@ -6,7 +6,7 @@ from typing import List, Optional
 
 from loguru import logger
 
-from gdal_viirs.types import ViirsFileset
+from gdal_viirs.types import ViirsFileset, Bounds
 from gdal_viirs.utility import find_sdr_viirs_filesets
 
 
@@ -48,3 +48,27 @@ def find_npp_viirs_filesets(root_dir, **kwargs) -> List[NPPViirsFileset]:
 
 def today_folder_name():
     return datetime.now().strftime('%Y%m%d')
+
+
+def get_png_config_bounds(png_config, margin: float = 0) -> List[Bounds]:
+    """
+    Возвращает границы (xmin, ymin, xmax, ymax) каждого региона из PNG_CONFIG (по xlim и ylim),
+    расширенные на margin во все стороны
+    """
+    bounds = []
+    for entry in png_config:
+        xlim, ylim = entry['xlim'], entry['ylim']
+        bounds.append((
+            min(xlim) - margin, min(ylim) - margin,
+            max(xlim) + margin, max(ylim) + margin
+        ))
+    return bounds
+
+
+def union_bounds(bounds: List[Bounds]) -> Optional[Bounds]:
+    if len(bounds) == 0:
+        return None
+    return (
+        min(b[0] for b in bounds), min(b[1] for b in bounds),
+        max(b[2] for b in bounds), max(b[3] for b in bounds)
+    )
@@ -1,3 +1,4 @@
+import math
 import os
 import time
 from functools import lru_cache
@@ -15,6 +16,8 @@ from matplotlib import pyplot, patches, offsetbox, patheffects
 from matplotlib.colors import to_rgb
 from matplotlib.ticker import Formatter
 from rasterio import DatasetReader
+from rasterio.enums import Resampling
+from rasterio.windows import Window
 
 from gdal_viirs import misc
 from gdal_viirs.maps.utils import CARTOPY_LCC, get_lonlat_lim_range
@@ -24,6 +27,7 @@ _CM = 1 / 2.54
 
 __all__ = (
     'build_figure',
+    'get_lims_window',
     'MapBuilder'
 )
 
@@ -211,6 +215,24 @@ def build_figure(data, axes, crs, *, xlim: Tuple[Number, Number] = None, ylim: T
     return axes
 
 
+def get_lims_window(file: DatasetReader, xlim: Tuple[Number, Number],
+                    ylim: Tuple[Number, Number]) -> Optional[Window]:
+    """
+    Окно растра (целые пиксели), которое покрывает границы xlim и ylim, обрезанное по размеру растра.
+
+    :return: окно или None, если границы не пересекаются с растром
+    """
+    inverse = ~file.transform
+    cols, rows = zip(*(inverse * (x, y) for x in xlim for y in ylim))
+    col_start = max(0, math.floor(min(cols)))
+    row_start = max(0, math.floor(min(rows)))
+    col_end = min(file.width, math.ceil(max(cols)))
+    row_end = min(file.height, math.ceil(max(rows)))
+    if col_end <= col_start or row_end <= row_start:
+        return None
+    return Window(col_start, row_start, col_end - col_start, row_end - row_start)
+
+
 def plot_marks(points: dict, crs, ax, ec='k', fc='white', props=None):
     plate_carree = cartopy.crs.PlateCarree()
     annotations = []
@@ -253,6 +275,12 @@ class MapBuilder:
     agro_mask_shp_file = None
     water_shp_file = None
     layers = None
+    # читать только часть растра в границах карты и, если пиксель растра мельче пикселя изображения,
+    # читать растр с прореживанием (при наличии обзоров GDAL берет данные из них)
+    windowed_read = False
+    # nearest сохраняет значения пикселей (облака, NaN, классы NDVI), а доли классов в легенде
+    # остаются несмещенными; mode для непрерывных значений NDVI вырождается и завышает долю облаков
+    resampling = Resampling.nearest
 
     def __init__(self, file: DatasetReader, band=1, **kwargs):
         self.points = {}
@@ -276,9 +304,36 @@ class MapBuilder:
 
     def read_data(self):
         if not hasattr(self, '_data'):
-            setattr(self, '_data', self.file.read(self.band))
+            if self.windowed_read:
+                data, transform = self._read_window()
+            else:
+                data, transform = self.file.read(self.band), self.file.transform
+            setattr(self, '_data', data)
+            setattr(self, '_data_transform', transform)
         return getattr(self, '_data')
 
+    def _read_window(self):
+        """
+        Читает часть растра в границах карты (_lims) с разрешением не выше, чем у изображения растра на карте.
+
+        :return: данные и их трансформация
+        """
+        window = get_lims_window(self.file, *self._lims)
+        if window is None:
+            logger.warning('границы карты не пересекаются с растром, растр будет прочитан целиком')
+            return self.file.read(self.band), self.file.transform
+
+        transform = self.file.window_transform(window)
+        image_size, _ = self._raster_size_rect
+        step = int(min(window.width / (image_size[0] * self.dpi), window.height / (image_size[1] * self.dpi)))
+        if step < 2:
+            return self.file.read(self.band, window=window), transform
+
+        out_shape = math.ceil(window.height / step), math.ceil(window.width / step)
+        data = self.file.read(self.band, window=window, out_shape=out_shape, resampling=self.resampling)
+        transform = transform * transform.scale(window.width / out_shape[1], window.height / out_shape[0])
+        return data, transform
+
     def _get_font_props(self, **kwargs):
         if self.font_family:
             if os.path.isfile(self.font_family):
@@ -314,7 +369,7 @@ class MapBuilder:
 
     def _build_figure(self, data, crs, ax1, xlim, ylim):
         build_figure(data, ax1, crs, cmap=self.cmap, norm=self.norm, xlim=xlim, ylim=ylim,
-                     transform=self.file.transform,
+                     transform=getattr(self, '_data_transform', self.file.transform),
                      water_shp_file=self.water_shp_file,
                      layers=self.layers)
 
@@ -0,0 +1,50 @@
+import numpy as np
+from matplotlib import patches
+from matplotlib.colors import ListedColormap, BoundaryNorm
+
+from gdal_viirs.maps.rcpod import RCPODMapBuilder
+
+# границы классов отклонения NDVI от нормы (канал anomaly, см. gdal_viirs.hl.climatology)
+ANOMALY_STRONG = .1
+ANOMALY_WEAK = .03
+
+
+class NDVIAnomalyMapBuilder(RCPODMapBuilder):
+    bottom_title = 'Отклонение NDVI от среднемноголетней нормы'
+
+    def init(self):
+        self.cmap = ListedColormap(['#8c8c8c', '#a11f14', '#ffaa00', '#ffff00', '#98e600', '#3b7a17'])
+        self.norm = BoundaryNorm([-999, -998.999, -ANOMALY_STRONG, -ANOMALY_WEAK, ANOMALY_WEAK, ANOMALY_STRONG, 999],
+                                 6)
+
+    def get_legend_handles(self):
+        data = self.read_data()
+        data_mask = ~np.isnan(data)
+        all_count = max(1, np.count_nonzero(data_mask))
+        clouds_count = np.count_nonzero((data <= -999) * data_mask)
+        much_lower_count = np.count_nonzero(data_mask * (data < -ANOMALY_STRONG) * (data > -999))
+        lower_count = np.count_nonzero(data_mask * (data >= -ANOMALY_STRONG) * (data < -ANOMALY_WEAK))
+        normal_count = np.count_nonzero(data_mask * (data >= -ANOMALY_WEAK) * (data < ANOMALY_WEAK))
+        higher_count = np.count_nonzero(data_mask * (data >= ANOMALY_WEAK) * (data < ANOMALY_STRONG))
+        much_higher_count = np.count_nonzero(data_mask * (data >= ANOMALY_STRONG))
+        del data
+
+        return [
+            patches.Patch(color='#3b7a17',
+                          label=f'Значительно выше нормы >{ANOMALY_STRONG} '
+                                f'({round(10000 * much_higher_count / all_count) / 100}%)'),
+            patches.Patch(color='#98e600',
+                          label=f'Выше нормы {ANOMALY_WEAK} - {ANOMALY_STRONG} '
+                                f'({round(10000 * higher_count / all_count) / 100}%)'),
+            patches.Patch(color='#ffff00',
+                          label=f'Норма (-{ANOMALY_WEAK}) - {ANOMALY_WEAK} '
+                                f'({round(10000 * normal_count / all_count) / 100}%)'),
+            patches.Patch(color='#ffaa00',
+                          label=f'Ниже нормы (-{ANOMALY_STRONG}) - (-{ANOMALY_WEAK}) '
+                                f'({round(10000 * lower_count / all_count) / 100}%)'),
+            patches.Patch(color='#a11f14',
+                          label=f'Значительно ниже нормы <(-{ANOMALY_STRONG}) '
+                                f'({round(10000 * much_lower_count / all_count) / 100}%)'),
+            patches.Patch(color='#8c8c8c',
+                          label=f'Закрытые облачностью посевы ({round(10000 * clouds_count / all_count) / 100}%)'),
+        ]
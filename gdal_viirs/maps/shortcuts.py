@@ -1,11 +1,30 @@
 import fiona
 import rasterio
 from rasterio import DatasetReader
+from rasterio.features import geometry_mask
 from rasterio.mask import mask
 
+from gdal_viirs.maps.builder import get_lims_window
 from gdal_viirs.maps.ndvi import NDVIMapBuilder
 
 
+def _mask_window(ndvi_file: DatasetReader, geoms, xlim, ylim):
+    """
+    То же, что rasterio.mask.mask, но читает только окно растра в границах xlim и ylim.
+
+    :return: данные и их трансформация или None, если границы не пересекаются с растром
+    """
+    window = get_lims_window(ndvi_file, xlim, ylim)
+    if window is None:
+        return None
+    out_transform = ndvi_file.window_transform(window)
+    out_image = ndvi_file.read(window=window, masked=True)
+    shape_mask = geometry_mask(geoms, out_image.shape[1:], out_transform, all_touched=False)
+    nodata = ndvi_file.nodata if ndvi_file.nodata is not None else 0
+    out_image.mask = out_image.mask | shape_mask
+    return out_image.filled(nodata), out_transform
+
+
 def produce_image(ndvi_file: DatasetReader, output_file, shp_mask_file=None, builder=None, **kwargs):
     def _build(file):
         builder_instance = (builder or NDVIMapBuilder)(file, **kwargs)
@@ -15,7 +34,12 @@ def produce_image(ndvi_file: DatasetReader, output_file, shp_mask_file=None, bui
         # прочитать данные маски и применить её
         with fiona.open(shp_mask_file) as shp_file:
             geoms = [feature["geometry"] for feature in shp_file]
-        out_image, out_transform = mask(ndvi_file, geoms, all_touched=False)
+        masked = None
+        if kwargs.get('windowed_read') and kwargs.get('xlim') and kwargs.get('ylim'):
+            masked = _mask_window(ndvi_file, geoms, kwargs['xlim'], kwargs['ylim'])
+        if masked is None:
+            masked = mask(ndvi_file, geoms, all_touched=False)
+        out_image, out_transform = masked
         meta = ndvi_file.meta.copy()
 
         with rasterio.MemoryFile() as memf:
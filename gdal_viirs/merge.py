@@ -1,8 +1,13 @@
-from typing import List, Union, Tuple
+import concurrent.futures
+import math
+import os
+import threading
+from typing import Callable, Iterable, List, Optional, Union, Tuple
 
 import numpy as np
 import rasterio
 import rasterio.crs
+from rasterio import windows
 from rasterio.merge import merge as _merge
 
 import gdal_viirs.utility as _utility
@@ -35,3 +40,366 @@ def merge_files2tiff(datasets: List[MergeDataset], output_file: str, **kw):
     })
     with rasterio.open(output_file, 'w', **meta) as f:
         f.write(merged)
+
+
+# region объединение по тайлам
+# функции объединения принимают данные и маску (True - нет данных) уже объединенной области и нового растра,
+# результат записывается в merged_data, как в rasterio.merge
+
+def _copy_first(merged_data, new_data, merged_mask, new_mask):
+    np.copyto(merged_data, new_data, where=merged_mask & ~new_mask)
+
+
+def _copy_last(merged_data, new_data, merged_mask, new_mask):
+    np.copyto(merged_data, new_data, where=~new_mask)
+
+
+def _copy_min(merged_data, new_data, merged_mask, new_mask):
+    np.copyto(merged_data, new_data, where=~new_mask & (merged_mask | (new_data < merged_data)))
+
+
+def _copy_max(merged_data, new_data, merged_mask, new_mask):
+    np.copyto(merged_data, new_data, where=~new_mask & (merged_mask | (new_data > merged_data)))
+
+
+MERGE_METHODS = {
+    'first': _copy_first,
+    'last': _copy_last,
+    'min': _copy_min,
+    'max': _copy_max,
+}
+
+# размер блока выходного GeoTIFF, размер тайла лучше брать кратным ему
+_BLOCK_SIZE = 256
+
+
+def _align_window(window: windows.Window) -> windows.Window:
+    """
+    Округляет смещение и размер окна так же, как rasterio.merge (и gdal_merge.py), чтобы тайлы не давали швов
+    """
+    return windows.Window(math.floor(window.col_off + 0.1), math.floor(window.row_off + 0.1),
+                          math.floor(window.width + 0.5), math.floor(window.height + 0.5))
+
+
+def _intersect_bounds(bounds1, bounds2) -> Optional[Tuple[float, float, float, float]]:
+    left, bottom = max(bounds1[0], bounds2[0]), max(bounds1[1], bounds2[1])
+    right, top = min(bounds1[2], bounds2[2]), min(bounds1[3], bounds2[3])
+    if left >= right or bottom >= top:
+        return None
+    return left, bottom, right, top
+
+
+def _nodata_mask(data: np.ma.MaskedArray) -> np.ndarray:
+    mask = np.ma.getmaskarray(data)
+    if np.issubdtype(data.dtype, np.floating):
+        mask = mask | np.isnan(data.data)
+    return mask
+
+
+def _valid_bounds(path: str, block_rows: int) -> Optional[Tuple[float, float, float, float]]:
+    """
+    Границы части растра, в которой есть данные (как после utility.trim_nodata). Если в крайних строках и столбцах
+    есть данные (растр уже обрезан), читаются только они, иначе растр читается полосами по block_rows строк.
+
+    :return: границы (left, bottom, right, top) или None, если данных в растре нет
+    """
+    with rasterio.open(path) as f:
+        edges = (
+            windows.Window(0, 0, f.width, 1),
+            windows.Window(0, f.height - 1, f.width, 1),
+            windows.Window(0, 0, 1, f.height),
+            windows.Window(f.width - 1, 0, 1, f.height),
+        )
+        if all((~_nodata_mask(f.read(window=edge, masked=True)).all(axis=0)).any() for edge in edges):
+            return tuple(f.bounds)
+
+        rows = np.zeros(f.height, bool)
+        cols = np.zeros(f.width, bool)
+        for row_off in range(0, f.height, block_rows):
+            window = windows.Window(0, row_off, f.width, min(block_rows, f.height - row_off))
+            valid = ~_nodata_mask(f.read(window=window, masked=True)).all(axis=0)
+            rows[row_off:row_off + window.height] = valid.any(axis=1)
+            cols |= valid.any(axis=0)
+        if not rows.any():
+            return None
+        row_start, row_end = rows.argmax(), f.height - rows[::-1].argmax()
+        col_start, col_end = cols.argmax(), f.width - cols[::-1].argmax()
+        return windows.bounds(windows.Window(col_start, row_start, col_end - col_start, row_end - row_start),
+                              f.transform)
+
+
+class _TileReader:
+    """
+    Читает части входных растров, попадающие в тайл выходного растра. Вызывается из нескольких потоков,
+    поэтому у каждого потока свои открытые файлы (объекты rasterio нельзя использовать из разных потоков).
+    """
+
+    def __init__(self, sources: List[Tuple[str, tuple]], output_transform):
+        self.sources = sources
+        self.output_transform = output_transform
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._opened = []
+
+    def _open(self, path):
+        files = getattr(self._local, 'files', None)
+        if files is None:
+            files = self._local.files = {}
+        if path not in files:
+            files[path] = rasterio.open(path)
+            with self._lock:
+                self._opened.append(files[path])
+        return files[path]
+
+    def read(self, chunk: windows.Window, count: int):
+        """
+        Для каждого входного растра, у которого есть данные в тайле, возвращает его индекс, окно в тайле
+        и прочитанные данные (masked array)
+        """
+        chunk_bounds = windows.bounds(chunk, self.output_transform)
+        chunk_transform = windows.transform(chunk, self.output_transform)
+        for index, (path, valid_bounds) in enumerate(self.sources):
+            if _intersect_bounds(valid_bounds, chunk_bounds) is None:
+                continue
+            src = self._open(path)
+            # читаем по полным границам растра, как rasterio.merge, чтобы пиксели совпадали
+            bounds = _intersect_bounds(src.bounds, chunk_bounds)
+            dst_window = _align_window(windows.from_bounds(*bounds, chunk_transform))
+            if dst_window.width <= 0 or dst_window.height <= 0:
+                continue
+            data = src.read(out_shape=(count, dst_window.height, dst_window.width), masked=True,
+                            window=windows.from_bounds(*bounds, src.transform))
+            yield index, dst_window, data
+
+    def close(self):
+        for f in self._opened:
+            f.close()
+
+
+class _TileMerger(_TileReader):
+    """
+    Объединяет один тайл выходного растра функцией объединения (см. MERGE_METHODS)
+    """
+
+    def __init__(self, sources: List[Tuple[str, tuple]], output_transform, count: int, copyto: Callable):
+        super(_TileMerger, self).__init__(sources, output_transform)
+        self.count = count
+        self.copyto = copyto
+
+    def __call__(self, chunk: windows.Window) -> Tuple[windows.Window, np.ndarray]:
+        dest = np.full((self.count, chunk.height, chunk.width), np.nan, 'float32')
+        for _, dst_window, data in self.read(chunk, self.count):
+            rows, cols = dst_window.toslices()
+            region = dest[:, rows, cols]
+            self.copyto(region, data.data, np.isnan(region), _nodata_mask(data))
+        return chunk, dest
+
+
+def _tiled_grid(datasets: List[str], tile_size: int, executor: concurrent.futures.Executor):
+    """
+    Сетка объединения - как у rasterio.merge: границы всех растров и разрешение первого, обрезанная по данным,
+    как trim_nodata в merge_files.
+
+    :return: проекция, количество каналов, трансформация сетки, окно с данными в сетке, растры с данными
+        (список пар путь - границы данных) и тайлы (окна в сетке)
+    """
+    xs, ys = [], []
+    for path in datasets:
+        with rasterio.open(path) as f:
+            if path == datasets[0]:
+                res, crs, count = f.res, f.crs, f.count
+            elif f.crs != crs:
+                raise ValueError(f'проекция {path} отличается от проекции {datasets[0]}')
+            xs += [f.bounds.left, f.bounds.right]
+            ys += [f.bounds.bottom, f.bounds.top]
+    output_transform = rasterio.Affine.translation(min(xs), max(ys)) * rasterio.Affine.scale(res[0], -res[1])
+    output_width = int(round((max(xs) - min(xs)) / res[0]))
+    output_height = int(round((max(ys) - min(ys)) / res[1]))
+
+    valid_bounds = list(executor.map(lambda path: _valid_bounds(path, tile_size), datasets))
+    sources = [(path, bounds) for path, bounds in zip(datasets, valid_bounds) if bounds is not None]
+    if sources:
+        aligned = [_align_window(windows.from_bounds(*bounds, output_transform)) for _, bounds in sources]
+        col_start = max(0, min(w.col_off for w in aligned))
+        row_start = max(0, min(w.row_off for w in aligned))
+        col_end = min(output_width, max(w.col_off + w.width for w in aligned))
+        row_end = min(output_height, max(w.row_off + w.height for w in aligned))
+        output_window = windows.Window(col_start, row_start, col_end - col_start, row_end - row_start)
+    else:
+        output_window = windows.Window(0, 0, output_width, output_height)
+
+    chunks = [
+        windows.Window(col, row,
+                       min(tile_size, output_window.col_off + output_window.width - col),
+                       min(tile_size, output_window.row_off + output_window.height - row))
+        for row in range(output_window.row_off, output_window.row_off + output_window.height, tile_size)
+        for col in range(output_window.col_off, output_window.col_off + output_window.width, tile_size)
+    ]
+    return crs, count, output_transform, output_window, sources, chunks
+
+
+def _write_tiles(dst, executor: concurrent.futures.Executor, fn: Callable, chunks: List[windows.Window],
+                 output_window: windows.Window, workers: int):
+    """
+    Вычисляет тайлы функцией fn (принимает окно тайла, возвращает окно и данные) в executor и записывает их в dst.
+    В очереди не больше workers * 2 тайлов, иначе готовые тайлы копятся в памяти, если запись не успевает
+    за вычислением.
+    """
+    pending = set()
+    chunks = iter(chunks)
+    while True:
+        for chunk in chunks:
+            pending.add(executor.submit(fn, chunk))
+            if len(pending) >= workers * 2:
+                break
+        if not pending:
+            break
+        done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            chunk, dest = future.result()
+            dst.write(dest, window=windows.Window(chunk.col_off - output_window.col_off,
+                                                  chunk.row_off - output_window.row_off,
+                                                  chunk.width, chunk.height))
+
+
+def _tiled_meta(output_window: windows.Window, output_transform, crs, count: int) -> dict:
+    meta = _utility.make_rasterio_meta(output_window.height, output_window.width, count)
+    meta.update({
+        'transform': windows.transform(output_window, output_transform),
+        'crs': crs,
+        'tiled': True,
+        'blockxsize': _BLOCK_SIZE,
+        'blockysize': _BLOCK_SIZE,
+    })
+    return meta
+
+
+def merge_files2tiff_tiled(datasets: List[str], output_file: str, method: Union[str, Callable] = 'max',
+                           tile_size: int = 1024, workers: int = None):
+    """
+    Объединяет растры в GeoTIFF по тайлам, результат такой же, как у merge_files2tiff (объединение обрезается
+    по данным), но растр целиком в памяти не собирается: для каждого тайла читаются только пересекающиеся с ним
+    части входных растров, тайлы объединяются параллельно в нескольких потоках и сразу записываются в файл.
+    Памяти нужно порядка workers * 2 тайлов плюс кэш блоков GDAL (GDAL_CACHEMAX).
+
+    :param datasets: пути к растрам, у всех одна проекция, разрешение берется из первого
+    :param output_file: выходной файл
+    :param method: способ объединения (first, last, min, max) или функция с сигнатурой
+        (merged_data, new_data, merged_mask, new_mask)
+    :param tile_size: размер тайла в пикселях (лучше кратный 256 - размеру блока выходного файла)
+    :param workers: количество потоков, по умолчанию - по количеству процессоров
+    """
+    copyto = MERGE_METHODS[method] if isinstance(method, str) else method
+    workers = workers or os.cpu_count() or 1
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        crs, count, output_transform, output_window, sources, chunks = _tiled_grid(datasets, tile_size, executor)
+        merger = _TileMerger(sources, output_transform, count, copyto)
+        try:
+            with rasterio.open(output_file, 'w', **_tiled_meta(output_window, output_transform, crs, count)) as dst:
+                _write_tiles(dst, executor, merger, chunks, output_window, workers)
+        finally:
+            merger.close()
+
+
+# статистики композита, которые умеет считать composite_files2tiff
+COMPOSITE_STATISTICS = (
+    'max',  # максимум, как у merge_files2tiff с method='max' (облака, если безоблачных наблюдений нет)
+    'count',  # количество безоблачных наблюдений (NaN - наблюдений нет)
+    'median',  # медиана безоблачных наблюдений
+    'latest',  # последнее (по дате) безоблачное наблюдение
+)
+
+
+class _TileCompositor(_TileReader):
+    """
+    Считает статистики композита для одного тайла по стеку всех входных растров, которые в него попадают
+    """
+
+    def __init__(self, sources: List[Tuple[str, tuple]], output_transform, statistics: Tuple[str, ...],
+                 cloud_value: float):
+        super(_TileCompositor, self).__init__(sources, output_transform)
+        self.statistics = statistics
+        self.cloud_value = cloud_value
+
+    def __call__(self, chunk: windows.Window) -> Tuple[windows.Window, np.ndarray]:
+        dest = np.full((len(self.statistics), chunk.height, chunk.width), np.nan, 'float32')
+        if not self.sources:
+            return chunk, dest
+        # источники отсортированы по дате, поэтому последний по индексу в стеке - самый поздний
+        stack = np.full((len(self.sources), chunk.height, chunk.width), np.nan, 'float32')
+        for index, dst_window, data in self.read(chunk, 1):
+            rows, cols = dst_window.toslices()
+            np.copyto(stack[index, rows, cols], data.data[0], where=~_nodata_mask(data)[0])
+
+        if 'max' in self.statistics:
+            dest[self.statistics.index('max')] = np.fmax.reduce(stack, axis=0)
+        if self.statistics == ('max',):
+            return chunk, dest
+
+        clouds = stack == self.cloud_value
+        clear_stack = np.where(clouds, np.float32(np.nan), stack)
+        clear_count = np.count_nonzero(~np.isnan(clear_stack), axis=0)
+        # пиксели без безоблачных наблюдений: облака, если они были, иначе NaN
+        no_clear = np.where(clouds.any(axis=0), np.float32(self.cloud_value), np.float32(np.nan))
+        del clouds
+
+        if 'count' in self.statistics:
+            dest[self.statistics.index('count')] = np.where(np.isnan(no_clear) & (clear_count == 0),
+                                                            np.float32(np.nan), clear_count)
+        if 'median' in self.statistics:
+            # для одного или двух наблюдений медиана - среднее минимума и максимума, сортируются только
+            # пиксели, где наблюдений больше (NaN при сортировке оказываются в конце)
+            median = (np.fmin.reduce(clear_stack, axis=0) + np.fmax.reduce(clear_stack, axis=0)) / 2
+            many = clear_count > 2
+            if many.any():
+                ordered = np.sort(clear_stack[:, many], axis=0)
+                count, columns = clear_count[many], np.arange(ordered.shape[1])
+                median[many] = (ordered[(count - 1) // 2, columns] + ordered[count // 2, columns]) / 2
+            dest[self.statistics.index('median')] = np.where(clear_count > 0, median, no_clear)
+        if 'latest' in self.statistics:
+            latest = no_clear.copy()
+            for layer in clear_stack:
+                np.copyto(latest, layer, where=~np.isnan(layer))
+            dest[self.statistics.index('latest')] = latest
+        return chunk, dest
+
+
+def composite_files2tiff(datasets: List[str], output_file: str, statistics: Iterable[str] = COMPOSITE_STATISTICS,
+                         dates: List = None, cloud_value: float = -2, tile_size: int = 512, workers: int = None):
+    """
+    Создает многоканальный композит: каждый канал - статистика (см. COMPOSITE_STATISTICS) по всем входным
+    растрам (первый канал входных растров). Входные растры читаются один раз, по тайлам, как в
+    merge_files2tiff_tiled, все статистики тайла считаются по одному стеку. Облака (cloud_value) не считаются
+    безоблачными наблюдениями, но попадают в max и в median/latest, если безоблачных наблюдений нет.
+    Каналам выходного файла присваиваются описания - названия статистик.
+
+    :param datasets: пути к растрам, у всех одна проекция, разрешение берется из первого
+    :param output_file: выходной файл
+    :param statistics: статистики в порядке каналов
+    :param dates: даты растров (для latest), по умолчанию - порядок в datasets
+    :param cloud_value: значение облачных пикселей
+    :param tile_size: размер тайла в пикселях, памяти нужно порядка workers * 2 * len(datasets) тайлов
+    :param workers: количество потоков, по умолчанию - по количеству процессоров
+    """
+    statistics = tuple(statistics)
+    for statistic in statistics:
+        if statistic not in COMPOSITE_STATISTICS:
+            raise ValueError(f'неизвестная статистика композита: {statistic}')
+    if dates is not None:
+        datasets = [path for _, path in sorted(zip(dates, datasets), key=lambda item: item[0])]
+    workers = workers or os.cpu_count() or 1
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        crs, _, output_transform, output_window, sources, chunks = _tiled_grid(datasets, tile_size, executor)
+        compositor = _TileCompositor(sources, output_transform, statistics, cloud_value)
+        meta = _tiled_meta(output_window, output_transform, crs, len(statistics))
+        try:
+            with rasterio.open(output_file, 'w', **meta) as dst:
+                for band, statistic in enumerate(statistics):
+                    dst.set_band_description(band + 1, statistic)
+                _write_tiles(dst, executor, compositor, chunks, output_window, workers)
+        finally:
+            compositor.close()
+
+# endregion
@@ -1,4 +1,4 @@
-import importlib
+import importlib.metadata
 import json
 import os
 from datetime import date, datetime
@@ -17,13 +17,15 @@ def get_gdal_viirs_directory() -> Path:
 
 
 def gather_packages():
+    """
+    Версии пакетов из метаданных установленных дистрибутивов (сами пакеты не импортируются)
+    """
     try:
         versions = {}
         packages = 'pyproj', 'rasterio', 'peewee', 'matplotlib', 'numpy'
         for p in packages:
             try:
-                ver = importlib.import_module(p).__version__ # noqa
-                versions[p] = ver
+                versions[p] = importlib.metadata.version(p)
             except Exception as exc:
                 versions[p] = f'failed: {exc}'
         return json.dumps(versions)
@@ -31,14 +33,21 @@ def gather_packages():
         return f'failed: {exc}'
 
 
+_proj_version = None
+
+
 def get_proj_version():
-    try:
-        import subprocess
-        proc = subprocess.Popen('proj', stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        _, stderr = proc.communicate()
-        return stderr.decode('ascii').split('\n')[0]
-    except Exception as exc:
-        return f'exception: {exc}'
+    """
+    Версия PROJ, с которой работает pyproj (без запуска программы proj), значение кэшируется
+    """
+    global _proj_version
+    if _proj_version is None:
+        try:
+            import pyproj
+            _proj_version = f'Rel. {pyproj.proj_version_str}'
+        except Exception as exc:
+            return f'exception: {exc}'
+    return _proj_version
 
 
 def julian2date(julian_date: str) -> date:
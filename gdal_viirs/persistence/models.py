@@ -1,6 +1,6 @@
 from datetime import datetime
 from pathlib import Path
-from typing import Union
+from typing import Union, Optional, Iterable, Dict, List
 
 from peewee import *
 
@@ -8,11 +8,19 @@ __all__ = (
     'db_proxy',
     'ProcessedViirsL1',
     'NDVITiff',
+    'BandIndexTiff',
     'NDVIDynamicsTiff',
     'NDVIComposite',
     'NDVICompositeComponents',
+    'NDVICompositeBand',
     'MetaData',
+    'FilesetCheck',
+    'StageMetric',
+    'PendingWork',
+    'Footprint',
     'PEEWEE_MODELS',
+    'SQLITE_PRAGMAS',
+    'bulk_upsert',
 )
 
 from peewee import ModelSelect
@@ -21,6 +29,48 @@ from gdal_viirs.hl import utility
 
 db_proxy = Proxy()
 
+# WAL позволяет читать БД во время записи (например, db_view_util.py или второй процесс обработки),
+# busy_timeout - ждать освобождения блокировки записи вместо ошибки "database is locked"
+SQLITE_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'busy_timeout': 30000,
+    'cache_size': -32 * 1024,
+    'temp_store': 'memory',
+}
+
+# SQLite ограничивает количество параметров в одном запросе
+_SQLITE_BATCH_SIZE = 500
+
+
+def _batches(items: list, size: int = _SQLITE_BATCH_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def bulk_upsert(model, rows: List[dict], conflict_target, batch_size: int = 100):
+    """
+    Вставляет записи пачками, при конфликте по conflict_target обновляет остальные поля записи.
+
+    :param model: модель peewee
+    :param rows: записи в виде словарей (у всех записей должен быть одинаковый набор полей)
+    :param conflict_target: поля уникального индекса
+    :param batch_size: количество записей в одном запросе
+    """
+    if len(rows) == 0:
+        return
+    conflict_names = {f if isinstance(f, str) else f.name for f in conflict_target}
+    conflict_target = [getattr(model, name) for name in conflict_names]
+    preserve = [getattr(model, k) for k in rows[0] if k not in conflict_names]
+    with model._meta.database.atomic():
+        for batch in _batches(rows, batch_size):
+            query = model.insert_many(batch)
+            if preserve:
+                query = query.on_conflict(conflict_target=conflict_target, preserve=preserve)
+            else:
+                query = query.on_conflict_ignore()
+            query.execute()
+
 
 class BaseModel(Model):
     id = IntegerField(primary_key=True)
@@ -35,13 +85,15 @@ class MetaData(BaseModel):
 
     @classmethod
     def set_meta(cls, key: str, value: str):
-        record: MetaData = cls.get_or_none(cls.key == key)
-        if record is None:
-            record = cls(key=key, value=value)
-            record.save(True)
-        else:
-            record.value = value
-            record.save()
+        cls.set_meta_many({key: value})
+
+    @classmethod
+    def set_meta_many(cls, values: Dict[str, str]):
+        bulk_upsert(cls, [{'key': k, 'value': v} for k, v in values.items()], ['key'])
+
+    @classmethod
+    def get_meta_many(cls, keys: Iterable[str]) -> Dict[str, str]:
+        return {record.key: record.value for record in cls.select().where(cls.key.in_(list(keys)))}
 
     @classmethod
     def get_meta(cls, key: str, default: str):
@@ -60,9 +112,24 @@ class ProcessedFile(BaseModel):
     output_file: str = CharField(unique=True)
     created_at: datetime = DateTimeField(default=datetime.now)
 
+    @classmethod
+    def get_many(cls, output_files: Iterable[Union[str, Path]]) -> Dict[str, 'ProcessedFile']:
+        """
+        Получает записи по путям выходных файлов несколькими запросами (вместо запроса на каждый файл)
+
+        :param output_files: пути выходных файлов
+        :return: словарь путь -> запись, файлов без записи в словаре нет
+        """
+        output_files = list(dict.fromkeys(map(str, output_files)))
+        records = {}
+        for batch in _batches(output_files):
+            for record in cls.select().where(cls.output_file.in_(batch)):
+                records[record.output_file] = record
+        return records
+
 
 class DatasetRelatedFile(ProcessedFile):
-    dataset_date = DateTimeField()
+    dataset_date = DateTimeField(index=True)
 
     def __init__(self, output_file: Union[str, Path] = None, dataset_date: datetime = None, **kwargs):
         super(DatasetRelatedFile, self).__init__(output_file, **kwargs)
@@ -107,9 +174,18 @@ class NDVITiff(ProcessedFile):
     based_on = ForeignKeyField(ProcessedViirsL1)
 
 
+class BandIndexTiff(ProcessedFile):
+    """
+    Индекс (EVI2, NDWI, ...), посчитанный по каналам level1 файла, см. BAND_INDICES в конфигурации
+    """
+    based_on = ForeignKeyField(ProcessedViirsL1)
+    # название индекса (ключ process.BAND_INDICES или BAND_EXPRESSIONS)
+    name: str = CharField(index=True)
+
+
 class NDVIComposite(ProcessedFile):
-    starts_at: Union[DateField, datetime] = DateField()
-    ends_at: Union[DateField, datetime] = DateField()
+    starts_at: Union[DateField, datetime] = DateField(index=True)
+    ends_at: Union[DateField, datetime] = DateField(index=True)
 
     @property
     def date_text(self):
@@ -119,6 +195,17 @@ class NDVIComposite(ProcessedFile):
         """
         return self.starts_at.strftime('%d.%m') + ' - ' + self.ends_at.strftime('%d.%m.%Y')
 
+    def get_band(self, statistic: str) -> Optional[int]:
+        """
+        :param statistic: статистика (max, count, median, latest, см. merge.COMPOSITE_STATISTICS)
+        :return: номер канала композита (с 1) со статистикой или None, если такого канала нет. У композитов
+            без записей о каналах (созданных merge_files2tiff) единственный канал - max.
+        """
+        bands = {b.statistic: b.band for b in NDVICompositeBand.select().where(NDVICompositeBand.composite == self)}
+        if not bands:
+            return 1 if statistic == 'max' else None
+        return bands.get(statistic)
+
 
 class NDVICompositeComponents(BaseModel):
     composite = ForeignKeyField(NDVIComposite, related_name='components')
@@ -128,6 +215,38 @@ class NDVICompositeComponents(BaseModel):
         primary_key = CompositeKey('composite', 'component')
 
 
+class NDVICompositeBand(BaseModel):
+    """
+    Канал многоканального композита (см. merge.composite_files2tiff): какая статистика в нем записана
+    """
+    composite: Union[int, NDVIComposite] = ForeignKeyField(NDVIComposite, related_name='bands')
+    band: Union[IntegerField, int] = IntegerField()
+    statistic: Union[CharField, str] = CharField()
+    # значение облачных пикселей (в каналах, где облака сохраняются)
+    cloud_value: Union[FloatField, float, None] = FloatField(null=True)
+    # количество растров, по которым посчитана статистика
+    sources_count: Union[IntegerField, int] = IntegerField()
+    created_at: datetime = DateTimeField(default=datetime.now)
+
+    class Meta:
+        indexes = (
+            (('composite', 'band'), True),
+        )
+
+    @classmethod
+    def set_bands(cls, composite: NDVIComposite, statistics: List[str], cloud_value: float, sources_count: int):
+        """
+        Записывает каналы композита, лишние каналы (от предыдущего создания композита) удаляются
+        """
+        with cls._meta.database.atomic():
+            cls.delete().where((cls.composite == composite) & (cls.band > len(statistics))).execute()
+            bulk_upsert(cls, [
+                {'composite': composite.id, 'band': band, 'statistic': statistic, 'cloud_value': cloud_value,
+                 'sources_count': sources_count, 'created_at': datetime.now()}
+                for band, statistic in enumerate(statistics, 1)
+            ], ['composite', 'band'])
+
+
 class NDVIDynamicsTiff(ProcessedFile):
     b1_composite: Union[int, NDVIComposite] = ForeignKeyField(NDVIComposite)
     b2_composite: Union[int, NDVIComposite] = ForeignKeyField(NDVIComposite)
@@ -141,11 +260,226 @@ class NDVIDynamicsTiff(ProcessedFile):
         return self.b1_composite.starts_at.strftime('%d.%m') + ' - ' + self.b2_composite.ends_at.strftime('%d.%m.%Y')
 
 
+class FilesetCheck(BaseModel):
+    """
+    Результат предварительной проверки набора файлов (например, попадание витка в область интереса),
+    чтобы не повторять проверку при следующих запусках
+    """
+    geoloc_filename: Union[CharField, str] = CharField()
+    # название проверки, может включать хэш ее параметров (например, aoi:{хэш регионов}), чтобы после изменения
+    # параметров проверка выполнялась заново
+    check: Union[CharField, str] = CharField()
+    passed: Union[BooleanField, bool] = BooleanField()
+    value: Union[FloatField, float, None] = FloatField(null=True)
+    created_at: datetime = DateTimeField(default=datetime.now)
+
+    class Meta:
+        indexes = (
+            (('geoloc_filename', 'check'), True),
+        )
+
+    @classmethod
+    def get_result(cls, geoloc_filename: str, check: str) -> Optional['FilesetCheck']:
+        return cls.get_or_none((cls.geoloc_filename == geoloc_filename) & (cls.check == check))
+
+    @classmethod
+    def get_results(cls, geoloc_filenames: Iterable[str], check: str) -> Dict[str, 'FilesetCheck']:
+        """
+        Получает результаты проверки check для нескольких наборов файлов
+
+        :return: словарь имя файла геолокации -> запись, непроверенных наборов в словаре нет
+        """
+        geoloc_filenames = list(dict.fromkeys(geoloc_filenames))
+        records = {}
+        for batch in _batches(geoloc_filenames):
+            for record in cls.select().where((cls.check == check) & cls.geoloc_filename.in_(batch)):
+                records[record.geoloc_filename] = record
+        return records
+
+    @classmethod
+    def set_result(cls, geoloc_filename: str, check: str, passed: bool, value: float = None) -> 'FilesetCheck':
+        record = cls(geoloc_filename=geoloc_filename, check=check, passed=passed, value=value)
+        bulk_upsert(cls, [{'geoloc_filename': geoloc_filename, 'check': check, 'passed': passed, 'value': value,
+                           'created_at': record.created_at}], ['geoloc_filename', 'check'])
+        return record
+
+
+class StageMetric(BaseModel):
+    """
+    Показатели одного выполнения этапа обработки (см. gdal_viirs.hl.metrics)
+    """
+    stage: Union[CharField, str] = CharField(index=True)
+    output: Union[CharField, str] = CharField()
+    swath_id: Union[CharField, str, None] = CharField(null=True)
+    region: Union[CharField, str, None] = CharField(null=True)
+    date: Union[DateField, datetime, None] = DateField(null=True)
+    started_at: datetime = DateTimeField(index=True)
+    wall_seconds: float = FloatField()
+    cpu_seconds: float = FloatField()
+    peak_rss_mb: Union[FloatField, float, None] = FloatField(null=True)
+    bytes_read: int = BigIntegerField()
+    bytes_written: int = BigIntegerField()
+    input_pixels: Union[BigIntegerField, int, None] = BigIntegerField(null=True)
+    output_pixels: Union[BigIntegerField, int, None] = BigIntegerField(null=True)
+    success: bool = BooleanField()
+
+    @classmethod
+    def insert_records(cls, records: List[dict], batch_size: int = 50):
+        """
+        Сохраняет показатели пачками по batch_size записей (14 параметров на запись, SQLite до 3.32
+        допускает не больше 999 параметров в одном запросе)
+        """
+        with cls._meta.database.atomic():
+            for batch in _batches(records, batch_size):
+                cls.insert_many(batch).execute()
+
+
+class PendingWork(BaseModel):
+    """
+    Отложенная обработка датасета (например, NDVI без маски облачности). Обработка повторяется только после
+    появления файла prerequisite (если указан) или после retry_after, см. NPPProcessor._is_pending_ready
+    """
+    processed: Union[int, ProcessedViirsL1] = ForeignKeyField(ProcessedViirsL1)
+    stage: Union[CharField, str] = CharField()
+    reason: Union[TextField, str] = TextField()
+    prerequisite: Union[CharField, str, None] = CharField(null=True)
+    attempts: Union[IntegerField, int] = IntegerField(default=0)
+    created_at: datetime = DateTimeField(default=datetime.now)
+    last_attempt_at: datetime = DateTimeField(default=datetime.now)
+    retry_after: datetime = DateTimeField(default=datetime.now, index=True)
+    gave_up: Union[BooleanField, bool] = BooleanField(default=False)
+
+    class Meta:
+        indexes = (
+            (('processed', 'stage'), True),
+        )
+
+    @classmethod
+    def get_many(cls, processed_ids: Iterable[int]) -> Dict[tuple, 'PendingWork']:
+        """
+        :return: словарь (id обработанного датасета, этап) -> запись
+        """
+        processed_ids = list(dict.fromkeys(processed_ids))
+        records = {}
+        for batch in _batches(processed_ids):
+            for record in cls.select().where(cls.processed.in_(batch)):
+                records[(record.processed_id, record.stage)] = record
+        return records
+
+
+class Footprint(BaseModel):
+    """
+    Каталог растров: где находится растр (границы, проекция, разрешение), за какой период и какая доля пикселей
+    содержит данные и облака. Границы также хранятся в R-tree таблице footprint_rtree (id = Footprint.id) для
+    быстрого поиска растров, пересекающих область. Заполняется через gdal_viirs.hl.catalog.
+    """
+    output_file: str = CharField(unique=True)
+    # тип продукта: VIMGO (и другие типы level1), ndvi, merged_ndvi, ndvi_dynamics
+    kind: Union[CharField, str] = CharField(index=True)
+    starts_at: datetime = DateTimeField(index=True)
+    ends_at: datetime = DateTimeField(index=True)
+    crs: Union[TextField, str] = TextField()
+    min_x: float = FloatField()
+    min_y: float = FloatField()
+    max_x: float = FloatField()
+    max_y: float = FloatField()
+    res_x: float = FloatField()
+    res_y: float = FloatField()
+    width: int = IntegerField()
+    height: int = IntegerField()
+    # доля пикселей с данными (не nodata и не облака)
+    valid_fraction: Union[FloatField, float, None] = FloatField(null=True)
+    # доля облаков среди пикселей, для которых есть наблюдение (данные или облака)
+    cloud_fraction: Union[FloatField, float, None] = FloatField(null=True)
+    created_at: datetime = DateTimeField(default=datetime.now)
+
+    RTREE_TABLE = 'footprint_rtree'
+
+    @property
+    def bounds(self):
+        return self.min_x, self.min_y, self.max_x, self.max_y
+
+    @classmethod
+    def create_table(cls, safe=True, **options):
+        super(Footprint, cls).create_table(safe, **options)
+        cls._meta.database.execute_sql(
+            f'CREATE VIRTUAL TABLE {"IF NOT EXISTS " if safe else ""}{cls.RTREE_TABLE} '
+            f'USING rtree(id, min_x, max_x, min_y, max_y)')
+
+    @classmethod
+    def drop_table(cls, safe=True, **options):
+        cls._meta.database.execute_sql(f'DROP TABLE {"IF EXISTS " if safe else ""}{cls.RTREE_TABLE}')
+        super(Footprint, cls).drop_table(safe, **options)
+
+    @classmethod
+    def register(cls, output_file: Union[str, Path], kind: str, starts_at: datetime, ends_at: datetime,
+                 **info) -> 'Footprint':
+        """
+        Добавляет или обновляет запись каталога и R-tree индекс
+
+        :param info: остальные поля записи (crs, границы, разрешение, доли пикселей), см. catalog.describe_raster
+        """
+        row = dict(output_file=str(output_file), kind=kind, starts_at=starts_at, ends_at=ends_at,
+                   created_at=datetime.now(), **info)
+        with cls._meta.database.atomic():
+            bulk_upsert(cls, [row], ['output_file'])
+            record = cls.get(cls.output_file == str(output_file))
+            cls._meta.database.execute_sql(
+                f'INSERT OR REPLACE INTO {cls.RTREE_TABLE} (id, min_x, max_x, min_y, max_y) VALUES (?, ?, ?, ?, ?)',
+                (record.id, record.min_x, record.max_x, record.min_y, record.max_y))
+        return record
+
+    @classmethod
+    def get_many(cls, output_files: Iterable[Union[str, Path]]) -> Dict[str, 'Footprint']:
+        output_files = list(dict.fromkeys(map(str, output_files)))
+        records = {}
+        for batch in _batches(output_files):
+            for record in cls.select().where(cls.output_file.in_(batch)):
+                records[record.output_file] = record
+        return records
+
+    @classmethod
+    def find(cls, kind: str = None, bounds=None, starts_at: datetime = None, ends_at: datetime = None,
+             min_valid_fraction: float = None) -> ModelSelect:
+        """
+        Ищет растры в каталоге, например NDVI файлы, пересекающие регион, за период:
+        ``Footprint.find('ndvi', bounds=(xmin, ymin, xmax, ymax), starts_at=a, ends_at=b)``
+
+        :param kind: тип продукта
+        :param bounds: (xmin, ymin, xmax, ymax) - растры, пересекающие эту область (поиск по R-tree)
+        :param starts_at: растры, период которых заканчивается не раньше этой даты
+        :param ends_at: растры, период которых начинается не позже этой даты
+        :param min_valid_fraction: растры, в которых доля пикселей с данными больше этого значения
+            (растры, для которых доля не посчитана, не исключаются)
+        """
+        query = cls.select()
+        if kind is not None:
+            query = query.where(cls.kind == kind)
+        if starts_at is not None:
+            query = query.where(cls.ends_at >= starts_at)
+        if ends_at is not None:
+            query = query.where(cls.starts_at <= ends_at)
+        if min_valid_fraction is not None:
+            query = query.where(cls.valid_fraction.is_null() | (cls.valid_fraction > min_valid_fraction))
+        if bounds is not None:
+            xmin, ymin, xmax, ymax = bounds
+            query = query.where(cls.id.in_(SQL(
+                f'(SELECT id FROM {cls.RTREE_TABLE} WHERE max_x >= ? AND min_x <= ? AND max_y >= ? AND min_y <= ?)',
+                (xmin, xmax, ymin, ymax))))
+        return query
+
+
 PEEWEE_MODELS = [
     NDVITiff,
+    BandIndexTiff,
     NDVIComposite,
     NDVICompositeComponents,
+    NDVICompositeBand,
     NDVIDynamicsTiff,
     ProcessedViirsL1,
-    MetaData
+    MetaData,
+    FilesetCheck,
+    StageMetric,
+    PendingWork,
+    Footprint
 ]
@@ -1,21 +1,39 @@
+import ast
+import concurrent.futures
+import os
 import time
+import zlib
 from datetime import datetime
-from typing import List, Iterable
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, Iterable, NamedTuple, Optional, Sequence, Tuple, Union
 
 import numpy as np
 import pyproj
 import rasterio
 import rasterio.crs
+import rasterio.errors
 import rasterio.features
 import rasterio.fill
+import rasterio.transform
 import rasterio.warp
+import rasterio.windows
+from rasterio.enums import Resampling
+from affine import Affine
 from loguru import logger
 
-from gdal_viirs import utility
+from gdal_viirs import sharedmem, utility
 from gdal_viirs.const import GIMGO, ND_OBPT, PROJ_LCC, ND_NA
 from gdal_viirs.exceptions import SubDatasetNotFound, InvalidData, CorruptedFile, ProcessingException
+from gdal_viirs.resample import SparseResampler, KDTreeResampler, RESAMPLE_MEAN
 from gdal_viirs.types import GeofileInfo, Number, \
-    ProcessedGeolocFile, ViirsFileset
+    ProcessedGeolocFile, ViirsFileset, Bounds
+
+GRIDDING_SCATTER = 'scatter'
+GRIDDING_SPARSE = 'sparse'
+GRIDDING_KDTREE = 'kdtree'
+
+GRIDDING_METHODS = GRIDDING_SCATTER, GRIDDING_SPARSE, GRIDDING_KDTREE
 
 _RASTERIO_DEFAULT_META = {
     'driver': 'GTiff',
@@ -42,7 +60,9 @@ def _try_open_fileset(fileset: ViirsFileset):
             raise CorruptedFile(e)
 
 
-def process_fileset(fileset: ViirsFileset, output_file: str, scale=2000, trim=True, proj=None):
+def process_fileset(fileset: ViirsFileset, output_file: str, scale=2000, trim=True, proj=None,
+                    gridding: str = GRIDDING_SCATTER, cache_dir: Union[str, Path] = None, block_rows: int = None,
+                    bounds: Bounds = None, workers: int = None):
     """
     Обрабатывает набор файлов, начиная с файла геолокации (широта/долгота) и затем файлы каналов (SVI/SVM),
     создает файл вида out_ИМЯ_ФАЙЛА_ГЕОЛОКАЦИИ.tiff в папке, указанной в параметре out_dir (если указан filename,
@@ -52,54 +72,234 @@ def process_fileset(fileset: ViirsFileset, output_file: str, scale=2000, trim=Tr
     :param fileset: ViirsFileSet, получаенный через функцию utility.find_sdr_viirs_filesets
     :param scale: масштаб, метров на пиксель (рекомендовано значение 2000, чтобы минимизировать nodata)
     :param proj: проекция в формате WKT, значение по умолчанию - gdal_viirs.const.PROJ_LCC
+    :param gridding: способ построения сетки: scatter - разброс точек по пикселям и заполнение пустот для каждого
+        канала, sparse - разреженный оператор (см. gdal_viirs.resample), общий для всех каналов,
+        kdtree - ближайшая точка снимка для каждого пикселя (KD-дерево), без отдельного заполнения пустот
+    :param cache_dir: папка для кэша геолокации (и оператора перепроецирования), None - не использовать кэш
+    :param block_rows: если указан, геолокация и каналы читаются и обрабатываются блоками по block_rows строк
+        (округляется до целого числа сканов), потребление памяти ограничено размером блока и выходного изображения,
+        поддерживается только для gridding='scatter'
+    :param bounds: (xmin, ymin, xmax, ymax) в координатах проекции, если указан - в сетку попадают только точки
+        внутри этой области (например, область интереса, см. get_swath_sample)
+    :param workers: если больше 1, каналы обрабатываются параллельно в стольких процессах, геолокация и сетка
+        каналов передаются через разделяемую память (см. gdal_viirs.sharedmem), поддерживается только для
+        gridding='scatter' без block_rows
+    """
+    data, transform = grid_fileset(fileset, scale, trim=trim, proj=proj, gridding=gridding, cache_dir=cache_dir,
+                                   block_rows=block_rows, bounds=bounds, workers=workers)
+    _write_bands(output_file, data, transform, proj, [file.file_type for file in fileset.band_files])
+
+
+def grid_fileset(fileset: ViirsFileset, scale=2000, trim=True, proj=None, gridding: str = GRIDDING_SCATTER,
+                 cache_dir: Union[str, Path] = None, block_rows: int = None, bounds: Bounds = None,
+                 workers: int = None):
+    """
+    Строит сетку для всех каналов набора файлов, не записывая результат в файл.
+    Параметры такие же, как у process_fileset.
+
+    :return: массив (каналы, высота, ширина) и Affine transform
     """
     if len(fileset.band_files) == 0:
         raise InvalidData('Band-файлы не найдены')
+    if gridding not in GRIDDING_METHODS:
+        raise ValueError(f'неизвестный способ построения сетки {gridding}, поддерживаются: {", ".join(GRIDDING_METHODS)}')
+    if block_rows is not None and gridding != GRIDDING_SCATTER:
+        raise ValueError(f'обработка блоками (block_rows) не поддерживается для gridding={gridding}')
 
     _try_open_fileset(fileset)
 
-    logger.info(f'Обработка набора файлов {fileset.geoloc_file.name} scale={scale}')
-
-    crs = rasterio.crs.CRS.from_wkt(proj or PROJ_LCC, morph_from_esri_dialect=True)
-
-    geoloc_file = process_geoloc_file(fileset.geoloc_file, scale, proj=proj)
-    height, width = geoloc_file.out_image_shape
+    logger.info(f'Обработка набора файлов {fileset.geoloc_file.name} scale={scale} gridding={gridding}')
 
-    bands = _process_band_files(geoloc_file, fileset.band_files)
-    transform = geoloc_file.transform
+    if block_rows is not None:
+        bands, transform = _process_fileset_blocks(fileset, scale, block_rows, proj=proj, bounds=bounds)
+    else:
+        bands, transform = _grid_fileset(fileset, scale, proj=proj, gridding=gridding, cache_dir=cache_dir,
+                                         bounds=bounds, workers=workers)
 
     if trim:
         # обрезаем nodata
-        transform, data = utility.trim_nodata(bands, geoloc_file.transform)
-        height, width = data.shape[1:]
+        transform, data = utility.trim_nodata(bands, transform)
     else:
         data = bands
     del bands
+    return data, transform
+
 
-    meta = utility.make_rasterio_meta(height, width, data.shape[0])
+def _write_bands(output_file: str, data: np.ndarray, transform: Affine, proj=None, descriptions: List[str] = None):
+    """
+    :param descriptions: описания каналов (типы файлов каналов, например SVI01), по ним каналы находит
+        process_band_math
+    """
+    crs = rasterio.crs.CRS.from_wkt(proj or PROJ_LCC, morph_from_esri_dialect=True)
+    height, width = data.shape[-2:]
+    meta = utility.make_rasterio_meta(height, width, 1 if data.ndim == 2 else data.shape[0])
     meta.update({
         'transform': transform,
         'crs': crs
     })
     with rasterio.open(output_file, 'w', **meta) as f:
-        f.write(data)
+        if data.ndim == 2:
+            f.write(data, 1)
+        else:
+            f.write(data)
+        for band, description in enumerate(descriptions or [], 1):
+            f.set_band_description(band, description)
+
 
+def _grid_fileset(fileset: ViirsFileset, scale, proj=None, gridding: str = GRIDDING_SCATTER,
+                  cache_dir: Union[str, Path] = None, bounds: Bounds = None, workers: int = None):
+    # KD-дереву нужны дробные координаты точек, получаем их за ту же обработку геолокации
+    geoloc_file = get_processed_geoloc_file(fileset.geoloc_file, scale, proj=proj, cache_dir=cache_dir,
+                                            bounds=bounds, keep_coords=gridding == GRIDDING_KDTREE)
 
-def process_geoloc_file(geofile: GeofileInfo, scale: Number, proj=None) -> ProcessedGeolocFile:
+    if gridding == GRIDDING_SPARSE:
+        resampler = get_sparse_resampler(fileset.geoloc_file, geoloc_file, proj=proj, cache_dir=cache_dir,
+                                         bounds=bounds)
+        bands = _resample_band_files(geoloc_file, resampler, fileset.band_files)
+    elif gridding == GRIDDING_KDTREE:
+        resampler = get_kdtree_resampler(fileset.geoloc_file, geoloc_file, proj=proj, cache_dir=cache_dir,
+                                         bounds=bounds)
+        bands = _resample_band_files(geoloc_file, resampler, fileset.band_files)
+    else:
+        bands = _process_band_files(geoloc_file, fileset.band_files, workers=workers)
+    return bands, geoloc_file.transform
+
+
+def _cache_path(cache_dir: Union[str, Path], geofile: GeofileInfo, scale: Number, proj: Optional[str],
+                suffix: str, bounds: Bounds = None) -> Path:
+    key = proj or PROJ_LCC
+    if bounds is not None:
+        key += repr(tuple(float(v) for v in bounds))
+    key_hash = zlib.crc32(key.encode('utf-8'))
+    return Path(cache_dir) / f'{geofile.name_without_extension}.{scale}.{key_hash:08x}.{suffix}.npz'
+
+
+def get_processed_geoloc_file(geofile: GeofileInfo, scale: Number, proj=None,
+                              cache_dir: Union[str, Path] = None, bounds: Bounds = None,
+                              keep_coords: bool = False) -> ProcessedGeolocFile:
     """
-    Обробатывает файл геолокации
+    Возвращает обработанный файл геолокации из кэша (если cache_dir указан и файл кэша есть),
+    иначе обрабатывает его через process_geoloc_file и сохраняет в кэш.
+
+    :param keep_coords: сохранить дробные координаты точек (см. process_geoloc_file), если геолокация
+        обрабатывается; в кэш координаты не сохраняются, поэтому в геолокации из кэша их нет
     """
-    assert geofile.is_geoloc, (
-        f'{geofile.name} не является геолокационным файлом, '
-        f'поддерживаемые форматы: {", ".join(GeofileInfo.GEOLOC_SDR + GeofileInfo.GEOLOC_EDR)}'
-    )
+    if cache_dir is None:
+        return process_geoloc_file(geofile, scale, proj=proj, bounds=bounds, keep_coords=keep_coords)
+
+    cache_file = _cache_path(cache_dir, geofile, scale, proj, 'geoloc', bounds)
+    if cache_file.is_file():
+        try:
+            geoloc_file = ProcessedGeolocFile.load(cache_file)
+            logger.debug(f'геолокация загружена из кэша {cache_file}')
+            return geoloc_file
+        except Exception as exc:
+            logger.warning(f'не удалось прочитать кэш геолокации {cache_file}: {exc}')
+
+    geoloc_file = process_geoloc_file(geofile, scale, proj=proj, bounds=bounds, keep_coords=keep_coords)
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    geoloc_file.save(cache_file)
+    return geoloc_file
 
+
+def _load_cached_resampler(resampler_class, cache_file: Path, geoloc_file: ProcessedGeolocFile):
+    if not cache_file.is_file():
+        return None
+    try:
+        resampler = resampler_class.load(cache_file)
+        if resampler.out_image_shape == tuple(geoloc_file.out_image_shape) and \
+                resampler.samples_count == geoloc_file.samples_count:
+            logger.debug(f'оператор перепроецирования загружен из кэша {cache_file}')
+            return resampler
+        logger.warning(f'кэш оператора перепроецирования {cache_file} не соответствует геолокации')
+    except Exception as exc:
+        logger.warning(f'не удалось прочитать кэш оператора перепроецирования {cache_file}: {exc}')
+    return None
+
+
+def get_sparse_resampler(geofile: GeofileInfo, geoloc_file: ProcessedGeolocFile, proj=None,
+                         cache_dir: Union[str, Path] = None, method: str = RESAMPLE_MEAN,
+                         fill_distance: int = 10, bounds: Bounds = None) -> SparseResampler:
+    """
+    Возвращает разреженный оператор перепроецирования для файла геолокации,
+    кэш хранится рядом с кэшем геолокации
+    """
+    if cache_dir is None:
+        return SparseResampler.from_geoloc(geoloc_file, method=method, fill_distance=fill_distance)
+
+    cache_file = _cache_path(cache_dir, geofile, geoloc_file.scale, proj, f'resampler_{method}_{fill_distance}',
+                             bounds)
+    resampler = _load_cached_resampler(SparseResampler, cache_file, geoloc_file)
+    if resampler is None:
+        resampler = SparseResampler.from_geoloc(geoloc_file, method=method, fill_distance=fill_distance)
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        resampler.save(cache_file)
+    return resampler
+
+
+def get_kdtree_resampler(geofile: GeofileInfo, geoloc_file: ProcessedGeolocFile, proj=None,
+                         cache_dir: Union[str, Path] = None, radius: float = 3.0,
+                         bounds: Bounds = None) -> KDTreeResampler:
+    """
+    Возвращает индекс ближайших точек (KDTreeResampler) для файла геолокации,
+    кэш хранится рядом с кэшем геолокации.
+    Если в geoloc_file нет дробных координат точек, файл геолокации будет обработан повторно.
+    """
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = _cache_path(cache_dir, geofile, geoloc_file.scale, proj, f'kdtree_{radius:g}', bounds)
+        resampler = _load_cached_resampler(KDTreeResampler, cache_file, geoloc_file)
+        if resampler is not None:
+            return resampler
+
+    if geoloc_file.x_coords is None:
+        logger.debug('в обработанной геолокации нет координат точек, повторная обработка ' + geofile.name)
+        geoloc_file = process_geoloc_file(geofile, geoloc_file.scale, proj=proj, keep_coords=True, bounds=bounds)
+
+    resampler = KDTreeResampler.from_geoloc(geoloc_file, radius=radius)
+    if cache_file is not None:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        resampler.save(cache_file)
+    return resampler
+
+
+def _clip_to_bounds(lonlat_mask: np.ndarray, x: np.ndarray, y: np.ndarray, bounds: Bounds):
+    """
+    Отбрасывает точки за пределами bounds, маска lonlat_mask изменяется на месте
+    """
+    inside = utility.points_in_bounds(x, y, bounds)
+    lonlat_mask[lonlat_mask] = inside
+    if not inside.any():
+        raise InvalidData(f'ни одна точка снимка не попадает в область {bounds}')
+    return x[inside], y[inside]
+
+
+def _find_lonlat_subdatasets(geofile: GeofileInfo):
     with rasterio.open(geofile.path) as f:
         try:
             lat_dataset = next(ds for ds in f.subdatasets if ds.endswith('/Latitude'))
             lon_dataset = next(ds for ds in f.subdatasets if ds.endswith('/Longitude'))
         except StopIteration:
             raise SubDatasetNotFound('не удалось найти датасеты широты и долготы')
+    return lat_dataset, lon_dataset
+
+
+def process_geoloc_file(geofile: GeofileInfo, scale: Number, proj=None, keep_coords=False,
+                        bounds: Bounds = None) -> ProcessedGeolocFile:
+    """
+    Обробатывает файл геолокации
+
+    :param keep_coords: если True, сохраняет дробные координаты точек в пикселях (x_coords, y_coords),
+        они нужны для построения KDTreeResampler
+    :param bounds: (xmin, ymin, xmax, ymax) в координатах проекции, точки за пределами этой области
+        отбрасываются (считаются точками с некорректной геолокацией)
+    """
+    assert geofile.is_geoloc, (
+        f'{geofile.name} не является геолокационным файлом, '
+        f'поддерживаемые форматы: {", ".join(GeofileInfo.GEOLOC_SDR + GeofileInfo.GEOLOC_EDR)}'
+    )
+
+    lat_dataset, lon_dataset = _find_lonlat_subdatasets(geofile)
 
     with rasterio.open(lat_dataset) as lat_ds:
         lat = lat_ds.read(1)
@@ -110,20 +310,25 @@ def process_geoloc_file(geofile: GeofileInfo, scale: Number, proj=None) -> Proce
     projection = pyproj.Proj(proj or PROJ_LCC)
     logger.info('ОБРАБОТКА ' + geofile.name)
     logger.debug(f'lat.shape = lon.shape = {lat.shape}')
-    lonlat_mask = (lon > -200) * (lat > -200)
+    lonlat_mask = (lon > -200) & (lat > -200)
     nodata_values = len(lonlat_mask[lonlat_mask == False])
     logger.debug(f'Обнаружено {nodata_values} значений nodata в массивах широты и долготы')
 
     lat_masked = lat[lonlat_mask]
     lon_masked = lon[lonlat_mask]
+    del lat, lon
 
     started_at = datetime.now()
     logger.info('ПРОЕКЦИЯ...')
     x_index, y_index = projection(lon_masked, lat_masked)
+    del lon_masked, lat_masked
     logger.info(f'ПРОЕКЦИЯ. ГОТОВО: {(datetime.now() - started_at).seconds}s')
     assert x_index.shape == y_index.shape, 'x_index.shape != y_index.shape'
     assert np.all(np.isfinite(x_index)), 'x_index contains non-finite numbers'
     assert np.all(np.isfinite(x_index)), 'y_index contains non-finite numbers'
+    if bounds is not None:
+        x_index, y_index = _clip_to_bounds(lonlat_mask, x_index, y_index, bounds)
+    x_proj, y_proj = (x_index, y_index) if keep_coords else (None, None)
     x_index, y_index = np.int_(np.round(x_index)), np.int_(np.round(y_index))
 
     x_min = x_index.min()
@@ -131,49 +336,67 @@ def process_geoloc_file(geofile: GeofileInfo, scale: Number, proj=None) -> Proce
 
     # подсчитывает индексы для пикселей с учетом масштаба
     x_index, y_index = np.int_(np.round(x_index / scale)), np.int_(np.round(y_index / scale))
-    x_index -= x_index.min()
-    y_index -= y_index.min()
+    x_offset, y_offset = x_index.min(), y_index.min()
+    x_index -= x_offset
+    y_index -= y_offset
 
     out_image_shape = y_index.max() + 1, x_index.max() + 1
 
+    # линейный индекс пикселя в перевернутом по вертикали изображении
+    y_index *= -1
+    y_index += out_image_shape[0] - 1
+    y_index *= out_image_shape[1]
+    y_index += x_index
+    del x_index
+    linear_index = y_index.astype('int32')
+    del y_index
+
+    if keep_coords:
+        # координаты точек в пикселях выходного изображения (после переворота по вертикали)
+        x_coords = (x_proj / scale - x_offset).astype('float32')
+        y_coords = (out_image_shape[0] - 1 - (y_proj / scale - y_offset)).astype('float32')
+        del x_proj, y_proj
+    else:
+        x_coords, y_coords = None, None
+
     logger.info('ОБРАБОТКА ЗАВЕРШЕНА ' + geofile.name)
     return ProcessedGeolocFile(
-        x_index=x_index,
-        y_index=y_index,
+        linear_index=linear_index,
         lonlat_mask=lonlat_mask,
         geotransform_max_y=y_max,
         geotransform_min_x=x_min,
         projection=projection,
         scale=scale,
-        out_image_shape=out_image_shape
+        out_image_shape=out_image_shape,
+        x_coords=x_coords,
+        y_coords=y_coords
     )
 
 
-def process_band_file(geofile: GeofileInfo,
-                      geoloc_file: ProcessedGeolocFile,
-                      no_data_threshold: Number = 60000) -> np.ndarray:
+def _find_band_subdatasets(geofile: GeofileInfo):
     """
-    Обрабатывает band-файл
+    Возвращает пути к субдатасету с данными канала и к маске BANDSDR (или None, если маски нет)
     """
-    _require_band_notimpl(geofile)
-
-    logger.info(f'ОБРАБОТКА {geofile.band_verbose}: {geofile.name}')
-    ts = time.time()
-
     dataset_name = geofile.get_band_dataset()
     with rasterio.open(geofile.path) as f:
         try:
             dataset_path = next(ds for ds in f.subdatasets if ds.endswith('/' + dataset_name))
         except StopIteration:
             raise SubDatasetNotFound(dataset_name)
+        sdr_mask_path = next((ds for ds in f.subdatasets if ds.endswith('BANDSDR')), None)
+    return dataset_path, sdr_mask_path
 
-        try:
-            sdr_mask = next(ds for ds in f.subdatasets if ds.endswith('BANDSDR'))
-            with rasterio.open(sdr_mask) as sdr_mask_f:
-                sdr_mask = sdr_mask_f.read(1)
-        except StopIteration:
-            sdr_mask = None
-            pass
+
+def _read_band_file(geofile: GeofileInfo) -> np.ndarray:
+    """
+    Читает данные канала, значения помеченные в BANDSDR как плохие заменяются на ND_NA
+    """
+    dataset_path, sdr_mask_path = _find_band_subdatasets(geofile)
+    if sdr_mask_path is not None:
+        with rasterio.open(sdr_mask_path) as sdr_mask_f:
+            sdr_mask = sdr_mask_f.read(1)
+    else:
+        sdr_mask = None
 
     with rasterio.open(dataset_path) as f:
         arr = f.read(1)
@@ -181,21 +404,58 @@ def process_band_file(geofile: GeofileInfo,
     if sdr_mask is not None:
         arr[sdr_mask > 32] = ND_NA
         del sdr_mask
+    return arr
+
+
+def _apply_band_factors(image: np.ndarray, geofile: GeofileInfo, mask: np.ndarray = None):
+    dataset_name = geofile.get_band_dataset()
+    data = utility.h5py_get_dataset(geofile.path, dataset_name + "Factors")
+    if data is not None:
+        if mask is None:
+            mask = np.isfinite(image)
+        image[mask] *= data[0]
+        image[mask] += data[1]
+    else:
+        logger.warning('Не удалось получить ' + dataset_name + "Factors")
+    return image
 
+
+def process_band_file(geofile: GeofileInfo,
+                      geoloc_file: ProcessedGeolocFile,
+                      no_data_threshold: Number = 60000) -> np.ndarray:
+    """
+    Обрабатывает band-файл
+    """
+    _require_band_notimpl(geofile)
+
+    logger.info(f'ОБРАБОТКА {geofile.band_verbose}: {geofile.name}')
+    ts = time.time()
+
+    arr = _read_band_file(geofile)
     arr = arr[geoloc_file.lonlat_mask]
-    x_index = geoloc_file.x_index
-    y_index = geoloc_file.y_index
-    assert x_index.shape == arr.shape, f'x_index.shape != arr.shape {x_index.shape} {arr.shape}'
-    assert y_index.shape == arr.shape, 'y_index.shape != arr.shape {x_index.shape} {arr.shape}'
+    linear_index = geoloc_file.linear_index
+    assert linear_index.shape == arr.shape, f'linear_index.shape != arr.shape {linear_index.shape} {arr.shape}'
     image_shape = geoloc_file.out_image_shape
     logger.debug(f'image_shape={image_shape}')
     assert len(image_shape) == 2
     assert all(d > 1 for d in image_shape), 'image must be at least 2x2'
 
+    # linear_index уже учитывает переворот изображения по вертикали
     image = np.zeros(image_shape, 'float32')
-    image[y_index, x_index] = arr.astype('float32')
+    image.ravel()[linear_index] = arr
     del arr
-    image = np.flip(image, 0)
+    image = _finalize_band_image(image, geofile, no_data_threshold)
+    ts = time.time() - ts
+    logger.info(f'ОБРАБОТАН {geofile.band_verbose}: {int(ts * 1000)}ms')
+
+    return image
+
+
+def _finalize_band_image(image: np.ndarray, geofile: GeofileInfo, no_data_threshold: Number) -> np.ndarray:
+    """
+    Заполняет пустоты в изображении канала, полученном разбросом точек по пикселям,
+    заменяет nodata на nan и применяет коэфициенты (factors)
+    """
     image[image == ND_OBPT] = 0
     image[np.isnan(image)] = 0
     image = _fill_nodata(image, nd_value=0, smoothing_iterations=0, max_search_dist=10)
@@ -204,25 +464,66 @@ def process_band_file(geofile: GeofileInfo,
     image[mask] = np.nan
     image[image == 0] = np.nan
     # factors
-    data = utility.h5py_get_dataset(geofile.path, dataset_name + "Factors")
-    if data is not None:
-        mask = ~mask
-        image[mask] *= data[0]
-        image[mask] += data[1]
-    else:
-        logger.warning('Не удалось получить ' + dataset_name + "Factors")
-    ts = time.time() - ts
-    logger.info(f'ОБРАБОТАН {geofile.band_verbose}: {int(ts * 1000)}ms')
-
+    _apply_band_factors(image, geofile, ~mask)
     return image
 
 
+def read_band_samples(geofile: GeofileInfo,
+                      geoloc_file: ProcessedGeolocFile,
+                      no_data_threshold: Number = 60000) -> np.ndarray:
+    """
+    Возвращает значения канала для всех точек снимка с корректной геолокацией (в порядке
+    ProcessedGeolocFile.linear_index) в виде float32, nodata значения заменяются на nan
+    """
+    _require_band_notimpl(geofile)
+    arr = _read_band_file(geofile)[geoloc_file.lonlat_mask].astype('float32')
+    assert arr.shape == geoloc_file.linear_index.shape, \
+        f'linear_index.shape != arr.shape {geoloc_file.linear_index.shape} {arr.shape}'
+    arr[(arr > no_data_threshold) | (arr == 0)] = np.nan
+    return arr
+
+
+def _resample_band_files(geoloc_file: ProcessedGeolocFile,
+                         resampler: Union[SparseResampler, KDTreeResampler],
+                         files: List[GeofileInfo]) -> np.ndarray:
+    """
+    Перепроецирует все каналы за один раз: одно умножение разреженной матрицы на матрицу (точки x каналы)
+    для SparseResampler или одна выборка по индексу для KDTreeResampler
+    """
+    assert len(files) > 0, 'bands list is empty'
+    ts = time.time()
+
+    samples = np.full((geoloc_file.samples_count, len(files)), np.nan, 'float32')
+    valid_files = []
+    for index, file in enumerate(files):
+        try:
+            samples[:, index] = read_band_samples(file, geoloc_file)
+            valid_files.append(index)
+        except Exception as e:
+            logger.warning('Не удалось обработать файл ' + file.path + ' - исключение будет отправлено в лог (см. ниже)')
+            logger.error(e)
+
+    if len(valid_files) == 0:
+        raise ProcessingException('Не удалось обработать файл: все каналы датасета повреждены (см. ошибки выше)')
+
+    bands = resampler.resample(samples)
+    del samples
+    for index in valid_files:
+        _apply_band_factors(bands[index], files[index])
+    ts = time.time() - ts
+    logger.info(f'ОБРАБОТАНО {len(files)} каналов ({type(resampler).__name__}): {int(ts * 1000)}ms')
+    return bands
+
+
 def _process_band_files(geoloc_file: ProcessedGeolocFile,
-                        files: List[GeofileInfo]) -> np.ndarray:
+                        files: List[GeofileInfo], workers: int = None) -> np.ndarray:
     assert len(files) > 0, 'bands list is empty'
     assert len(
         set(b.band for b in files)) == 1, 'bands passed to _process_band_files_gen belong to different band types'
 
+    if workers is not None and workers > 1 and len(files) > 1:
+        return _process_band_files_shared(geoloc_file, files, workers)
+
     arrays = []
 
     for index, file in enumerate(files):
@@ -247,20 +548,242 @@ def _process_band_files(geoloc_file: ProcessedGeolocFile,
     return np.array(arrays)
 
 
-def process_ndvi(input_file: str, output_file: str, cloud_mask_file: str = None):
+def _process_band_file_into(geofile: GeofileInfo, geoloc_file: sharedmem.SharedGeolocFile,
+                            bands: sharedmem.SharedArray, index: int):
+    """
+    Задача процесса-исполнителя: строит сетку канала и записывает ее в bands.data[index]
+    """
+    bands.data[index] = process_band_file(geofile, geoloc_file.open())
+    bands.release()
+
+
+def _process_band_files_shared(geoloc_file: ProcessedGeolocFile, files: List[GeofileInfo],
+                               workers: int) -> np.ndarray:
+    """
+    То же, что _process_band_files, но каналы обрабатываются в отдельных процессах: геолокация копируется
+    в разделяемую память один раз, а процессы записывают каналы сразу в общий массив (каналы, высота, ширина),
+    поэтому ни геолокация, ни сетки каналов не сериализуются.
+    """
+    with sharedmem.SharedArena() as arena:
+        shared_geoloc = arena.share_geoloc(geoloc_file)
+        # поврежденные каналы остаются заполненными nan
+        bands = arena.empty((len(files),) + geoloc_file.out_image_shape, 'float32', transform=geoloc_file.transform,
+                            crs=geoloc_file.projection.srs, fill_value=np.nan)
+        failed = 0
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, len(files))) as executor:
+            futures = [executor.submit(_process_band_file_into, file, shared_geoloc, bands, index)
+                       for index, file in enumerate(files)]
+            for index, (file, future) in enumerate(zip(files, futures)):
+                exc = future.exception()
+                if exc is not None:
+                    logger.warning('Не удалось обработать файл ' + file.path + ' - исключение будет отправлено в лог (см. ниже)')
+                    logger.error(exc)
+                    logger.debug(f'Канал {index + 1} поврежден (см. выше) - заполнение nan')
+                    failed += 1
+        if failed == len(files):
+            raise ProcessingException('Не удалось обработать файл: все каналы датасета повреждены (см. ошибки выше)')
+        # данные остаются доступны после удаления сегмента при выходе из арены
+        return np.asarray(bands.data)
+
+
+def get_swath_sample(geofile: GeofileInfo, proj=None, step: int = 16):
+    """
+    Читает каждую step-ую строку и столбец широты и долготы (без чтения всего файла) и проецирует их.
+    Используется для быстрой проверки попадания витка в область интереса.
+
+    :return: координаты x и y (в координатах проекции) точек с корректной геолокацией
+    """
+    lat = utility.h5py_get_dataset_decimated(geofile.path, 'Latitude', step)
+    lon = utility.h5py_get_dataset_decimated(geofile.path, 'Longitude', step)
+    if lat is None or lon is None:
+        raise SubDatasetNotFound('не удалось найти датасеты широты и долготы')
+    mask = (lon > -200) & (lat > -200)
+    projection = pyproj.Proj(proj or PROJ_LCC)
+    return projection(lon[mask], lat[mask])
+
+
+def get_solar_zenith_sample(geofile: GeofileInfo, step: int = 16) -> np.ndarray:
+    """
+    Читает каждую step-ую строку и столбец зенитного угла солнца (SolarZenithAngle) из файла геолокации.
+
+    :return: значения зенитного угла в градусах для точек с корректными значениями
+    """
+    sza = utility.h5py_get_dataset_decimated(geofile.path, 'SolarZenithAngle', step)
+    if sza is None:
+        raise SubDatasetNotFound('SolarZenithAngle')
+    return sza[(sza >= 0) & (sza <= 180)]
+
+
+# количество строк в одном скане для каждого типа канала
+_SCAN_ROWS = {
+    'I': 32,
+    'M': 16,
+    'DN': 16
+}
+
+
+def _iter_row_windows(height: int, width: int, block_rows: int):
+    for row in range(0, height, block_rows):
+        yield rasterio.windows.Window(0, row, width, min(block_rows, height - row))
+
+
+def _project_lonlat_block(lat_ds, lon_ds, window, projection: pyproj.Proj, bounds: Bounds = None):
+    """
+    Читает блок широты и долготы и возвращает маску корректной геолокации блока и
+    спроецированные координаты (в метрах, округленные) точек с корректной геолокацией
+    """
+    lat = lat_ds.read(1, window=window)
+    lon = lon_ds.read(1, window=window)
+    mask = (lon > -200) & (lat > -200)
+    x, y = projection(lon[mask], lat[mask])
+    del lat, lon
+    assert np.all(np.isfinite(x)), 'x_index contains non-finite numbers'
+    assert np.all(np.isfinite(y)), 'y_index contains non-finite numbers'
+    if bounds is not None:
+        inside = utility.points_in_bounds(x, y, bounds)
+        mask[mask] = inside
+        x, y = x[inside], y[inside]
+    return mask, np.int_(np.round(x)), np.int_(np.round(y))
+
+
+def _process_fileset_blocks(fileset: ViirsFileset, scale: Number, block_rows: int, proj=None,
+                            no_data_threshold: Number = 60000, bounds: Bounds = None):
+    """
+    Потоковая обработка набора файлов: широта/долгота и каналы читаются блоками строк, выровненными по сканам.
+
+    Первый проход по геолокации определяет размер выходного изображения, второй - проецирует каждый блок
+    повторно и раскладывает значения всех каналов блока по пикселям. Результат совпадает с обработкой
+    целиком (process_geoloc_file + process_band_file), т. к. порядок записи точек в пиксели тот же.
+
+    :return: массив (каналы, высота, ширина) и Affine transform
+    """
+    scan_rows = _SCAN_ROWS.get(fileset.geoloc_file.band, 16)
+    block_rows = max(1, int(np.ceil(block_rows / scan_rows))) * scan_rows
+    projection = pyproj.Proj(proj or PROJ_LCC)
+    lat_dataset, lon_dataset = _find_lonlat_subdatasets(fileset.geoloc_file)
+    ts = time.time()
+    logger.info(f'ОБРАБОТКА БЛОКАМИ ({block_rows} строк) ' + fileset.geoloc_file.name)
+
+    with rasterio.open(lat_dataset) as lat_ds, rasterio.open(lon_dataset) as lon_ds:
+        swath_height, swath_width = lat_ds.height, lat_ds.width
+        windows = list(_iter_row_windows(swath_height, swath_width, block_rows))
+
+        # первый проход - границы изображения
+        x_min = y_min = np.iinfo(np.int_).max
+        x_max = y_max = np.iinfo(np.int_).min
+        for window in windows:
+            _, x, y = _project_lonlat_block(lat_ds, lon_ds, window, projection, bounds)
+            if x.shape[0] == 0:
+                continue
+            x_min, x_max = min(x_min, x.min()), max(x_max, x.max())
+            y_min, y_max = min(y_min, y.min()), max(y_max, y.max())
+        if x_min > x_max:
+            raise InvalidData('в файле геолокации нет ни одной точки с корректными координатами'
+                              + ('' if bounds is None else f' в области {bounds}'))
+
+        x_offset, y_offset = int(np.round(x_min / scale)), int(np.round(y_min / scale))
+        height = int(np.round(y_max / scale)) - y_offset + 1
+        width = int(np.round(x_max / scale)) - x_offset + 1
+        assert height > 1 and width > 1, 'image must be at least 2x2'
+        logger.debug(f'image_shape={(height, width)}')
+
+        # открываем все каналы, поврежденные каналы заполняются nan
+        band_sources = []
+        for file in fileset.band_files:
+            try:
+                _require_band_notimpl(file)
+                dataset_path, sdr_mask_path = _find_band_subdatasets(file)
+                band_sources.append((rasterio.open(dataset_path),
+                                     rasterio.open(sdr_mask_path) if sdr_mask_path else None))
+            except Exception as e:
+                logger.warning('Не удалось обработать файл ' + file.path + ' - исключение будет отправлено в лог (см. ниже)')
+                logger.error(e)
+                band_sources.append(None)
+        if all(v is None for v in band_sources):
+            raise ProcessingException('Не удалось обработать файл: все каналы датасета повреждены (см. ошибки выше)')
+
+        bands = np.zeros((len(band_sources), height, width), 'float32')
+        try:
+            # второй проход - раскладываем значения всех каналов блока по пикселям
+            for window in windows:
+                mask, x, y = _project_lonlat_block(lat_ds, lon_ds, window, projection, bounds)
+                x = np.round(x / scale).astype(np.int_) - x_offset
+                y = np.round(y / scale).astype(np.int_) - y_offset
+                linear_index = (height - 1 - y) * width + x
+                del x, y
+                for index, source in enumerate(band_sources):
+                    if source is None:
+                        continue
+                    data_ds, sdr_mask_ds = source
+                    arr = data_ds.read(1, window=window)
+                    if sdr_mask_ds is not None:
+                        arr[sdr_mask_ds.read(1, window=window) > 32] = ND_NA
+                    bands[index].ravel()[linear_index] = arr[mask]
+                    del arr
+        finally:
+            for source in band_sources:
+                if source is not None:
+                    for ds in source:
+                        if ds is not None:
+                            ds.close()
+
+    for index, (file, source) in enumerate(zip(fileset.band_files, band_sources)):
+        if source is None:
+            logger.debug(f'Канал {index + 1} поврежден (см. выше) - заполнение nan')
+            bands[index] = np.nan
+        else:
+            bands[index] = _finalize_band_image(bands[index], file, no_data_threshold)
+
+    ts = time.time() - ts
+    logger.info(f'ОБРАБОТКА БЛОКАМИ ЗАВЕРШЕНА {fileset.geoloc_file.name}: {int(ts * 1000)}ms')
+    transform = Affine.translation(x_min, y_max) * Affine.scale(scale, -scale)
+    return bands, transform
+
+
+def calc_ndvi(svi01: np.ndarray, svi02: np.ndarray, transform: Affine, cloud_mask_file: str = None,
+              crs=None, warp_cloud_mask: bool = False, projected_cloud_mask_file: str = None) -> np.ndarray:
+    """
+    Считает NDVI по каналам SVI01 (красный) и SVI02 (ближний ИК) и применяет маску облачности
+    (облачные пиксели получают значение -2).
+
+    :param transform: Affine transform каналов, нужен для совмещения с маской облачности
+    :param crs: проекция каналов, нужна только при warp_cloud_mask=True
+    :param warp_cloud_mask: если True, cloud_mask_file - исходная маска облачности (level2), которая
+        перепроецируется сразу на сетку NDVI (см. warp_cloud_mask_to_grid), иначе - уже перепроецированная
+        маска (см. process_cloud_mask), которая совмещается с NDVI по пересечению
+    :param projected_cloud_mask_file: если указан (и warp_cloud_mask=True), маска облачности на сетке NDVI
+        записывается в этот файл
+    """
+    ndvi = (svi02 - svi01) / (svi01 + svi02)
+    if cloud_mask_file:
+        try:
+            if warp_cloud_mask:
+                clouds = warp_cloud_mask_to_grid(cloud_mask_file, transform, ndvi.shape, crs)
+                if projected_cloud_mask_file:
+                    meta = utility.make_rasterio_meta(ndvi.shape[0], ndvi.shape[1], 1, omit=['nodata'])
+                    meta.update({'transform': transform, 'crs': crs, 'dtype': rasterio.uint8})
+                    with rasterio.open(projected_cloud_mask_file, 'w', **meta) as f:
+                        f.write(clouds, 1)
+                ndvi = np.where(clouds == 4, ndvi.dtype.type(-2), ndvi)
+            else:
+                with rasterio.open(cloud_mask_file) as cmf:
+                    mask = cmf.read(1) == 4
+                    ndvi = utility.apply_mask(ndvi, transform, mask, cmf.transform, -2)
+        except Exception as exc:
+            logger.warning(f'ошибка при применениии маски облачности к NDVI: {exc}')
+    return ndvi
+
+
+def process_ndvi(input_file: str, output_file: str, cloud_mask_file: str = None, warp_cloud_mask: bool = False,
+                 projected_cloud_mask_file: str = None):
     """
     Получает NDVI и записывает его в файл.
+    Параметры маски облачности - см. calc_ndvi.
     """
     with rasterio.open(input_file) as f:
         svi01, svi02 = f.read(1), f.read(2)
-        ndvi = (svi02 - svi01) / (svi01 + svi02)
-        if cloud_mask_file:
-            with rasterio.open(cloud_mask_file) as cmf:
-                try:
-                    mask = cmf.read(1) == 4
-                    ndvi = utility.apply_mask(ndvi, f.transform, mask, cmf.transform, -2)
-                except Exception as exc:
-                    logger.warning(f'ошибка при применениии маски облачности к NDVI: {exc}')
+        ndvi = calc_ndvi(svi01, svi02, f.transform, cloud_mask_file, crs=f.crs, warp_cloud_mask=warp_cloud_mask,
+                         projected_cloud_mask_file=projected_cloud_mask_file)
         meta = utility.make_rasterio_meta(svi01.shape[0], svi02.shape[1], 1)
         meta.update({
             'transform': f.transform,
@@ -271,6 +794,41 @@ def process_ndvi(input_file: str, output_file: str, cloud_mask_file: str = None)
         f.write(ndvi, 1)
 
 
+def process_fileset_ndvi(fileset: ViirsFileset, output_file: str, scale=2000, cloud_mask_file: str = None,
+                         vimgo_file: str = None, proj=None, gridding: str = GRIDDING_SCATTER,
+                         cache_dir: Union[str, Path] = None, block_rows: int = None, bounds: Bounds = None,
+                         warp_cloud_mask: bool = False, projected_cloud_mask_file: str = None,
+                         workers: int = None):
+    """
+    Считает NDVI напрямую из набора файлов: сетка строится в памяти и NDVI считается сразу, без записи
+    и повторного чтения промежуточного файла со всеми каналами.
+    Остальные параметры такие же, как у process_fileset.
+
+    :param output_file: путь к файлу NDVI
+    :param cloud_mask_file: маска облачности (см. process_cloud_mask и calc_ndvi), None - не применять
+    :param vimgo_file: если указан, все каналы набора файлов также записываются в этот файл (как в process_fileset),
+        иначе сетка строится только для SVI01 и SVI02
+    """
+    band_types = [file.file_type for file in fileset.band_files]
+    if 'SVI01' not in band_types or 'SVI02' not in band_types:
+        raise InvalidData(f'для NDVI необходимы каналы SVI01 и SVI02, найдены: {", ".join(band_types)}')
+    if vimgo_file is None:
+        fileset = ViirsFileset(geoloc_file=fileset.geoloc_file,
+                               band_files=[file for file in fileset.band_files if file.file_type in ('SVI01', 'SVI02')])
+        band_types = [file.file_type for file in fileset.band_files]
+
+    data, transform = grid_fileset(fileset, scale, proj=proj, gridding=gridding, cache_dir=cache_dir,
+                                   block_rows=block_rows, bounds=bounds, workers=workers)
+    if vimgo_file is not None:
+        _write_bands(vimgo_file, data, transform, proj, band_types)
+
+    crs = rasterio.crs.CRS.from_wkt(proj or PROJ_LCC, morph_from_esri_dialect=True)
+    ndvi = calc_ndvi(data[band_types.index('SVI01')], data[band_types.index('SVI02')], transform, cloud_mask_file,
+                     crs=crs, warp_cloud_mask=warp_cloud_mask, projected_cloud_mask_file=projected_cloud_mask_file)
+    del data
+    _write_bands(output_file, ndvi.astype('float32', copy=False), transform, proj)
+
+
 def _require_file_type_notimpl(info: GeofileInfo, type_: str):
     if info.file_type != GIMGO:
         logger.error('Поддерживаются только файлы типа ' + type_)
@@ -319,6 +877,64 @@ def process_cloud_mask(input_file: str,
         f.write(data)
 
 
+@lru_cache(maxsize=16)
+def _cloud_mask_warp_plan(input_file: str, mtime: float, dst_bounds: Bounds, dst_crs_wkt: str):
+    """
+    Окно исходной маски облачности, покрывающее область dst_bounds (с запасом в 1 пиксель), и его transform.
+    Кэшируется, т. к. для одного витка и одной сетки окно всегда одно и то же.
+
+    :return: (окно, transform окна, проекция исходного файла) или None, если область не пересекается с маской
+    """
+    with rasterio.open(input_file) as f:
+        src_bounds = rasterio.warp.transform_bounds(dst_crs_wkt, f.crs, *dst_bounds, densify_pts=21)
+        window = rasterio.windows.from_bounds(*src_bounds, transform=f.transform)
+        col_off, row_off = int(np.floor(window.col_off)) - 1, int(np.floor(window.row_off)) - 1
+        window = rasterio.windows.Window(col_off, row_off,
+                                         int(np.ceil(window.col_off + window.width)) + 1 - col_off,
+                                         int(np.ceil(window.row_off + window.height)) + 1 - row_off)
+        try:
+            window = window.intersection(rasterio.windows.Window(0, 0, f.width, f.height))
+        except rasterio.errors.WindowError:
+            return None
+        return window, f.window_transform(window), f.crs
+
+
+def warp_cloud_mask_to_grid(input_file: str, transform: Affine, shape, crs=None) -> np.ndarray:
+    """
+    Перепроецирует маску облачности (level2) на заданную сетку методом ближайшего соседа,
+    читая из исходного файла только окно, покрывающее эту сетку.
+
+    :param input_file: исходная маска облачности
+    :param transform: Affine transform сетки (например, NDVI)
+    :param shape: (высота, ширина) сетки
+    :param crs: проекция сетки, по умолчанию - gdal_viirs.const.PROJ_LCC
+    :return: массив uint8 размера shape, пиксели вне исходной маски равны 0
+    """
+    if crs is None:
+        crs = rasterio.crs.CRS.from_wkt(PROJ_LCC, morph_from_esri_dialect=True)
+    height, width = shape
+    dst_bounds = rasterio.transform.array_bounds(height, width, transform)
+    clouds = np.zeros((height, width), 'uint8')
+
+    plan = _cloud_mask_warp_plan(input_file, os.path.getmtime(input_file), dst_bounds, crs.to_wkt())
+    if plan is None:
+        logger.warning(f'маска облачности {input_file} не пересекается с сеткой NDVI')
+        return clouds
+    window, src_transform, src_crs = plan
+
+    with rasterio.open(input_file) as f:
+        data = f.read(1, window=window)
+    rasterio.warp.reproject(
+        data, clouds,
+        src_transform=src_transform,
+        src_crs=src_crs,
+        dst_transform=transform,
+        dst_crs=crs,
+        resampling=Resampling.nearest
+    )
+    return clouds
+
+
 def calc_ndvi_dynamics(b1, b2):
     data = 100 * (b2 - b1) / b1
     data[data > 998] = 998
@@ -326,21 +942,348 @@ def calc_ndvi_dynamics(b1, b2):
     return data
 
 
+def _ndvi_dynamics_block(b1_data: np.ndarray, b2_data: np.ndarray) -> np.ndarray:
+    """
+    Динамика NDVI для двух выровненных массивов композитов: NaN - нет данных, -999 - облака
+    """
+    nan_mask = np.isnan(b1_data) | np.isnan(b2_data)
+    cloud_mask = (b1_data == -2) | (b2_data == -2)
+    data_mask = ~nan_mask * ~cloud_mask
+    b3 = np.full(b1_data.shape, np.nan, 'float32')
+    b3[data_mask] = calc_ndvi_dynamics(b1_data[data_mask], b2_data[data_mask])
+    b3[cloud_mask] = -999  # облака
+    return b3
+
+
 def process_ndvi_dynamics(composite_b1_input: str, composite_b2_input: str, output_file: str):
-    with rasterio.open(composite_b1_input) as b1_f:
-        with rasterio.open(composite_b2_input) as b2_f:
-            b1_data = b1_f.read(1)
-            b2_data = b2_f.read(1)
-            b1_data, b1_transform, b2_data, b2_transform = utility.crop_intersection(
-                b1_data, b1_f.transform, b2_data, b2_f.transform)
-
-            nan_mask = np.isnan(b1_data) | np.isnan(b2_data)
-            cloud_mask = (b1_data == -2) | (b2_data == -2)
-            data_mask = ~nan_mask * ~cloud_mask
-            b3 = np.full(b1_data.shape, np.nan, 'float32')
-            b3[data_mask] = calc_ndvi_dynamics(b1_data[data_mask], b2_data[data_mask])
-            b3[cloud_mask] = -999  # облака
-
-            with rasterio.open(output_file, 'w', driver='GTiff', count=1, crs=b1_f.crs, transform=b1_transform,
-                               nodata=np.nan, width=b3.shape[1], height=b3.shape[0], dtype='float32') as out:
-                out.write(b3, 1)
+    """
+    Динамика NDVI композита composite_b2_input относительно более раннего composite_b1_input
+    (см. process_ndvi_dynamics_multi), если композиты не пересекаются - файл не создается
+    """
+    process_ndvi_dynamics_multi(composite_b2_input, [composite_b1_input], [output_file])
+
+
+def _get_intersection_windows(b1_f: rasterio.DatasetReader, b2_f: rasterio.DatasetReader):
+    """
+    Окна двух растров с одинаковым разрешением, которые покрывают их общую область.
+    Если сетки растров совпадают, окна - растры целиком.
+
+    :return: пара окон одинакового размера или None, если растры не пересекаются
+    """
+    if b1_f.res != b2_f.res:
+        raise ValueError('вычисление пересечения невозможно для двух растров с разным масштабом')
+    if b1_f.transform == b2_f.transform and b1_f.shape == b2_f.shape:
+        window = rasterio.windows.Window(0, 0, b1_f.width, b1_f.height)
+        return window, window
+    left, bottom = max(b1_f.bounds.left, b2_f.bounds.left), max(b1_f.bounds.bottom, b2_f.bounds.bottom)
+    right, top = min(b1_f.bounds.right, b2_f.bounds.right), min(b1_f.bounds.top, b2_f.bounds.top)
+    if left >= right or bottom >= top:
+        return None
+    windows = []
+    for f in (b1_f, b2_f):
+        window = rasterio.windows.from_bounds(left, bottom, right, top, f.transform)
+        windows.append((round(window.col_off), round(window.row_off), round(window.width), round(window.height)))
+    width = min(w[2] for w in windows)
+    height = min(w[3] for w in windows)
+    if width <= 0 or height <= 0:
+        return None
+    return tuple(rasterio.windows.Window(w[0], w[1], width, height) for w in windows)
+
+
+def process_ndvi_dynamics_multi(composite_b2_input: str, composite_b1_inputs: List[str], output_files: List[str],
+                                block_rows: int = 512) -> List[str]:
+    """
+    Динамика NDVI одного (текущего) композита относительно нескольких более ранних за один проход: текущий
+    композит читается один раз, полосами по block_rows строк, и каждая полоса сравнивается со всеми ранними
+    композитами. Каждый результат - общая область пары композитов в сетке раннего композита, выравнивание
+    считается по границам растров и пропускается, если сетки совпадают.
+
+    :param composite_b2_input: текущий композит
+    :param composite_b1_inputs: ранние композиты
+    :param output_files: выходные файлы для каждого раннего композита
+    :param block_rows: количество строк, которые читаются за раз
+    :return: созданные файлы (пары композитов без общей области пропускаются)
+    """
+    if len(composite_b1_inputs) != len(output_files):
+        raise ValueError('количество выходных файлов должно совпадать с количеством ранних композитов')
+    created = []
+    opened = []
+    with rasterio.open(composite_b2_input) as b2_f:
+        try:
+            pairs = []
+            for b1_input, output_file in zip(composite_b1_inputs, output_files):
+                b1_f = rasterio.open(b1_input)
+                opened.append(b1_f)
+                windows = _get_intersection_windows(b1_f, b2_f)
+                if windows is None:
+                    logger.warning(f'композиты {b1_input} и {composite_b2_input} не пересекаются, '
+                                   f'динамика {output_file} не будет создана')
+                    continue
+                b1_window, b2_window = windows
+                out = rasterio.open(output_file, 'w', driver='GTiff', count=1, crs=b1_f.crs,
+                                    transform=b1_f.window_transform(b1_window), nodata=np.nan,
+                                    width=b1_window.width, height=b1_window.height, dtype='float32')
+                opened.append(out)
+                pairs.append((b1_f, b1_window, b2_window, out))
+                created.append(output_file)
+            if not pairs:
+                return created
+
+            # читаем из текущего композита только полосу, покрывающую окна всех пар
+            col_start = min(p[2].col_off for p in pairs)
+            col_end = max(p[2].col_off + p[2].width for p in pairs)
+            row_start = min(p[2].row_off for p in pairs)
+            row_end = max(p[2].row_off + p[2].height for p in pairs)
+            for row in range(row_start, row_end, block_rows):
+                block_height = min(block_rows, row_end - row)
+                b2_block = b2_f.read(1, window=rasterio.windows.Window(col_start, row, col_end - col_start,
+                                                                       block_height))
+                for b1_f, b1_window, b2_window, out in pairs:
+                    top = max(row, b2_window.row_off)
+                    bottom = min(row + block_height, b2_window.row_off + b2_window.height)
+                    if top >= bottom:
+                        continue
+                    b2_data = b2_block[top - row:bottom - row,
+                                       b2_window.col_off - col_start:b2_window.col_off - col_start + b2_window.width]
+                    out_row = top - b2_window.row_off
+                    b1_data = b1_f.read(1, window=rasterio.windows.Window(
+                        b1_window.col_off, b1_window.row_off + out_row, b1_window.width, bottom - top))
+                    out.write(_ndvi_dynamics_block(b1_data, b2_data), 1,
+                              window=rasterio.windows.Window(0, out_row, b1_window.width, bottom - top))
+        finally:
+            for f in opened:
+                f.close()
+    return created
+
+
+class BandExpression(NamedTuple):
+    """
+    Индекс, который считается по каналам выражением (см. process_band_math)
+    """
+    # выражение над каналами (SVI01, SVI02, ...): числа, + - * / **, унарный минус и функции из _EXPRESSION_FUNCTIONS
+    expression: str
+    # значение облачных пикселей, None - маска облачности не применяется
+    cloud_value: Optional[float] = -2
+    # допустимый диапазон значений (min, max), значения вне диапазона заменяются на nan
+    valid_range: Optional[Tuple[float, float]] = None
+
+
+BAND_INDICES = {
+    'ndvi': BandExpression('(SVI02 - SVI01) / (SVI02 + SVI01)'),
+    # двухканальный EVI (EVI2, Jiang et al. 2008): в I-каналах VIIRS нет синего канала, нужного для EVI
+    'evi2': BandExpression('2.5 * (SVI02 - SVI01) / (SVI02 + 2.4 * SVI01 + 1)', valid_range=(-1, 1)),
+    # NDWI (Gao 1996): ближний ИК и коротковолновый ИК (SVI03, 1.61 мкм)
+    'ndwi': BandExpression('(SVI02 - SVI03) / (SVI02 + SVI03)', valid_range=(-1, 1)),
+    # яркостная температура SVI05 (11.45 мкм), K
+    'bt_i5': BandExpression('SVI05', cloud_value=None),
+}
+
+_EXPRESSION_BINARY_OPS = {
+    ast.Add: np.add,
+    ast.Sub: np.subtract,
+    ast.Mult: np.multiply,
+    ast.Div: np.true_divide,
+    ast.Pow: np.power,
+}
+_EXPRESSION_UNARY_OPS = {
+    ast.USub: np.negative,
+    ast.UAdd: np.positive,
+}
+_EXPRESSION_FUNCTIONS = {
+    'sqrt': np.sqrt,
+    'log': np.log,
+    'exp': np.exp,
+    'abs': np.abs,
+    'minimum': np.fmin,
+    'maximum': np.fmax,
+}
+
+
+class _ExpressionProgram:
+    """
+    Выражение, скомпилированное в последовательность ufunc, каждая из которых пишет результат (out=)
+    в один из временных буферов. Буферы освобождаются, как только результат использован, поэтому их
+    количество (slots) - не больше глубины выражения, а сами буферы выделяются один раз на все блоки.
+    """
+
+    def __init__(self, expression: str):
+        self.expression = expression
+        self.bands: List[str] = []
+        self.steps = []
+        self.slots = 0
+        self._free_slots = []
+        try:
+            tree = ast.parse(expression, mode='eval')
+        except SyntaxError as exc:
+            raise ValueError(f'не удалось разобрать выражение "{expression}": {exc}')
+        self.result = self._compile(tree.body)
+
+    def _release(self, operand):
+        if operand[0] == 'slot':
+            self._free_slots.append(operand[1])
+
+    def _emit(self, ufunc, operands) -> tuple:
+        for operand in operands:
+            self._release(operand)
+        if self._free_slots:
+            slot = self._free_slots.pop()
+        else:
+            slot = self.slots
+            self.slots += 1
+        self.steps.append((ufunc, operands, slot))
+        return 'slot', slot
+
+    def _compile(self, node) -> tuple:
+        if isinstance(node, ast.Name):
+            if node.id not in self.bands:
+                self.bands.append(node.id)
+            return 'band', node.id
+        # ast.Num - для python < 3.8
+        if type(node).__name__ in ('Constant', 'Num'):
+            value = getattr(node, 'value', getattr(node, 'n', None))
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                return 'const', np.float32(value)
+        elif isinstance(node, ast.BinOp) and type(node.op) in _EXPRESSION_BINARY_OPS:
+            operands = self._compile(node.left), self._compile(node.right)
+            return self._emit(_EXPRESSION_BINARY_OPS[type(node.op)], operands)
+        elif isinstance(node, ast.UnaryOp) and type(node.op) in _EXPRESSION_UNARY_OPS:
+            return self._emit(_EXPRESSION_UNARY_OPS[type(node.op)], (self._compile(node.operand),))
+        elif isinstance(node, ast.Call) and isinstance(node.func, ast.Name) \
+                and node.func.id in _EXPRESSION_FUNCTIONS and not node.keywords:
+            ufunc = _EXPRESSION_FUNCTIONS[node.func.id]
+            if len(node.args) != ufunc.nin:
+                raise ValueError(f'функция {node.func.id} принимает {ufunc.nin} аргумента(ов): {self.expression}')
+            return self._emit(ufunc, tuple(self._compile(arg) for arg in node.args))
+        raise ValueError(f'недопустимый элемент выражения "{self.expression}": {ast.dump(node)}')
+
+    def evaluate(self, bands: Dict[str, np.ndarray], buffers: List[np.ndarray]) -> np.ndarray:
+        """
+        :param bands: каналы блока (не изменяются)
+        :param buffers: self.slots временных буферов размера блока
+        :return: результат - один из буферов или канал (если выражение - просто канал)
+        """
+        def value(operand):
+            kind, v = operand
+            if kind == 'band':
+                return bands[v]
+            return buffers[v] if kind == 'slot' else v
+
+        for ufunc, operands, slot in self.steps:
+            ufunc(*(value(o) for o in operands), out=buffers[slot])
+        return value(self.result)
+
+
+def _cloud_mask_on_grid(cloud_mask_file: str, transform: Affine, shape, crs=None,
+                        warp_cloud_mask: bool = False) -> Optional[np.ndarray]:
+    """
+    Маска облачности (True - облака) на сетке растра, параметры - см. calc_ndvi.
+    Если маску не удалось прочитать, возвращает None.
+    """
+    try:
+        if warp_cloud_mask:
+            return warp_cloud_mask_to_grid(cloud_mask_file, transform, shape, crs) == 4
+        with rasterio.open(cloud_mask_file) as cmf:
+            return utility.apply_mask(np.zeros(shape, bool), transform, cmf.read(1) == 4, cmf.transform, True)
+    except Exception as exc:
+        logger.warning(f'ошибка при чтении маски облачности {cloud_mask_file}: {exc}')
+        return None
+
+
+def expression_bands(expression: str) -> List[str]:
+    """
+    Каналы, которые используются в выражении (в порядке появления)
+
+    :raises ValueError: если выражение не удалось разобрать или оно содержит неподдерживаемые операции
+    """
+    return list(_ExpressionProgram(expression).bands)
+
+
+def process_band_math(input_file: str, outputs: Dict[str, str], expressions: Dict[str, BandExpression] = None,
+                      band_names: Sequence[str] = None, cloud_mask_file: str = None, warp_cloud_mask: bool = False,
+                      block_rows: int = 512) -> List[str]:
+    """
+    Считает несколько индексов по каналам файла (например, VIMGO) за один проход: файл читается блоками
+    по block_rows строк, каждый нужный канал читается один раз, все индексы блока считаются в float32
+    во временных буферах, которые выделяются один раз.
+
+    Пиксели без данных (nan в каналах) и результаты деления на ноль получают nan, облачные пиксели -
+    cloud_value индекса (если он указан).
+
+    :param input_file: файл с каналами
+    :param outputs: название индекса -> выходной файл
+    :param expressions: название индекса -> BandExpression, по умолчанию - BAND_INDICES
+    :param band_names: названия каналов файла по порядку, по умолчанию - описания каналов, а если их нет -
+        SVI01, SVI02, ... (порядок каналов VIMGO)
+    :param cloud_mask_file: маска облачности, параметры маски - см. calc_ndvi
+    :return: созданные файлы
+    """
+    expressions = BAND_INDICES if expressions is None else expressions
+    unknown = [name for name in outputs if name not in expressions]
+    if unknown:
+        raise ValueError(f'неизвестные индексы: {", ".join(unknown)}')
+    programs = {name: _ExpressionProgram(expressions[name].expression) for name in outputs}
+    if not programs:
+        return []
+
+    opened = []
+    try:
+        f = rasterio.open(input_file)
+        opened.append(f)
+        if band_names is None:
+            band_names = f.descriptions if all(f.descriptions) else GeofileInfo.I_BAND_SDR[:f.count]
+        band_indexes = {name: index for index, name in enumerate(band_names, 1)}
+        required = list(dict.fromkeys(band for program in programs.values() for band in program.bands))
+        missing = [band for band in required if band not in band_indexes]
+        if missing:
+            raise InvalidData(f'в файле {input_file} нет каналов {", ".join(missing)}')
+
+        height, width = f.height, f.width
+        block_rows = max(1, min(block_rows, height))
+        clouds = None
+        if cloud_mask_file and any(expressions[name].cloud_value is not None for name in programs):
+            clouds = _cloud_mask_on_grid(cloud_mask_file, f.transform, (height, width), f.crs, warp_cloud_mask)
+
+        meta = utility.make_rasterio_meta(height, width, 1)
+        meta.update({'transform': f.transform, 'crs': f.crs})
+        outs = {}
+        for name in programs:
+            outs[name] = rasterio.open(outputs[name], 'w', **meta)
+            opened.append(outs[name])
+
+        band_buffers = {band: np.empty((block_rows, width), 'float32') for band in required}
+        scratch = {name: [np.empty((block_rows, width), 'float32') for _ in range(program.slots)]
+                   for name, program in programs.items()}
+        result_buffer = np.empty((block_rows, width), 'float32')
+        invalid = np.empty((block_rows, width), bool)
+
+        for row in range(0, height, block_rows):
+            rows = min(block_rows, height - row)
+            window = rasterio.windows.Window(0, row, width, rows)
+            bands = {}
+            for band in required:
+                buffer = band_buffers[band][:rows]
+                if f.dtypes[band_indexes[band] - 1] == 'float32':
+                    f.read(band_indexes[band], window=window, out=buffer)
+                else:
+                    buffer[...] = f.read(band_indexes[band], window=window)
+                bands[band] = buffer
+
+            for name, program in programs.items():
+                expression = expressions[name]
+                result, block_invalid = result_buffer[:rows], invalid[:rows]
+                with np.errstate(all='ignore'):
+                    np.copyto(result, program.evaluate(bands, [buffer[:rows] for buffer in scratch[name]]))
+                np.isfinite(result, out=block_invalid)
+                np.logical_not(block_invalid, out=block_invalid)
+                if expression.valid_range is not None:
+                    low, high = expression.valid_range
+                    with np.errstate(invalid='ignore'):
+                        block_invalid |= (result < low) | (result > high)
+                result[block_invalid] = np.nan
+                if expression.cloud_value is not None and clouds is not None:
+                    result[clouds[row:row + rows]] = expression.cloud_value
+                outs[name].write(result, 1, window=window)
+    finally:
+        for dataset in opened:
+            dataset.close()
+    return [outputs[name] for name in programs]
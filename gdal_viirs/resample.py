@@ -0,0 +1,235 @@
+"""
+resample.py содержит операторы перепроецирования (разреженный оператор и индекс ближайших точек),
+которые строятся один раз для файла геолокации и затем применяются ко всем каналам набора файлов
+"""
+from pathlib import Path
+from typing import Union, TYPE_CHECKING
+
+import numpy as np
+from loguru import logger
+
+from gdal_viirs.types import ProcessedGeolocFile
+
+# scipy импортируется только при построении или загрузке операторов: запуски, в которых нет новых
+# снимков, не тратят время на его импорт
+if TYPE_CHECKING:
+    import scipy.sparse
+
+RESAMPLE_NEAREST = 'nearest'
+RESAMPLE_MEAN = 'mean'
+
+RESAMPLE_METHODS = RESAMPLE_NEAREST, RESAMPLE_MEAN
+
+
+def _kdtree_workers_kwargs() -> dict:
+    """
+    Параметры cKDTree.query для поиска во всех потоках: до scipy 1.6 параметр называется n_jobs
+    (в requirements.txt закреплен scipy 1.5.4), в новых версиях - workers
+    """
+    import scipy
+    version = tuple(int(v) for v in scipy.__version__.split('.')[:2])
+    return {'workers': -1} if version >= (1, 6) else {'n_jobs': -1}
+
+
+class SparseResampler:
+    """
+    Разреженная матрица размера (кол-во пикселей выходного изображения) x (кол-во точек снимка),
+    которая переводит значения точек снимка в пиксели выходного изображения.
+
+    Все веса матрицы равны 1, нормализация выполняется при применении оператора, чтобы
+    корректно исключать nodata значения конкретного канала (nan).
+    """
+
+    def __init__(self, matrix: 'scipy.sparse.csr_matrix', out_image_shape, method: str, fill_distance: int):
+        assert matrix.shape[0] == out_image_shape[0] * out_image_shape[1], 'matrix.shape не соответствует out_image_shape'
+        self.matrix = matrix
+        self.out_image_shape = tuple(int(v) for v in out_image_shape)
+        self.method = method
+        self.fill_distance = fill_distance
+
+    @property
+    def samples_count(self):
+        return self.matrix.shape[1]
+
+    @classmethod
+    def from_geoloc(cls, geoloc_file: ProcessedGeolocFile,
+                    method: str = RESAMPLE_MEAN,
+                    fill_distance: int = 10) -> 'SparseResampler':
+        """
+        Строит оператор по обработанному файлу геолокации.
+
+        :param geoloc_file: обработанный файл геолокации
+        :param method: nearest - каждому пикселю соответствует первая (в порядке следования в снимке) попавшая в него
+            точка, mean - среднее всех попавших в пиксель точек
+        :param fill_distance: максимальное расстояние (в пикселях) на которое заполняются пустые пиксели значением
+            ближайшего непустого пикселя, 0 - не заполнять
+        """
+        if method not in RESAMPLE_METHODS:
+            raise ValueError(f'неизвестный метод {method}, поддерживаются: {", ".join(RESAMPLE_METHODS)}')
+
+        height, width = geoloc_file.out_image_shape
+        samples_count = geoloc_file.samples_count
+        rows = geoloc_file.linear_index
+        cols = np.arange(samples_count, dtype='int32')
+
+        if method == RESAMPLE_NEAREST:
+            rows, first = np.unique(rows, return_index=True)
+            cols = cols[first]
+
+        import scipy.sparse
+        matrix = scipy.sparse.csr_matrix(
+            (np.ones(rows.shape[0], 'float32'), (rows, cols)),
+            shape=(height * width, samples_count))
+        del rows, cols
+
+        if fill_distance > 0:
+            matrix = _with_gap_fill(matrix, (height, width), fill_distance)
+
+        logger.debug(f'SparseResampler: method={method} nnz={matrix.nnz} shape={matrix.shape}')
+        return cls(matrix, (height, width), method, fill_distance)
+
+    def resample(self, samples: np.ndarray) -> np.ndarray:
+        """
+        Применяет оператор к значениям точек снимка.
+
+        :param samples: массив (N,) для одного канала или (N, B) для B каналов, nan означает отсутствие данных
+        :return: массив (H, W) или (B, H, W) типа float32, пиксели без данных равны nan
+        """
+        if samples.shape[0] != self.samples_count:
+            raise ValueError(f'samples.shape={samples.shape} не соответствует оператору ({self.samples_count} точек)')
+        samples = samples.astype('float32', copy=False)
+        valid = np.isfinite(samples)
+        values = np.where(valid, samples, 0).astype('float32', copy=False)
+
+        # одно умножение (матрица на вектор или матрица на матрицу) для суммы и одно для количества значений
+        total = self.matrix @ values
+        count = self.matrix @ valid.astype('float32')
+        del values, valid
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            image = total / count
+        image[count == 0] = np.nan
+        image = image.astype('float32', copy=False)
+
+        if image.ndim == 1:
+            return image.reshape(self.out_image_shape)
+        return image.T.reshape((image.shape[1], *self.out_image_shape))
+
+    def save(self, path: Union[str, Path]):
+        matrix = self.matrix
+        np.savez(str(path),
+                 data=matrix.data, indices=matrix.indices, indptr=matrix.indptr,
+                 shape=np.array(matrix.shape), out_image_shape=np.array(self.out_image_shape),
+                 method=np.array(self.method), fill_distance=np.array(self.fill_distance))
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> 'SparseResampler':
+        import scipy.sparse
+        with np.load(str(path)) as f:
+            matrix = scipy.sparse.csr_matrix((f['data'], f['indices'], f['indptr']), shape=tuple(f['shape']))
+            return cls(matrix, tuple(f['out_image_shape']), str(f['method']), int(f['fill_distance']))
+
+
+class KDTreeResampler:
+    """
+    Индекс ближайших точек: для каждого пикселя выходного изображения в пределах полосы обзора хранится
+    номер ближайшей (по дробным координатам) точки снимка не дальше radius пикселей.
+    Применение к каналу - одна выборка по индексу, отдельное заполнение пустот не требуется.
+    """
+
+    def __init__(self, pixels: np.ndarray, samples: np.ndarray, out_image_shape, samples_count: int, radius: float):
+        assert pixels.shape == samples.shape, 'pixels.shape != samples.shape'
+        self.pixels = pixels
+        self.samples = samples
+        self.out_image_shape = tuple(int(v) for v in out_image_shape)
+        self.samples_count = int(samples_count)
+        self.radius = radius
+
+    @classmethod
+    def from_geoloc(cls, geoloc_file: ProcessedGeolocFile, radius: float = 3.0) -> 'KDTreeResampler':
+        """
+        Строит индекс по обработанному файлу геолокации, требуются дробные координаты точек
+        (process_geoloc_file(..., keep_coords=True)).
+
+        :param geoloc_file: обработанный файл геолокации
+        :param radius: максимальное расстояние (в пикселях) от центра пикселя до точки снимка
+        """
+        if geoloc_file.x_coords is None or geoloc_file.y_coords is None:
+            raise ValueError('для построения KDTreeResampler необходимы координаты точек (keep_coords=True)')
+
+        height, width = geoloc_file.out_image_shape
+        samples_count = geoloc_file.x_coords.shape[0]
+        import scipy.ndimage
+        import scipy.spatial
+        tree = scipy.spatial.cKDTree(np.column_stack((geoloc_file.x_coords, geoloc_file.y_coords)))
+
+        # кандидаты - пиксели не дальше radius от пикселей, в которые попала хотя бы одна точка,
+        # так не приходится искать ближайшую точку для пикселей вне полосы обзора
+        footprint = np.zeros((height, width), np.bool_)
+        footprint.ravel()[geoloc_file.linear_index] = True
+        footprint = scipy.ndimage.binary_dilation(footprint, iterations=int(np.ceil(radius)))
+        rows, cols = np.nonzero(footprint)
+        del footprint
+
+        _, nearest = tree.query(np.column_stack((cols, rows)), k=1, distance_upper_bound=radius,
+                                **_kdtree_workers_kwargs())
+        del tree
+        found = nearest < samples_count
+        pixels = (rows[found] * width + cols[found]).astype('int32')
+        samples = nearest[found].astype('int32')
+        logger.debug(f'KDTreeResampler: radius={radius} pixels={pixels.shape[0]} shape={(height, width)}')
+        return cls(pixels, samples, (height, width), samples_count, radius)
+
+    def resample(self, samples: np.ndarray) -> np.ndarray:
+        """
+        Применяет индекс к значениям точек снимка.
+
+        :param samples: массив (N,) для одного канала или (N, B) для B каналов, nan означает отсутствие данных
+        :return: массив (H, W) или (B, H, W) типа float32, пиксели без данных равны nan
+        """
+        if samples.shape[0] != self.samples_count:
+            raise ValueError(f'samples.shape={samples.shape} не соответствует индексу ({self.samples_count} точек)')
+        height, width = self.out_image_shape
+        if samples.ndim == 1:
+            image = np.full(height * width, np.nan, 'float32')
+            image[self.pixels] = samples[self.samples]
+            return image.reshape(self.out_image_shape)
+
+        image = np.full((samples.shape[1], height * width), np.nan, 'float32')
+        image[:, self.pixels] = samples[self.samples].T
+        return image.reshape((samples.shape[1], height, width))
+
+    def save(self, path: Union[str, Path]):
+        np.savez(str(path),
+                 pixels=self.pixels, samples=self.samples, out_image_shape=np.array(self.out_image_shape),
+                 samples_count=np.array(self.samples_count), radius=np.array(self.radius))
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> 'KDTreeResampler':
+        with np.load(str(path)) as f:
+            return cls(f['pixels'], f['samples'], tuple(f['out_image_shape']), int(f['samples_count']),
+                       float(f['radius']))
+
+
+def _with_gap_fill(matrix: 'scipy.sparse.csr_matrix', shape, fill_distance: int) -> 'scipy.sparse.csr_matrix':
+    """
+    Добавляет в оператор веса для заполнения пустых пикселей: строка пустого пикселя становится копией строки
+    ближайшего (по евклидову расстоянию) непустого пикселя, если он находится не дальше fill_distance.
+    """
+    empty = np.diff(matrix.indptr).reshape(shape) == 0
+    if not empty.any() or empty.all():
+        return matrix
+    import scipy.ndimage
+    import scipy.sparse
+    distance, (nearest_y, nearest_x) = scipy.ndimage.distance_transform_edt(empty, return_indices=True)
+    source = nearest_y * shape[1] + nearest_x
+    del nearest_x, nearest_y
+    source[distance > fill_distance] = -1
+    source = source.ravel()
+    del distance
+
+    pixels = np.flatnonzero(source >= 0)
+    selection = scipy.sparse.csr_matrix(
+        (np.ones(pixels.shape[0], 'float32'), (pixels, source[pixels])),
+        shape=(matrix.shape[0], matrix.shape[0]))
+    return (selection @ matrix).tocsr()
@@ -0,0 +1,327 @@
+"""
+sharedmem.py - передача массивов (сетки каналов, маски, композиты) между процессами без копирования.
+
+Массив хранится в сегменте - .npy файле в /dev/shm (в памяти, без записи на диск), который каждый процесс
+отображает в память (np.memmap). Между процессами передается только описание массива: путь к сегменту,
+Affine transform и проекция, поэтому SharedArray можно передавать в ProcessPoolExecutor и multiprocessing
+как обычный аргумент, данные при этом не копируются.
+
+Время жизни сегментов явное: сегмент создает и удаляет владелец (SharedArena или SharedArray.create),
+процессы, получившие массив, только отображают его в память. Сегмент можно удалить, пока он отображен:
+данные остаются доступны всем, кто уже отобразил его, память освобождается после закрытия последнего
+отображения, а новые процессы подключиться к нему уже не смогут.
+
+Сегменты упавших процессов удаляются:
+
+* при выходе из интерпретатора, в том числе после необработанного исключения (atexit);
+* при создании первой SharedArena в любом процессе: удаляются сегменты, процесс-владелец которых (pid
+  в имени сегмента) уже завершился, так убираются сегменты процессов, убитых SIGKILL.
+"""
+import atexit
+import os
+import tempfile
+import threading
+import uuid
+from pathlib import Path
+from typing import List, NamedTuple, Optional, Tuple, Union
+
+import numpy as np
+import pyproj
+from affine import Affine
+from loguru import logger
+
+from gdal_viirs.types import Number, PackedMask, ProcessedGeolocFile
+
+SEGMENT_PREFIX = 'gdal_viirs_'
+
+_SHM_DIR = '/dev/shm'
+
+# сегменты, созданные в этом процессе и еще не удаленные
+_owned = set()
+_owned_lock = threading.Lock()
+_stale_removed = False
+
+
+def get_shared_dir() -> Path:
+    """
+    Папка для сегментов: /dev/shm, если она есть (Linux), иначе временная папка (на диске)
+    """
+    if os.path.isdir(_SHM_DIR) and os.access(_SHM_DIR, os.W_OK):
+        return Path(_SHM_DIR)
+    return Path(tempfile.gettempdir())
+
+
+def _segment_pid(path: Union[str, Path]) -> Optional[int]:
+    try:
+        return int(Path(path).name[len(SEGMENT_PREFIX):].split('_', 1)[0])
+    except ValueError:
+        return None
+
+
+def _is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _remove_segment(path: str):
+    with _owned_lock:
+        _owned.discard(path)
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def remove_stale_segments(directory: Union[str, Path] = None) -> int:
+    """
+    Удаляет сегменты, процесс-владелец которых завершился, не удалив их (например, был убит SIGKILL)
+
+    :return: количество удаленных сегментов
+    """
+    removed = 0
+    for path in Path(directory or get_shared_dir()).glob(SEGMENT_PREFIX + '*.npy'):
+        pid = _segment_pid(path)
+        if pid is None or _is_alive(pid):
+            continue
+        try:
+            path.unlink()
+            removed += 1
+        except FileNotFoundError:
+            pass
+    if removed:
+        logger.warning(f'удалено {removed} сегментов разделяемой памяти завершившихся процессов')
+    return removed
+
+
+@atexit.register
+def _remove_owned_segments():
+    # после fork дочерний процесс получает копию _owned, удаляем только свои сегменты
+    pid = os.getpid()
+    for path in list(_owned):
+        if _segment_pid(path) == pid:
+            _remove_segment(path)
+
+
+def _crs_to_string(crs) -> Optional[str]:
+    """
+    Проекция в виде строки (WKT или PROJ), которую понимают и rasterio, и pyproj
+    """
+    if crs is None or isinstance(crs, str):
+        return crs
+    if isinstance(crs, pyproj.Proj):
+        return crs.srs
+    return crs.to_wkt()
+
+
+class SharedArray:
+    """
+    Массив в разделяемой памяти вместе с привязкой: Affine transform и проекцией (строка WKT или PROJ).
+    При передаче в другой процесс (pickle) передается только описание, процесс-получатель отображает
+    тот же сегмент в память, запись в data видна всем процессам.
+
+    Удаляет сегмент только владелец (release или выход из блока with), остальные процессы только
+    закрывают отображение.
+    """
+    __slots__ = ('path', 'data', 'transform', 'crs', '_owner')
+
+    path: str
+    data: Optional[np.ndarray]
+    transform: Optional[Affine]
+    crs: Optional[str]
+
+    def __init__(self, path: Union[str, Path], data: np.ndarray, transform: Affine = None, crs=None,
+                 owner: bool = False):
+        self.path = str(path)
+        self.data = data
+        self.transform = transform
+        self.crs = _crs_to_string(crs)
+        self._owner = owner
+
+    @classmethod
+    def create(cls, shape: Tuple[int, ...], dtype, transform: Affine = None, crs=None, fill_value: Number = None,
+               directory: Union[str, Path] = None) -> 'SharedArray':
+        """
+        Создает сегмент (заполненный нулями или fill_value), вызывающий процесс становится его владельцем
+        """
+        path = str(Path(directory or get_shared_dir()) / f'{SEGMENT_PREFIX}{os.getpid()}_{uuid.uuid4().hex}.npy')
+        with _owned_lock:
+            _owned.add(path)
+        try:
+            data = np.lib.format.open_memmap(path, 'w+', dtype=np.dtype(dtype), shape=tuple(shape))
+        except Exception:
+            _remove_segment(path)
+            raise
+        if fill_value is not None:
+            data.fill(fill_value)
+        return cls(path, data, transform, crs, owner=True)
+
+    @classmethod
+    def from_array(cls, array: np.ndarray, transform: Affine = None, crs=None,
+                   directory: Union[str, Path] = None) -> 'SharedArray':
+        """
+        Копирует массив в новый сегмент, дальше он передается между процессами без копирования
+        """
+        shared = cls.create(array.shape, array.dtype, transform, crs, directory=directory)
+        shared.data[...] = array
+        return shared
+
+    @classmethod
+    def attach(cls, path: Union[str, Path], transform: Affine = None, crs=None,
+               writable: bool = False) -> 'SharedArray':
+        """
+        Отображает в память существующий сегмент (без владения)
+        """
+        return cls(path, np.load(str(path), mmap_mode='r+' if writable else 'r'), transform, crs)
+
+    def __reduce__(self):
+        if self.data is None:
+            raise ValueError(f'сегмент {self.path} уже освобожден')
+        return SharedArray.attach, (self.path, self.transform, self.crs, self.data.flags.writeable)
+
+    @property
+    def is_owner(self) -> bool:
+        return self._owner
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return self.data.shape
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self.data.dtype
+
+    @property
+    def nbytes(self) -> int:
+        return self.data.nbytes
+
+    def release(self):
+        """
+        Закрывает массив, владелец удаляет сегмент. Полученные ранее из data массивы остаются корректными,
+        пока на них есть ссылки.
+        """
+        self.data = None
+        if self._owner:
+            self._owner = False
+            _remove_segment(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    def __repr__(self):
+        state = 'released' if self.data is None else f'{self.data.shape} {self.data.dtype}'
+        return f'<SharedArray {self.path} {state}{" owner" if self._owner else ""}>'
+
+
+class SharedGeolocFile(NamedTuple):
+    """
+    Обработанный файл геолокации в разделяемой памяти (см. SharedArena.share_geoloc). Передается
+    в другие процессы без копирования linear_index и маски, ProcessedGeolocFile получается через open().
+    """
+    linear_index: SharedArray
+    mask_bits: SharedArray
+    mask_shape: Tuple[int, ...]
+    geotransform_min_x: Number
+    geotransform_max_y: Number
+    projection: str
+    scale: Number
+    out_image_shape: Tuple[int, int]
+    x_coords: Optional[SharedArray] = None
+    y_coords: Optional[SharedArray] = None
+
+    def open(self) -> ProcessedGeolocFile:
+        """
+        ProcessedGeolocFile, массивы которого отображены на сегменты (без копирования)
+        """
+        return ProcessedGeolocFile(
+            linear_index=self.linear_index.data,
+            lonlat_mask=PackedMask(self.mask_bits.data, self.mask_shape),
+            geotransform_min_x=self.geotransform_min_x,
+            geotransform_max_y=self.geotransform_max_y,
+            projection=pyproj.Proj(self.projection),
+            scale=self.scale,
+            out_image_shape=self.out_image_shape,
+            x_coords=self.x_coords.data if self.x_coords is not None else None,
+            y_coords=self.y_coords.data if self.y_coords is not None else None
+        )
+
+
+class SharedArena:
+    """
+    Набор сегментов с общим временем жизни: все сегменты, созданные через арену, удаляются при выходе
+    из блока with (в том числе по исключению) или при вызове release:
+
+        with SharedArena() as arena:
+            geoloc = arena.share_geoloc(geoloc_file)
+            cube = arena.empty((5, height, width), 'float32', transform=transform, crs=proj)
+            list(executor.map(worker, [geoloc] * 5, [cube] * 5, range(5)))
+            data = cube.data  # остается доступен после выхода из блока with
+    """
+
+    def __init__(self, directory: Union[str, Path] = None):
+        global _stale_removed
+        self.directory = Path(directory) if directory else get_shared_dir()
+        self._arrays: List[SharedArray] = []
+        if not _stale_removed:
+            _stale_removed = True
+            remove_stale_segments(self.directory)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(array.nbytes for array in self._arrays if array.data is not None)
+
+    def empty(self, shape: Tuple[int, ...], dtype, transform: Affine = None, crs=None,
+              fill_value: Number = None) -> SharedArray:
+        """
+        Новый сегмент, заполненный нулями или fill_value, например для результатов процессов-исполнителей
+        """
+        array = SharedArray.create(shape, dtype, transform, crs, fill_value, directory=self.directory)
+        self._arrays.append(array)
+        return array
+
+    def share(self, array: np.ndarray, transform: Affine = None, crs=None) -> SharedArray:
+        """
+        Копирует массив в новый сегмент
+        """
+        shared = SharedArray.from_array(array, transform, crs, directory=self.directory)
+        self._arrays.append(shared)
+        return shared
+
+    def share_geoloc(self, geoloc_file: ProcessedGeolocFile) -> SharedGeolocFile:
+        """
+        Копирует обработанный файл геолокации в сегменты, linear_index несет transform и проекцию сетки
+        """
+        crs = geoloc_file.projection.srs
+        return SharedGeolocFile(
+            linear_index=self.share(geoloc_file.linear_index, geoloc_file.transform, crs),
+            mask_bits=self.share(geoloc_file.packed_mask.bits),
+            mask_shape=geoloc_file.packed_mask.shape,
+            geotransform_min_x=geoloc_file.geotransform_min_x,
+            geotransform_max_y=geoloc_file.geotransform_max_y,
+            projection=crs,
+            scale=geoloc_file.scale,
+            out_image_shape=geoloc_file.out_image_shape,
+            x_coords=self.share(geoloc_file.x_coords) if geoloc_file.x_coords is not None else None,
+            y_coords=self.share(geoloc_file.y_coords) if geoloc_file.y_coords is not None else None
+        )
+
+    def release(self):
+        """
+        Удаляет все сегменты арены
+        """
+        arrays, self._arrays = self._arrays, []
+        for array in arrays:
+            array.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
@@ -7,7 +7,7 @@ import os
 from dataclasses import dataclass
 from datetime import datetime, time
 from pathlib import Path
-from typing import NamedTuple, List, TypeVar, Union, Tuple
+from typing import NamedTuple, List, TypeVar, Union, Tuple, Optional
 
 import numpy as np
 import pyproj
@@ -18,6 +18,8 @@ from gdal_viirs.exceptions import InvalidFileType, InvalidFilename
 
 TNumpyOperable = TypeVar('TNumpyOperable', np.ndarray, float, int)
 Number = Union[int, float]
+# xmin, ymin, xmax, ymax
+Bounds = Tuple[Number, Number, Number, Number]
 
 
 class Point(NamedTuple):
@@ -210,16 +212,97 @@ class GeofileInfo:
 GDALGeotransformT = Tuple[Number, Number, Number, Number, Number, Number]
 
 
-@dataclass
+class PackedMask:
+    """
+    Битовая маска (np.packbits), занимает в 8 раз меньше памяти, чем массив bool
+    """
+    __slots__ = ('bits', 'shape')
+
+    def __init__(self, bits: np.ndarray, shape: Tuple[int, ...]):
+        self.bits = bits
+        self.shape = tuple(int(v) for v in shape)
+
+    @classmethod
+    def pack(cls, mask: np.ndarray) -> 'PackedMask':
+        return cls(np.packbits(mask, axis=None), mask.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    def unpack(self) -> np.ndarray:
+        return np.unpackbits(self.bits, count=self.size).view(np.bool_).reshape(self.shape)
+
+
 class ProcessedGeolocFile:
-    lonlat_mask: np.ndarray
+    """
+    Обработанный файл геолокации.
+
+    Для каждой точки снимка с корректной геолокацией хранится только линейный индекс (int32) пикселя
+    выходного изображения (уже перевернутого по вертикали), маска корректной геолокации хранится
+    упакованной в биты.
+    """
+    __slots__ = ('linear_index', 'packed_mask', 'geotransform_min_x', 'geotransform_max_y', 'projection', 'scale',
+                 'out_image_shape', 'x_coords', 'y_coords')
+
+    linear_index: np.ndarray
+    packed_mask: PackedMask
     geotransform_min_x: Number
     geotransform_max_y: Number
     projection: pyproj.Proj
     scale: Number
     out_image_shape: Tuple[int, int]
-    x_index: np.ndarray
-    y_index: np.ndarray
+    # дробные координаты точек в пикселях выходного изображения, есть только если
+    # process_geoloc_file вызвана с keep_coords=True, в кэш не сохраняются
+    x_coords: Optional[np.ndarray]
+    y_coords: Optional[np.ndarray]
+
+    def __init__(self,
+                 linear_index: np.ndarray,
+                 lonlat_mask: Union[np.ndarray, PackedMask],
+                 geotransform_min_x: Number,
+                 geotransform_max_y: Number,
+                 projection: pyproj.Proj,
+                 scale: Number,
+                 out_image_shape: Tuple[int, int],
+                 x_coords: Optional[np.ndarray] = None,
+                 y_coords: Optional[np.ndarray] = None):
+        assert out_image_shape[0] * out_image_shape[1] < 2 ** 31, \
+            f'изображение {out_image_shape} слишком большое для индекса int32'
+        self.linear_index = linear_index.astype('int32', copy=False)
+        self.packed_mask = lonlat_mask if isinstance(lonlat_mask, PackedMask) else PackedMask.pack(lonlat_mask)
+        self.geotransform_min_x = geotransform_min_x
+        self.geotransform_max_y = geotransform_max_y
+        self.projection = projection
+        self.scale = scale
+        self.out_image_shape = tuple(int(v) for v in out_image_shape)
+        self.x_coords = x_coords
+        self.y_coords = y_coords
+
+    @property
+    def samples_count(self) -> int:
+        return self.linear_index.shape[0]
+
+    @property
+    def lonlat_mask(self) -> np.ndarray:
+        """
+        Маска точек снимка с корректной геолокацией (распаковывается при каждом обращении)
+        """
+        return self.packed_mask.unpack()
+
+    @property
+    def x_index(self) -> np.ndarray:
+        """
+        Номер столбца пикселя для каждой точки (вычисляется из linear_index)
+        """
+        return self.linear_index % self.width
+
+    @property
+    def y_index(self) -> np.ndarray:
+        """
+        Номер строки пикселя (снизу вверх, до переворота изображения) для каждой точки (вычисляется из linear_index)
+        """
+        return self.height - 1 - self.linear_index // self.width
 
     @property
     def height(self):
@@ -245,6 +328,30 @@ class ProcessedGeolocFile:
         return Affine.translation(self.geotransform_min_x, self.geotransform_max_y) * Affine.scale(self.scale,
                                                                                                    -self.scale)
 
+    def save(self, path: Union[str, Path]):
+        """
+        Сохраняет обработанный файл геолокации в .npz файл (кэш геолокации)
+        """
+        np.savez(str(path),
+                 linear_index=self.linear_index,
+                 mask_bits=self.packed_mask.bits, mask_shape=np.array(self.packed_mask.shape),
+                 geotransform_min_x=self.geotransform_min_x, geotransform_max_y=self.geotransform_max_y,
+                 projection=np.array(self.projection.srs), scale=self.scale,
+                 out_image_shape=np.array(self.out_image_shape))
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> 'ProcessedGeolocFile':
+        with np.load(str(path)) as f:
+            return cls(
+                linear_index=f['linear_index'],
+                lonlat_mask=PackedMask(f['mask_bits'], tuple(f['mask_shape'])),
+                geotransform_min_x=f['geotransform_min_x'].item(),
+                geotransform_max_y=f['geotransform_max_y'].item(),
+                projection=pyproj.Proj(str(f['projection'])),
+                scale=f['scale'].item(),
+                out_image_shape=tuple(int(v) for v in f['out_image_shape'])
+            )
+
 
 class ProcessedBandFile(NamedTuple):
     data: np.ndarray
@@ -20,6 +20,28 @@ def h5py_get_dataset(filename: str, dataset_lastname: str) -> Optional[h5py.File
         return None
 
 
+def h5py_get_dataset_decimated(filename: str, dataset_lastname: str, step: int) -> Optional[np.ndarray]:
+    """
+    Читает каждый step-ый элемент по каждой оси датасета (HDF5 читает только нужные строки)
+    """
+    with h5py.File(filename, 'r') as f:
+        datasets = []
+        f.visit(datasets.append)
+        try:
+            ds = next(ds for ds in datasets if ds == dataset_lastname or ds.endswith('/' + dataset_lastname))
+        except StopIteration:
+            return None
+        return f[ds][tuple(slice(None, None, step) for _ in range(f[ds].ndim))]
+
+
+def bounds_intersect(a: Bounds, b: Bounds) -> bool:
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+def points_in_bounds(x: np.ndarray, y: np.ndarray, bounds: Bounds) -> np.ndarray:
+    return (x >= bounds[0]) & (y >= bounds[1]) & (x <= bounds[2]) & (y <= bounds[3])
+
+
 def _find_viirs_files(root: str) -> List[GeofileInfo]:
     """
     Находит и возвращает все HDF VIIRS файлы в указанной папке
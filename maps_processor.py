@@ -1,5 +1,6 @@
 #!/usr/bin/python3
-from gdal_viirs.hl.shortcuts import produce_maps
+from gdal_viirs.hl.shortcuts import produce_maps, parse_cli_args
 
 if __name__ == '__main__':
-    produce_maps('config')
+    args = parse_cli_args()
+    produce_maps('config', profile=args.profile)
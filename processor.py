@@ -1,5 +1,6 @@
 #!/usr/bin/python3
-from gdal_viirs.hl.shortcuts import process_recent
+from gdal_viirs.hl.shortcuts import process_recent, parse_cli_args
 
 if __name__ == '__main__':
-    process_recent('config')
+    args = parse_cli_args()
+    process_recent('config', profile=args.profile)
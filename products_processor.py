@@ -1,5 +1,6 @@
 #!/usr/bin/python3
-from gdal_viirs.hl.shortcuts import produce_products
+from gdal_viirs.hl.shortcuts import produce_products, parse_cli_args
 
 if __name__ == '__main__':
-    produce_products('config')
+    args = parse_cli_args()
+    produce_products('config', profile=args.profile)
@@ -0,0 +1,5 @@
+#!/usr/bin/python3
+from gdal_viirs.hl.timeseries import run_cli
+
+if __name__ == '__main__':
+    run_cli('config')